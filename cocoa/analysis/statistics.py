@@ -0,0 +1,150 @@
+'''
+Dataset statistics computed in a single pass over transcripts.
+
+A Statistic accumulates transcripts one at a time (`update`) into mergeable
+accumulators, so that shards of the transcripts can be processed separately
+(e.g. by different processes) and merged (`merge`) into the same result.
+`compute_statistics` runs all registered statistics in one traversal of a
+stream of transcripts (e.g. `cocoa.core.util.iter_json`).
+'''
+import copy
+import math
+import multiprocessing
+from collections import defaultdict
+from itertools import islice, izip
+
+def _add_partial(partials, x):
+    # Shewchuk's algorithm (as in math.fsum): keep non-overlapping partial sums
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+class Summary(object):
+    """Count, min, max and sum of values, like the summaries of cocoa.lib.logstats.
+    The sum is exact until it is rounded once in `sum`, so summaries of any
+    split of the values merge into the same result.
+    """
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.partials = []
+
+    def add(self, x):
+        self.count += 1
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        _add_partial(self.partials, x)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for x in other.partials:
+            _add_partial(self.partials, x)
+
+    @property
+    def sum(self):
+        return math.fsum(self.partials)
+
+    @property
+    def mean(self):
+        return self.sum / self.count
+
+    def to_dict(self):
+        return {'min': self.min, 'max': self.max, 'sum': self.sum, 'count': self.count, 'mean': self.mean}
+
+class Statistic(object):
+    """A statistic of a dataset. By default values are accumulated by key in
+    Summary's and the result is their means; subclasses with other
+    accumulators override reset, merge and result.
+    """
+    name = None
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.summaries = defaultdict(Summary)
+
+    def empty(self):
+        """Return a copy with the same parameters and no transcripts.
+        """
+        statistic = copy.copy(self)
+        statistic.reset()
+        return statistic
+
+    def add(self, key, value):
+        self.summaries[key].add(value)
+
+    def update(self, transcript):
+        raise NotImplementedError
+
+    def merge(self, other):
+        for key, summary in other.summaries.iteritems():
+            self.summaries[key].merge(summary)
+
+    def result(self):
+        return {key: summary.mean for key, summary in self.summaries.iteritems()}
+
+def _update(statistics, transcripts, preprocess):
+    for transcript in transcripts:
+        if preprocess is not None:
+            transcript = preprocess(transcript)
+        for statistic in statistics:
+            statistic.update(transcript)
+
+# (statistics, preprocess) of a worker process, set once by _init_worker
+_worker_args = None
+
+def _init_worker(statistics, preprocess):
+    global _worker_args
+    _worker_args = (statistics, preprocess)
+
+def _update_shard(transcripts):
+    statistics, preprocess = _worker_args
+    statistics = [statistic.empty() for statistic in statistics]
+    _update(statistics, transcripts, preprocess)
+    return statistics
+
+def _shards(transcripts, shard_size):
+    transcripts = iter(transcripts)
+    while True:
+        shard = list(islice(transcripts, shard_size))
+        if not shard:
+            break
+        yield shard
+
+def compute_statistics(statistics, transcripts, preprocess=None, num_workers=1, shard_size=100):
+    """Update `statistics` with `transcripts` in one pass.
+    :param statistics: list of Statistic
+    :param transcripts: iterable of transcripts, consumed once
+    :param preprocess: function applied to each transcript before the
+        statistics, e.g. to parse it once for all of them
+    :param num_workers: number of processes; transcripts are sent to them by
+        shards of `shard_size` and their statistics are merged in order
+    :return: dict from statistic name to result
+    """
+    if num_workers <= 1:
+        _update(statistics, transcripts, preprocess)
+    else:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                initargs=([statistic.empty() for statistic in statistics], preprocess))
+        try:
+            for shard_statistics in pool.imap(_update_shard, _shards(transcripts, shard_size)):
+                for statistic, shard_statistic in izip(statistics, shard_statistics):
+                    statistic.merge(shard_statistic)
+        finally:
+            pool.close()
+            pool.join()
+    return {statistic.name: statistic.result() for statistic in statistics}
@@ -2,6 +2,8 @@ from __future__ import print_function
 
 import json
 import random
+from collections import defaultdict
+from itertools import izip
 
 from util import generate_uuid
 from dataset import Example
@@ -45,45 +47,63 @@ class Controller(object):
         '''
         Simulate a dialogue.
         '''
+        state = self._start_simulation(max_turns)
+        game_over = False
+        while not game_over:
+            session = self.sessions[state['agent']]
+            game_over = self._advance_simulation(state, session.send(), verbose)
+        return self._make_example(verbose)
+
+    def _start_simulation(self, max_turns):
+        '''
+        Reset the dialogue and return the simulation state:
+        time, number of turns so far and the agent whose turn it is.
+        '''
         self.events = []
         self.max_turns = max_turns
-        time = 0
-        num_turns = 0
-        game_over = False
         self.describe_scenario()
         if random.random() < 0.5:
             first_speaker = 0
         else:
             first_speaker = 1
-        while not game_over:
-            for agent, session in enumerate(self.sessions):
-                if num_turns == 0 and agent != first_speaker:
-                    continue
-                event = session.send()
-                time += 1
-                if not event:
-                    continue
+        return {'time': 0, 'num_turns': 0, 'agent': first_speaker}
 
-                event.time = time
-                self.event_callback(event)
-                self.events.append(event)
-
-                if verbose:
-                    print('agent=%s: session=%s, event=%s' % (agent, type(session).__name__, event.to_dict()))
-                else:
-                    action = event.action
-                    data = event.data
-                    event_output = data if action == 'message' else "Action: {0}, Data: {1}".format(action, data)
-                    print('agent=%s, event=%s' % (agent, event_output))
-                num_turns += 1
-                if self.game_over() or (max_turns and num_turns >= max_turns):
-                    game_over = True
-                    break
+    def _advance_simulation(self, state, event, verbose=False):
+        '''
+        Record `event` sent by the current agent and pass the turn on.
+        Return whether the dialogue is over.
+        '''
+        agent = state['agent']
+        session = self.sessions[agent]
+        state['time'] += 1
+        if not event:
+            # The first speaker keeps the turn until it says something
+            if state['num_turns'] > 0:
+                state['agent'] = 1 - agent
+            return False
+
+        event.time = state['time']
+        self.event_callback(event)
+        self.events.append(event)
 
-                for partner, other_session in enumerate(self.sessions):
-                    if agent != partner:
-                        other_session.receive(event)
+        if verbose:
+            print('agent=%s: session=%s, event=%s' % (agent, type(session).__name__, event.to_dict()))
+        else:
+            action = event.action
+            data = event.data
+            event_output = data if action == 'message' else "Action: {0}, Data: {1}".format(action, data)
+            print('agent=%s, event=%s' % (agent, event_output))
+        state['num_turns'] += 1
+        state['agent'] = 1 - agent
+        if self.game_over() or (self.max_turns and state['num_turns'] >= self.max_turns):
+            return True
+
+        for partner, other_session in enumerate(self.sessions):
+            if agent != partner:
+                other_session.receive(event)
+        return False
 
+    def _make_example(self, verbose=False):
         uuid = generate_uuid('E')
         outcome = self.get_outcome()
         if verbose:
@@ -163,3 +183,37 @@ class Controller(object):
         """Whether the task was completed successfully.
         """
         raise NotImplementedError
+
+
+class BatchedController(object):
+    """
+    Simulate multiple dialogues in lockstep. At each step, the sessions whose turn
+    it is are grouped by `Session.batch_key` and each group sends together through
+    `Session.send_batch`, so that sessions sharing a model run one batched generation.
+    Finished dialogues drop out of the active set.
+    """
+    def __init__(self, controllers):
+        self.controllers = controllers
+
+    def simulate(self, max_turns=None, verbose=False):
+        '''
+        Simulate all dialogues. Return a list of examples aligned with `controllers`.
+        '''
+        states = [c._start_simulation(max_turns) for c in self.controllers]
+        active = range(len(self.controllers))
+        while active:
+            groups = defaultdict(list)
+            for i in active:
+                session = self.controllers[i].sessions[states[i]['agent']]
+                groups[session.batch_key()].append(i)
+
+            finished = set()
+            for ids in groups.itervalues():
+                sessions = [self.controllers[i].sessions[states[i]['agent']] for i in ids]
+                events = type(sessions[0]).send_batch(sessions)
+                for i, event in izip(ids, events):
+                    if self.controllers[i]._advance_simulation(states[i], event, verbose):
+                        finished.add(i)
+            active = [i for i in active if i not in finished]
+
+        return [c._make_example(verbose) for c in self.controllers]
@@ -2,7 +2,9 @@
 Data structures for events, examples, and datasets.
 '''
 
-from util import read_json
+from itertools import islice
+
+from util import read_json, iter_json
 from event import Event
 from kb import KB
 
@@ -69,6 +71,48 @@ class Example(object):
             'agents_info': self.agents_info,
         }
 
+class LazyExample(Example):
+    '''
+    An Example read from its raw dict whose scenario and events are deserialized
+    when they are first accessed, so reading examples that are never used (or
+    only partially used) is cheap.
+    '''
+    def __init__(self, raw, Scenario):
+        if 'scenario' not in raw:
+            raise ValueError('No scenario')
+        if 'agents' in raw:
+            agents = {int(k): v for k, v in raw['agents'].iteritems()}
+        else:
+            agents = None
+        super(LazyExample, self).__init__(None, raw['scenario_uuid'], None, raw['outcome'], raw['uuid'], agents, agents_info=raw.get('agents_info', None))
+        self._scenario_class = Scenario
+        self._raw_scenario = raw['scenario']
+        self._raw_events = raw['events']
+
+    @property
+    def scenario(self):
+        if self._raw_scenario is not None:
+            self._scenario = self._scenario_class.from_dict(None, self._raw_scenario)
+            self._raw_scenario = None
+        return self._scenario
+
+    @scenario.setter
+    def scenario(self, scenario):
+        self._scenario = scenario
+        self._raw_scenario = None
+
+    @property
+    def events(self):
+        if self._raw_events is not None:
+            self._events = [Event.from_dict(e) for e in self._raw_events]
+            self._raw_events = None
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self._events = events
+        self._raw_events = None
+
 class Dataset(object):
     '''
     A dataset consists of a list of train and test examples.
@@ -107,17 +151,30 @@ class EvalExample(object):
 
 ############################################################
 
-def read_examples(paths, max_examples, Scenario):
+def read_examples(paths, max_examples, Scenario, lazy=True):
     '''
     Read a maximum of |max_examples| examples from |paths|.
+    JSON Lines files, and JSON arrays when |max_examples| is set, are read
+    incrementally and the rest of the file is not parsed.
+    If |lazy|, scenarios and events are deserialized when first accessed (LazyExample).
     '''
     examples = []
     for path in paths:
+        if max_examples >= 0 and len(examples) >= max_examples:
+            break
         print 'read_examples: %s' % path
-        for raw in read_json(path):
-            if max_examples >= 0 and len(examples) >= max_examples:
-                break
-            examples.append(Example.from_dict(raw, Scenario))
+        if max_examples >= 0:
+            raws = islice(iter_json(path), max_examples - len(examples))
+        elif path.endswith('.jsonl'):
+            raws = iter_json(path)
+        else:
+            # The whole file is needed: ujson is faster than incremental decoding
+            raws = read_json(path)
+        for raw in raws:
+            if lazy:
+                examples.append(LazyExample(raw, Scenario))
+            else:
+                examples.append(Example.from_dict(raw, Scenario))
     return examples
 
 def read_dataset(args, Scenario):
@@ -0,0 +1,133 @@
+'''
+Generate bot-bot dialogues with multiple processes.
+
+Jobs are (scenario_uuid, agent_names) pairs. They are partitioned across
+worker processes, each of which loads its own systems. Examples are streamed
+back to the parent and appended to a JSONL file as dialogues complete, so an
+interrupted run can be resumed: jobs already present in the output are skipped.
+'''
+import os
+import random
+import traceback
+import multiprocessing
+from collections import Counter, defaultdict
+
+import ujson as json
+import numpy as np
+
+
+def job_key(scenario_uuid, agent_names):
+    return (scenario_uuid, tuple(agent_names))
+
+def example_key(raw):
+    '''
+    Job key of a serialized example.
+    '''
+    agents = raw.get('agents') or {}
+    agent_names = (agents.get('0'), agents.get('1'))
+    return job_key(raw['scenario_uuid'], agent_names)
+
+def read_done_jobs(path):
+    '''
+    Count the jobs already in the JSONL file `path`.
+    A partially written last line (interrupted run) is ignored.
+    '''
+    done = Counter()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r') as fin:
+        for line in fin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                raw = json.loads(line)
+            except ValueError:
+                continue
+            done[example_key(raw)] += 1
+    return done
+
+def remove_done_jobs(jobs, done):
+    '''
+    Remove jobs in `done` (a Counter). Repeated jobs are matched by count.
+    '''
+    done = Counter(done)
+    todo = []
+    for job in jobs:
+        key = job_key(*job)
+        if done[key] > 0:
+            done[key] -= 1
+        else:
+            todo.append(job)
+    return todo
+
+def _run_worker(worker_id, jobs, load_systems, simulate, queue, random_seed):
+    if random_seed is not None:
+        random.seed(random_seed + worker_id)
+        np.random.seed(random_seed + worker_id)
+    try:
+        systems = load_systems()
+    except Exception:
+        traceback.print_exc()
+        for job in jobs:
+            queue.put((worker_id, job, None, False))
+        queue.put((worker_id, None, None, None))
+        return
+
+    for job in jobs:
+        try:
+            example, complete = simulate(systems, job)
+            queue.put((worker_id, job, example.to_dict(), complete))
+        except Exception:
+            traceback.print_exc()
+            queue.put((worker_id, job, None, False))
+    # Done
+    queue.put((worker_id, None, None, None))
+
+def generate_parallel(jobs, num_workers, load_systems, simulate, output_path,
+        remove_fail=False, random_seed=None):
+    '''
+    Run `jobs` on `num_workers` processes and append examples to `output_path`.
+
+    Args:
+        jobs (list[(str, tuple)]): (scenario_uuid, agent_names) pairs.
+        load_systems (callable): called once in each worker; returns the systems
+            passed to `simulate`.
+        simulate (callable): simulate(systems, job) -> (Example, complete).
+        remove_fail (bool): do not write incomplete dialogues.
+
+    Returns:
+        num_failed (dict): worker id -> number of failed dialogues
+            (incomplete or raised an exception).
+
+    '''
+    jobs = remove_done_jobs(jobs, read_done_jobs(output_path))
+    num_failed = defaultdict(int)
+    if not jobs:
+        return num_failed
+    num_workers = max(1, min(num_workers, len(jobs)))
+
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_run_worker,
+        args=(i, jobs[i::num_workers], load_systems, simulate, queue, random_seed))
+        for i in xrange(num_workers)]
+    for p in workers:
+        p.start()
+
+    num_finished = 0
+    with open(output_path, 'a') as out:
+        while num_finished < num_workers:
+            worker_id, job, example, complete = queue.get()
+            if job is None:
+                num_finished += 1
+                continue
+            if not complete:
+                num_failed[worker_id] += 1
+                if example is None or remove_fail:
+                    continue
+            out.write(json.dumps(example) + '\n')
+            out.flush()
+
+    for p in workers:
+        p.join()
+    return num_failed
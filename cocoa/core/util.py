@@ -1,8 +1,13 @@
+import os
 import random
+import hashlib
 import ujson as json
+import json as _json
 import string
 import cPickle as pickle
 import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
 
 def random_multinomial(probs):
     target = random.random()
@@ -20,6 +25,68 @@ def generate_uuid(prefix):
 def read_json(path):
     return json.load(open(path))
 
+_whitespace = ' \t\n\r'
+_delimiters = _whitespace + ',]'
+
+def iter_json(path, lines=None, buffer_size=1 << 16):
+    """Iterate over the items of a JSON array, or of a JSON Lines file (one
+    item per line, the default for *.jsonl), reading `path` incrementally so
+    that only the current item is held in memory.
+    """
+    if lines is None:
+        lines = path.endswith('.jsonl')
+    with open(path) as fin:
+        if lines:
+            for line in fin:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = _json.JSONDecoder()
+        buf = ''
+        pos = 0
+        eof = False
+        started = False
+        while True:
+            while pos < len(buf) and buf[pos] in _whitespace:
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise ValueError('Unterminated JSON array in {}'.format(path))
+                buf = fin.read(buffer_size)
+                pos = 0
+                eof = not buf
+                continue
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('{} is not a JSON array'.format(path))
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                break
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # A value in an array is followed by a delimiter, otherwise (e.g.
+                # a number at the end of the buffer) it may continue in the next read
+                complete = (end < len(buf) and buf[end] in _delimiters) or eof
+            except ValueError:
+                if eof:
+                    raise
+                complete = False
+            if not complete:
+                # Grow geometrically so that large items are decoded in linear time
+                data = fin.read(max(buffer_size, len(buf) - pos))
+                eof = not data
+                buf = buf[pos:] + data
+                pos = 0
+                continue
+            yield item
+            pos = end
+
 def write_json(raw, path):
     with open(path, 'w') as out:
         print >>out, json.dumps(raw)
@@ -28,9 +95,48 @@ def read_pickle(path):
     with open(path, 'rb') as fin:
         return pickle.load(fin)
 
-def write_pickle(obj, path):
+def write_pickle(obj, path, protocol=0):
     with open(path, 'wb') as fout:
-        pickle.dump(obj, fout)
+        pickle.dump(obj, fout, protocol)
+
+@contextmanager
+def atomic_open(path, mode='wb'):
+    """Open a temporary file that is renamed to `path` when closed without error,
+    so that readers (e.g. concurrent jobs sharing a cache) never see a partial file.
+    The directory of `path` is created if needed.
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Created by another process
+            if not os.path.isdir(dirname):
+                raise
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    try:
+        with open(tmp_path, mode) as fout:
+            yield fout
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def write_pickle_atomic(obj, path, protocol=pickle.HIGHEST_PROTOCOL):
+    with atomic_open(path, 'wb') as fout:
+        pickle.dump(obj, fout, protocol)
+
+def hash_json(obj):
+    """sha1 of the JSON of `obj`, e.g. to name a cache file by its inputs.
+    """
+    return hashlib.sha1(_json.dumps(obj)).hexdigest()
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
 
 def normalize(a):
     ma = np.max(a)
@@ -38,3 +144,34 @@ def normalize(a):
     assert ma > mi
     a = (a - mi) / (ma - mi)
     return a
+
+class LRUCache(object):
+    """A dict with at most `size` items; the least recently used item is evicted.
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def get(self, key, default=None):
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            return default
+        self.cache[key] = value
+        return value
+
+    def put(self, key, value):
+        if key in self.cache:
+            self.cache.pop(key)
+        elif len(self.cache) >= self.size:
+            self.cache.popitem(last=False)
+        self.cache[key] = value
+
+    def clear(self):
+        self.cache.clear()
@@ -1,13 +1,139 @@
+from collections import defaultdict, namedtuple
+from itertools import izip
+
 import numpy as np
 import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
 
 from cocoa.core.util import read_pickle, write_pickle
 from cocoa.model.counter import build_vocabulary, count_ngrams
-from cocoa.model.ngram import MLENgramModel
+from cocoa.model.ngram import CompactNgramModel
 
 from core.tokenizer import detokenize
 
+# Rows of templates in a partition and their TF-IDF vectors
+Partition = namedtuple('Partition', ['rows', 'tfidf_matrix'])
+
+class TemplateIndex(object):
+    """Templates partitioned by the values of their fields.
+
+    Each partition stores its rows and its TF-IDF sub-matrix. Retrieval then only
+    scores the templates of the selected partition instead of all templates.
+    """
+    def __init__(self, templates, tfidf_matrix):
+        self.templates = templates
+        self.tfidf_matrix = tfidf_matrix.tocsr()
+        self.num_templates = templates.shape[0]
+        self.id_to_row = {id_: row for row, id_ in enumerate(templates['id'].values)}
+        rows = np.arange(self.num_templates)
+        self.all = Partition(rows, self.tfidf_matrix)
+        self.empty = Partition(rows[:0], self.tfidf_matrix[rows[:0]])
+        # (field, ...) -> {(value, ...): Partition}
+        self.partitions = {}
+
+    def partition(self, fields):
+        partitions = self.partitions.get(fields)
+        if partitions is None:
+            groups = defaultdict(list)
+            columns = [self.templates[field].values for field in fields]
+            for row, values in enumerate(izip(*columns)):
+                groups[values].append(row)
+            partitions = {}
+            for values, rows in groups.iteritems():
+                rows = np.array(rows, dtype=np.int64)
+                partitions[values] = Partition(rows, self.tfidf_matrix[rows])
+            self.partitions[fields] = partitions
+        return partitions
+
+    def get_partition(self, constraints):
+        """Templates satisfying all (field, value) constraints.
+        """
+        if not constraints:
+            return self.all
+        fields, values = zip(*constraints)
+        return self.partition(fields).get(values, self.empty)
+
+    def used_mask(self, used_templates):
+        if isinstance(used_templates, UsedTemplates):
+            return used_templates.mask
+        mask = np.zeros(self.num_templates, dtype=np.bool_)
+        rows = [self.id_to_row[id_] for id_ in used_templates if id_ in self.id_to_row]
+        mask[rows] = True
+        return mask
+
+    def select(self, levels, used_templates=None, required=0):
+        """Select templates satisfying the most specific level of constraints.
+
+        `levels` is a list of (field, value) constraint lists, from the most
+        general to the most specific. Used templates are excluded unless all
+        templates are used. Return the partition and positions of the available
+        templates in it (None if all are available), or None if one of the first
+        `required` levels has no available template.
+        """
+        used = None
+        if used_templates:
+            used = self.used_mask(used_templates)
+            if used.all():
+                used = None
+        for i in xrange(len(levels) - 1, -1, -1):
+            partition = self.get_partition(levels[i])
+            if used is None:
+                if len(partition.rows) > 0:
+                    return partition, None
+            else:
+                available = np.flatnonzero(~used[partition.rows])
+                if len(available) > 0:
+                    return partition, available
+            if i < required:
+                return None
+        return self.all, None if used is None else np.flatnonzero(~used)
+
+    def search(self, features, selected, topk=20):
+        """Return rows of the `topk` selected templates whose contexts are most
+        similar to `features` (a TF-IDF vector), in descending order of similarity.
+        """
+        partition, available = selected
+        scores = (partition.tfidf_matrix * features.T).toarray().ravel()
+        rows = partition.rows
+        if available is not None:
+            scores = scores[available]
+            rows = rows[available]
+        return rows[self.topk(scores, topk)]
+
+    @classmethod
+    def topk(cls, scores, k):
+        """Indices of the `k` largest scores in descending order.
+        """
+        if k < len(scores):
+            ids = np.argpartition(-scores, k - 1)[:k]
+        else:
+            ids = np.arange(len(scores))
+        return ids[np.argsort(-scores[ids], kind='mergesort')]
+
+class UsedTemplates(object):
+    """Ids of templates used in a session, also kept as a bitmask over the rows
+    of a TemplateIndex.
+    """
+    def __init__(self, index):
+        self.id_to_row = index.id_to_row
+        self.mask = np.zeros(index.num_templates, dtype=np.bool_)
+        self.ids = set()
+
+    def add(self, id_):
+        self.ids.add(id_)
+        row = self.id_to_row.get(id_)
+        if row is not None:
+            self.mask[row] = True
+
+    def __contains__(self, id_):
+        return id_ in self.ids
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
 class Generator(object):
     def __init__(self, templates):
         self.templates = templates.templates
@@ -17,43 +143,33 @@ class Generator(object):
     def build_tfidf(self):
         documents = self.templates['context'].values
         self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+        self.index = TemplateIndex(self.templates, self.tfidf_matrix)
 
-    def _add_filter(self, locs, cond):
-        locs.append(locs[-1] & cond)
+    def new_used_templates(self):
+        return UsedTemplates(self.index)
 
-    def _select_filter(self, locs):
-        print [np.sum(loc) for loc in locs]
-        for loc in locs[::-1]:
-            if np.sum(loc) > 0:
-                return loc
-        return locs[0]
+    def _select_filter(self, used_templates, constraints, required=0):
+        """Filters are built by adding the (field, value) `constraints` one at a
+        time; select templates in the most specific filter that is not empty.
+        """
+        levels = [constraints[:i] for i in xrange(1, len(constraints) + 1)]
+        return self.index.select(levels, used_templates=used_templates, required=required)
 
-    def get_filter(self, used_templates=None):
-        if used_templates:
-            loc = (~self.templates.id.isin(used_templates))
-            if np.sum(loc) > 0:
-                return loc
-        # All templates
-        return self.templates.id.notnull()
+    def get_filter(self, used_templates=None, **kwargs):
+        return self._select_filter(used_templates, [])
 
     def retrieve(self, context, used_templates=None, topk=20, T=1., **kwargs):
-        loc = self.get_filter(used_templates=used_templates, **kwargs)
-        if loc is None:
+        selected = self.get_filter(used_templates=used_templates, **kwargs)
+        if selected is None:
             return None
 
         if isinstance(context, list):
             context = detokenize(context)
         features = self.vectorizer.transform([context])
-        scores = self.tfidf_matrix * features.T
-        scores = scores.todense()[loc]
-        scores = np.squeeze(np.array(scores), axis=1)
-        ids = np.argsort(scores)[::-1][:topk]
+        rows = self.index.search(features, selected, topk=topk)
 
-        candidates = self.templates[loc]
-        candidates = candidates.iloc[ids]
-        rows = self.templates[loc]
-        rows = rows.iloc[ids]
-        logp = rows['logp'].values
+        candidates = self.templates.iloc[rows]
+        logp = candidates['logp'].values
 
         return self.sample(logp, candidates, T)
 
@@ -97,8 +213,9 @@ class Templates(object):
         sequences = [s.split() for s in self.templates.template.values]
         vocab = build_vocabulary(1, *sequences)
         counter = count_ngrams(3, vocab, sequences, pad_left=True, pad_right=False)
-        model = MLENgramModel(counter)
-        scores = [-1.*model.entropy(s)*len(s) for s in sequences]
+        model = CompactNgramModel(counter)
+        lengths = np.array([len(s) for s in sequences])
+        scores = -1. * model.entropy_batch(sequences) * lengths
         if not 'logp' in self.templates.columns:
             self.templates.insert(0, 'logp', 0)
         self.templates['logp'] = scores
@@ -1,10 +1,16 @@
+import cPickle as pickle
+import numpy as np
+
 from cocoa.core.util import read_pickle, write_pickle
 from cocoa.model.counter import build_vocabulary, count_ngrams
-from cocoa.model.ngram import MLENgramModel
+from cocoa.model.ngram import MLENgramModel, CompactNgramModel
 from cocoa.model.util import entropy
 
 class Manager(object):
     def __init__(self, model, actions):
+        # Models saved before CompactNgramModel
+        if isinstance(model, MLENgramModel):
+            model = CompactNgramModel(model.ngram_counter)
         self.model = model
         self.actions = actions
 
@@ -12,7 +18,7 @@ class Manager(object):
     def from_train(cls, sequences, n=3):
         vocab = build_vocabulary(1, *sequences)
         counter = count_ngrams(n, vocab, sequences, pad_left=True, pad_right=False)
-        model = MLENgramModel(counter)
+        model = CompactNgramModel(counter)
         actions = vocab.keys()
         #print model.score('init-price', ('<start>',))
         #print model.ngrams.most_common(10)
@@ -39,13 +45,14 @@ class Manager(object):
     def choose_action(self, state, context=None):
         if not context:
             context = (state.my_act, state.partner_act)
-        freqdist = self.model.freqdist(context)
+        ids, counts = self.model.freqdist_ids(context)
         actions = self.available_actions(state)
-        freqdist = [x for x in freqdist if x[0] in actions]
+        available = np.in1d(ids, self.model.encode(actions))
         # TODO: backoff
-        if len(freqdist) == 0:
+        if not available.any():
             return None
-        best_action = max(freqdist, key=lambda x: x[1])[0]
+        ids, counts = ids[available], counts[available]
+        best_action = self.model.vocab[ids[np.argmax(counts)]]
         print 'context:', context
         #print 'dist:', freqdist
         print 'available actions:', actions
@@ -54,7 +61,7 @@ class Manager(object):
 
     def save(self, output):
         data = {'model': self.model, 'actions': self.actions}
-        write_pickle(data, output)
+        write_pickle(data, output, protocol=pickle.HIGHEST_PROTOCOL)
 
     @classmethod
     def from_pickle(cls, path):
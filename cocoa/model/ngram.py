@@ -7,8 +7,10 @@
 from __future__ import unicode_literals, division
 from math import log
 
+import numpy as np
+
 from nltk import compat
-from util import safe_div
+from util import safe_div, EPS
 
 
 NEG_INF = float("-inf")
@@ -134,6 +136,196 @@ class MLENgramModel(BaseNgramModel):
         return dist.items()
 
 
+@compat.python_2_unicode_compatible
+class CompactNgramModel(BaseNgramModel):
+    """MLE ngram model with integer-coded counts.
+
+    Words are mapped to integer ids and an ngram (w_1, ..., w_k) is coded as
+    the integer sum_i w_i * V^(k-i), where V is the vocabulary size. For each
+    order, ngram codes and context codes are stored in sorted numpy arrays with
+    their counts, so that lookups are binary searches. Scores are the same as
+    MLENgramModel, and the model does not keep the NgramCounter.
+    """
+
+    def __init__(self, ngram_counter):
+        self._order = ngram_counter.order
+        self.ngrams_kwargs = dict(ngram_counter.ngrams_kwargs)
+        vocabulary = ngram_counter.vocabulary
+        words = set(word for word in vocabulary if word in vocabulary)
+        words.add(ngram_counter.unk_label)
+        self.vocab = sorted(words)
+        self.unk_label = ngram_counter.unk_label
+        self.word_to_id = {word: i for i, word in enumerate(self.vocab)}
+        if len(self.vocab) ** self._order >= 2 ** 63:
+            raise ValueError("Vocabulary is too large for order {0}: {1}".format(self._order, len(self.vocab)))
+        key_dtype = np.int32 if len(self.vocab) ** self._order < 2 ** 31 else np.int64
+
+        # order -> sorted ngram codes and their counts
+        self.keys = {}
+        self.counts = {}
+        for order in range(1, self._order + 1):
+            ngrams = []
+            if order > 1:
+                for context, dist in ngram_counter.ngrams[order].items():
+                    context_key = self.encode_ngram(context)
+                    if context_key is None:
+                        continue
+                    for word, count in dist.items():
+                        if count > 0:
+                            ngrams.append((context_key * len(self.vocab) + self.word_to_id[word], count))
+            ngrams.sort()
+            self.keys[order] = np.array([k for k, _ in ngrams], dtype=key_dtype)
+            self.counts[order] = self._compact(np.array([c for _, c in ngrams], dtype=np.int64))
+        self._build_index()
+
+    @classmethod
+    def _compact(cls, a):
+        """Cast non-negative integers to the smallest dtype.
+        """
+        return a.astype(np.min_scalar_type(a.max() if len(a) > 0 else 0))
+
+    def _build_index(self):
+        """Build data derived from the vocabulary and ngram counts.
+        """
+        self.word_to_id = {word: i for i, word in enumerate(self.vocab)}
+        self.unk_id = self.word_to_id[self.unk_label]
+        # order -> sorted context codes and their total counts
+        self.context_keys = {}
+        self.context_counts = {}
+        for order, keys in self.keys.items():
+            context_keys = keys // len(self.vocab)
+            counts = self.counts[order].astype(np.int64)
+            if len(keys) > 0:
+                starts = np.flatnonzero(np.r_[True, context_keys[1:] != context_keys[:-1]])
+                context_keys = context_keys[starts]
+                counts = np.add.reduceat(counts, starts)
+            self.context_keys[order] = context_keys
+            self.context_counts[order] = self._compact(counts)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for k in ('word_to_id', 'unk_id', 'context_keys', 'context_counts'):
+            del state[k]
+        # Sorted keys are saved as differences, which are small
+        state['keys'] = {order: (keys.dtype, self._compact(np.diff(np.r_[0, keys])))
+                for order, keys in self.keys.items()}
+        return state
+
+    def __setstate__(self, state):
+        state['keys'] = {order: np.cumsum(diffs, dtype=dtype)
+                for order, (dtype, diffs) in state['keys'].items()}
+        self.__dict__.update(state)
+        self._build_index()
+
+    def _check_against_vocab(self, word):
+        return word if word in self.word_to_id else self.unk_label
+
+    def encode(self, words):
+        """Map words to ids; words not in the vocabulary are mapped to -1.
+        """
+        return np.array([self.word_to_id.get(word, -1) for word in words], dtype=np.int64)
+
+    def encode_ngram(self, ngram):
+        """Code of `ngram`, or None if it has words not in the vocabulary.
+        """
+        key = 0
+        for word in ngram:
+            i = self.word_to_id.get(word)
+            if i is None:
+                return None
+            key = key * len(self.vocab) + i
+        return key
+
+    @classmethod
+    def _lookup(cls, keys, values, queries):
+        """Values of `queries` in the sorted array `keys`, 0 if not found.
+        """
+        if len(keys) == 0:
+            return np.zeros(len(queries), dtype=values.dtype)
+        # Same dtype as keys to avoid copying them
+        ids = np.searchsorted(keys, queries.astype(keys.dtype))
+        ids[ids == len(keys)] = 0
+        return np.where(keys[ids] == queries, values[ids], 0)
+
+    def _scores(self, order, keys):
+        """MLE scores of ngrams of `order` given their codes.
+        """
+        counts = self._lookup(self.keys[order], self.counts[order], keys)
+        totals = self._lookup(self.context_keys[order], self.context_counts[order], keys // len(self.vocab))
+        return np.where(totals > 0, counts / np.maximum(totals, 1), 0.)
+
+    def score(self, word, context):
+        context = self.check_context(context)
+        key = self.encode_ngram(context + (word,))
+        if key is None:
+            return 0.
+        return float(self._scores(len(context) + 1, np.array([key], dtype=np.int64))[0])
+
+    def freqdist_ids(self, context):
+        """Ids and counts of words following `context`.
+        """
+        context = self.check_context(context)
+        order = len(context) + 1
+        keys = self.keys[order]
+        start = self.encode_ngram(context)
+        if start is None:
+            return keys[:0], self.counts[order][:0]
+        start *= len(self.vocab)
+        i, j = np.searchsorted(keys, np.array([start, start + len(self.vocab)], dtype=keys.dtype))
+        return keys[i:j] % len(self.vocab), self.counts[order][i:j]
+
+    def freqdist(self, context):
+        ids, counts = self.freqdist_ids(context)
+        return [(self.vocab[i], c) for i, c in zip(ids.tolist(), counts.tolist())]
+
+    def _pad(self, ids):
+        n = self._order
+        kwargs = self.ngrams_kwargs
+        if kwargs.get('pad_left'):
+            ids = [self.word_to_id[kwargs['left_pad_symbol']]] * (n - 1) + ids
+        if kwargs.get('pad_right'):
+            ids = ids + [self.word_to_id[kwargs['right_pad_symbol']]] * (n - 1)
+        return ids
+
+    def entropy_batch(self, texts, average=True):
+        """Vectorized `entropy` of each text in `texts`.
+
+        Return an array of entropies, or arrays of (negative) log probabilities
+        and the number of ngrams of each text if `average` is False.
+        """
+        n = self._order
+        V = len(self.vocab)
+        sequences = [self._pad([self.word_to_id.get(word, self.unk_id) for word in text]) for text in texts]
+        num_ngrams = np.array([max(0, len(s) - n + 1) for s in sequences], dtype=np.int64)
+        flat = np.array([i for s in sequences for i in s], dtype=np.int64)
+        # Start of each ngram in flat
+        seq_starts = np.cumsum([0] + [len(s) for s in sequences[:-1]]).astype(np.int64)
+        seq_index = np.repeat(np.arange(len(sequences)), num_ngrams)
+        positions = np.arange(num_ngrams.sum(), dtype=np.int64)
+        positions += np.repeat(seq_starts - np.r_[0, np.cumsum(num_ngrams)[:-1]], num_ngrams)
+        keys = np.zeros(len(positions), dtype=np.int64)
+        for i in range(n):
+            keys = keys * V + flat[positions + i]
+
+        scores = self._scores(n, keys)
+        with np.errstate(divide='ignore'):
+            logscores = np.log(scores) / log(2)
+        H = np.bincount(seq_index, weights=logscores, minlength=len(sequences))
+        if average:
+            return -1. * H / (num_ngrams + EPS)
+        else:
+            return -1. * H, num_ngrams
+
+    def entropy(self, text, average=True):
+        if average:
+            return float(self.entropy_batch([text])[0])
+        H, num_ngrams = self.entropy_batch([text], average=False)
+        return float(H[0]), int(num_ngrams[0])
+
+    def perplexity_batch(self, texts):
+        return np.power(2.0, self.entropy_batch(texts))
+
+
 @compat.python_2_unicode_compatible
 class LidstoneNgramModel(BaseNgramModel):
     """Provides Lidstone-smoothed scores.
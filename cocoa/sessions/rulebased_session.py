@@ -13,7 +13,7 @@ class RulebasedSession(Session):
         self.manager = manager
         self.state = state
         self.sample_temperature = sample_temperature
-        self.used_templates = set()
+        self.used_templates = generator.new_used_templates()
 
     def receive(self, event):
         utterance = self.parser.parse(event, self.state)
@@ -38,6 +38,26 @@ class Session(object):
         """
         raise NotImplementedError
 
+    def batch_key(self):
+        """Sessions with the same key can send together (see `send_batch`).
+        By default a session is only batched with itself.
+
+        """
+        return id(self)
+
+    @classmethod
+    def send_batch(cls, sessions):
+        """Send events from sessions sharing the same `batch_key`.
+
+        Args:
+            sessions (list[Session])
+
+        Returns:
+            events (list[Event]): one event (or None) per session.
+
+        """
+        return [session.send() for session in sessions]
+
     @staticmethod
     def remove_nonprintable(raw_tokens):
         tokens = []
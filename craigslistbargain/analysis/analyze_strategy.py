@@ -1,6 +1,7 @@
 import os
 import re
 import json
+import multiprocessing
 from collections import defaultdict
 from itertools import izip, ifilter
 from argparse import ArgumentParser
@@ -14,7 +15,7 @@ import pandas as pd
 import seaborn as sns
 sns.set()
 
-from cocoa.core.util import read_json, write_json
+from cocoa.core.util import read_json, write_json, read_pickle, write_pickle_atomic, hash_json, hash_file
 from cocoa.core.entity import Entity, is_entity
 
 from core.price_tracker import PriceTracker, PriceScaler
@@ -22,6 +23,7 @@ from core.tokenizer import tokenize
 from core.scenario import Scenario
 from analysis.html_visualizer import HTMLVisualizer
 from dialogue import Dialogue
+from features import FeatureTable
 from liwc import LIWC
 import utils
 import options
@@ -39,17 +41,65 @@ MAX_PRICE = 3
 def round_partial(value, resolution=0.1):
     return round (value / resolution) * resolution
 
+def label_dialogue(dialogue, labels, liwc):
+    if 'speech_act' in labels:
+        dialogue.extract_keywords()
+        dialogue.label_speech_acts()
+    if 'stage' in labels:
+        dialogue.label_stage()
+    if 'liwc' in labels:
+        dialogue.label_liwc(liwc)
+
+def build_dialogues(chats, labels, price_tracker, liwc):
+    """
+    :param chats: list of (raw chat, raw survey scores) or of Dialogue
+    :return: list of Dialogue labeled with `labels`
+    """
+    dialogues = []
+    for chat in chats:
+        if isinstance(chat, Dialogue):
+            dialogue = chat
+        else:
+            raw, raw_scores = chat
+            dialogue = Dialogue.from_dict(raw, raw_scores, price_tracker)
+        label_dialogue(dialogue, labels, liwc)
+        dialogues.append(dialogue)
+    return dialogues
+
+# (price_tracker, liwc) of a worker process, loaded once by _init_worker
+_worker_models = None
+
+def _init_worker(price_tracker_model, liwc_path):
+    global _worker_models
+    _worker_models = (PriceTracker(price_tracker_model), LIWC.from_pkl(liwc_path))
+
+def _build_dialogues_worker(args):
+    chats, labels = args
+    price_tracker, liwc = _worker_models
+    return build_dialogues(chats, labels, price_tracker, liwc)
+
 class StrategyAnalyzer(object):
     sent_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
 
-    def __init__(self, transcripts_paths, survey_paths, stats_path, price_tracker_model, liwc_path, max_examples=None):
+    # Bump when the labeling changes so that cached dialogues are rebuilt
+    version = 1
+
+    def __init__(self, transcripts_paths, survey_paths, stats_path, price_tracker_model, liwc_path, max_examples=None, num_workers=1, cache=None):
+        """
+        Dialogues are built (tokenized and linked) and labeled by `num_workers`
+        processes; labeled dialogues are cached in `cache` by a hash of the
+        input files and the labels (None to disable the cache). Feature tables
+        (see load_features) are cached in `cache` as well.
+        """
         transcripts = self._read_transcripts(transcripts_paths, max_examples)
         self.dataset = utils.filter_rejected_chats(transcripts)
 
-        dialogue_scores = self._read_surveys(survey_paths)
+        self.dialogue_scores = self._read_surveys(survey_paths)
 
+        self.price_tracker_model = price_tracker_model
         self.price_tracker = PriceTracker(price_tracker_model)
 
+        self.liwc_path = liwc_path
         self.liwc = LIWC.from_pkl(liwc_path)
 
         # group chats depending on whether the seller or the buyer wins
@@ -59,7 +109,119 @@ class StrategyAnalyzer(object):
         if not os.path.exists(self.stats_path):
             os.makedirs(self.stats_path)
 
-        self.examples = [Dialogue.from_dict(raw, dialogue_scores.get(raw['uuid'], {}), self.price_tracker) for raw in self.dataset]
+        self.num_workers = num_workers
+        self.cache = cache
+        self.model_hash = [hash_file(path) for path in (price_tracker_model, liwc_path)]
+        self.survey_hash = [hash_file(path) for path in survey_paths]
+        self.input_hash = json.dumps([self.version, max_examples] +
+                [hash_file(path) for path in transcripts_paths] + self.survey_hash + self.model_hash)
+
+        self.labels = set()
+        # Dialogues are loaded on first use, analyses of feature tables may not need them
+        self._examples = None
+        # frozenset of labels -> FeatureTable of self.dataset
+        self._features = {}
+
+    @property
+    def examples(self):
+        if self._examples is None:
+            self._examples = self.load_dialogues(self.labels)
+        return self._examples
+
+    @examples.setter
+    def examples(self, dialogues):
+        self._examples = dialogues
+
+    def _cache_path(self, labels):
+        if not self.cache:
+            return None
+        key = hash_json([self.input_hash, sorted(labels)])
+        return os.path.join(self.cache, 'dialogues_{}.pkl'.format(key))
+
+    def load_dialogues(self, labels, dialogues=None):
+        """
+        Build dialogues from self.dataset labeled with `labels`, or load them
+        from the cache. If `dialogues` (labeled with self.labels) are given,
+        only the new labels are computed.
+        """
+        cache_path = self._cache_path(labels)
+        if cache_path and os.path.exists(cache_path):
+            print 'Load dialogues from {}'.format(cache_path)
+            dialogues = read_pickle(cache_path)
+        else:
+            if dialogues is None:
+                chats = [(raw, self.dialogue_scores.get(raw['uuid'], {})) for raw in self.dataset]
+                dialogues = self._build_dialogues(chats, labels)
+            else:
+                dialogues = self._build_dialogues(dialogues, set(labels) - self.labels)
+            if cache_path:
+                print 'Dump dialogues to {}'.format(cache_path)
+                write_pickle_atomic(dialogues, cache_path)
+        # Scenario ids are assigned in order in this process
+        for dialogue in dialogues:
+            dialogue.scenario_id = Dialogue.get_scenario_id(dialogue.post_id, dialogue.buyer_target)
+        return dialogues
+
+    def _features_path(self, labels):
+        if not self.cache:
+            return None
+        # Chats are keyed by chat_id, so the table does not depend on the transcripts,
+        # but eval_* columns depend on the surveys (which may arrive later)
+        key = hash_json([self.version, sorted(labels)] + self.model_hash + self.survey_hash)
+        return os.path.join(self.cache, 'features_{}.npz'.format(key))
+
+    def load_features(self, labels=None):
+        """
+        Return the FeatureTable of self.dataset labeled with `labels`
+        (self.labels by default). The table of all chats seen so far is kept
+        in the cache, and only chats that are not in it are built, labeled
+        and appended.
+        """
+        labels = frozenset(self.labels if labels is None else labels)
+        if labels in self._features:
+            return self._features[labels]
+
+        path = self._features_path(labels)
+        if path and os.path.exists(path):
+            print 'Load features from {}'.format(path)
+            table = FeatureTable.load(path)
+        else:
+            table = FeatureTable()
+        known = table.chat_ids
+        raws = [raw for raw in self.dataset if raw['uuid'] not in known]
+        if raws:
+            if self._examples is not None and labels == self.labels:
+                examples = {d.chat_id: d for d in self._examples}
+                dialogues = [examples[raw['uuid']] for raw in raws]
+            else:
+                chats = [(raw, self.dialogue_scores.get(raw['uuid'], {})) for raw in raws]
+                dialogues = self._build_dialogues(chats, labels)
+            table.append(dialogues, raws)
+            if path:
+                print 'Add {} chats to {}'.format(len(raws), path)
+                table.save(path)
+
+        table = table.select([raw['uuid'] for raw in self.dataset])
+        # Scenario ids are assigned in order in this process
+        table.dialogues['scenario_id'] = [Dialogue.get_scenario_id(post_id, buyer_target)
+                for post_id, buyer_target in izip(table.dialogues.post_id, table.dialogues.buyer_target)]
+        self._features[labels] = table
+        return table
+
+    def _build_dialogues(self, chats, labels):
+        if self.num_workers <= 1 or len(chats) <= 1:
+            return build_dialogues(chats, labels, self.price_tracker, self.liwc)
+
+        shard_size = max(1, len(chats) / (self.num_workers * 4))
+        shards = [(chats[i:i+shard_size], labels) for i in xrange(0, len(chats), shard_size)]
+        pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker,
+                initargs=(self.price_tracker_model, self.liwc_path))
+        try:
+            results = pool.map(_build_dialogues_worker, shards, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return [dialogue for dialogues in results for dialogue in dialogues]
 
     def _read_transcripts(self, transcripts_paths, max_examples):
         transcripts = []
@@ -76,14 +238,13 @@ class StrategyAnalyzer(object):
         return dialogue_scores
 
     def label_dialogues(self, labels=('speech_act', 'stage', 'liwc')):
-        for dialogue in self.examples:
-            if 'speech_act' in labels:
-                dialogue.extract_keywords()
-                dialogue.label_speech_acts()
-            if 'stage' in labels:
-                dialogue.label_stage()
-            if 'liwc' in labels:
-                dialogue.label_liwc(self.liwc)
+        """
+        Label self.examples with `labels` (in addition to previous labels).
+        """
+        labels = self.labels.union(labels)
+        if labels != self.labels:
+            self.examples = self.load_dialogues(labels, self.examples)
+            self.labels = labels
 
     def summarize_tags(self):
         tags = defaultdict(lambda : defaultdict(int))
@@ -98,36 +259,20 @@ class StrategyAnalyzer(object):
                 print k, v
 
     def create_dataframe(self):
-        data = []
-        for dialogue in ifilter(lambda x: x.has_deal(), self.examples):
-            for turn in dialogue.turns:
-                for u in turn.iter_utterances():
-                    row = {
-                            'post_id': dialogue.post_id,
-                            'chat_id': dialogue.chat_id,
-                            'scenario_id': dialogue.scenario_id,
-                            'buyer_target': dialogue.buyer_target,
-                            'listing_price': dialogue.listing_price,
-                            'margin_seller': dialogue.margins['seller'],
-                            'margin_buyer': dialogue.margins['buyer'],
-                            'stage': u.stage,
-                            'role': turn.role,
-                            'num_tokens': u.num_tokens(),
-                            }
-                    for a in u.speech_acts:
-                        row['act_{}'.format(a[0].name)] = 1
-                    for cat, word_count in u.categories.iteritems():
-                        row['cat_{}'.format(cat)] = sum(word_count.values())
-                    for q in dialogue.eval_questions:
-                        for r in ('buyer', 'seller'):
-                            key = 'eval_{question}_{role}'.format(question=q, role=r)
-                            try:
-                                row[key] = dialogue.eval_scores[r][q]
-                            except KeyError:
-                                row[key] = -1
-                    data.append(row)
-        df = pd.DataFrame(data).fillna(0)
-        return df
+        """
+        Return a dataframe of utterances of chats with a deal, with the
+        features of their chat.
+        """
+        features = self.load_features()
+        dialogues = features.dialogues[features.dialogues.has_deal]
+        dialogue_columns = ['chat_id', 'post_id', 'scenario_id', 'buyer_target', 'listing_price', 'margin_seller', 'margin_buyer'] + \
+                [c for c in dialogues.columns if c.startswith('eval_')]
+        utterance_columns = ['chat_id', 'stage', 'role', 'num_tokens'] + \
+                [c for c in features.utterances.columns if c.startswith('act_') or c.startswith('cat_')]
+        df = features.utterances[utterance_columns].merge(dialogues[dialogue_columns], on='chat_id')
+        # Acts and categories that only occur in chats without a deal
+        df = df.drop(columns=[c for c in utterance_columns[4:] if not df[c].any()])
+        return df[sorted(df.columns)]
 
     def summarize_liwc(self, k=10):
         categories = defaultdict(lambda : defaultdict(int))
@@ -440,57 +585,34 @@ class StrategyAnalyzer(object):
         g.savefig(output)
 
     def group_outcomes_and_roles(self):
-        buyer_wins = []
-        seller_wins = []
-        ties = 0
-        total_chats = 0
-        for ex in self.dataset:
-            roles = {0: ex["scenario"]["kbs"][0]["personal"]["Role"],
-                     1: ex["scenario"]["kbs"][1]["personal"]["Role"]}
-            winner = utils.get_winner(ex)
-            if winner is None:
-                continue
-            total_chats += 1
-            if winner == -1:
-                buyer_wins.append(ex)
-                seller_wins.append(ex)
-                ties += 1
-            elif roles[winner] == utils.BUYER:
-                buyer_wins.append(ex)
-            elif roles[winner] == utils.SELLER:
-                seller_wins.append(ex)
-
-        print "# of ties: {:d}".format(ties)
-        print "Total chats with outcomes: {:d}".format(total_chats)
+        """
+        :return: dialogue features of chats won by the buyer and by the seller (ties are in both)
+        """
+        dialogues = self.load_features().dialogues
+        winner = dialogues.winner
+        winner_role = np.where(winner == 1, dialogues.role_1, dialogues.role_0)
+        ties = winner == -1
+        won = winner >= 0
+        buyer_wins = dialogues[ties | (won & (winner_role == utils.BUYER))]
+        seller_wins = dialogues[ties | (won & (winner_role == utils.SELLER))]
+
+        print "# of ties: {:d}".format(ties.sum())
+        print "Total chats with outcomes: {:d}".format(winner.notnull().sum())
         return buyer_wins, seller_wins
 
     def plot_length_vs_margin(self, out_name='turns_vs_margin.png'):
         labels = ['buyer wins', 'seller wins']
         plt.figure(figsize=(10, 6))
 
-        for (chats, lbl) in zip([self.buyer_wins, self.seller_wins], labels):
-            margins = defaultdict(list)
-            for ex in chats:
-                turns = utils.get_turns_per_agent(ex)
-                total_turns = turns[0] + turns[1]
-                margin = utils.get_margin(ex)
-                if margin > MAX_MARGIN or margin < 0.:
-                    continue
-
-                margins[total_turns].append(margin)
+        for (chats, lbl) in zip(self.group_outcomes_and_roles(), labels):
+            chats = chats[(chats.winner_margin >= 0.) & (chats.winner_margin <= MAX_MARGIN)]
+            margins = chats.winner_margin.groupby(chats.turns_0 + chats.turns_1)
+            counts = margins.count()
+            turns = counts.index[counts >= THRESHOLD]
+            means = margins.mean()[turns]
+            errors = margins.sem()[turns]
 
-            sorted_keys = list(sorted(margins.keys()))
-
-            turns = []
-            means = []
-            errors = []
-            for k in sorted_keys:
-                if len(margins[k]) >= THRESHOLD:
-                    turns.append(k)
-                    means.append(np.mean(margins[k]))
-                    errors.append(stats.sem(margins[k]))
-
-            plt.errorbar(turns, means, yerr=errors, label=lbl, fmt='--o')
+            plt.errorbar(list(turns), list(means), yerr=list(errors), label=lbl, fmt='--o')
 
         plt.legend()
         plt.xlabel('# of turns in dialogue')
@@ -500,15 +622,9 @@ class StrategyAnalyzer(object):
         plt.savefig(save_path)
 
     def plot_margin_histograms(self):
-        for (lbl, group) in zip(['buyer_wins', 'seller_wins'], [self.buyer_wins, self.seller_wins]):
-            margins = []
-            for ex in group:
-                winner = utils.get_winner(ex)
-                if winner is None:
-                    continue
-                margin = utils.get_margin(ex)
-                if 0 <= margin <= MAX_MARGIN:
-                    margins.append(margin)
+        for (lbl, group) in zip(['buyer_wins', 'seller_wins'], self.group_outcomes_and_roles()):
+            margins = group.winner_margin
+            margins = margins[(margins >= 0) & (margins <= MAX_MARGIN)].values
 
             b = np.linspace(0, MAX_MARGIN, num=int(MAX_MARGIN/0.2)+2)
             print b
@@ -525,14 +641,9 @@ class StrategyAnalyzer(object):
             plt.savefig(save_path)
 
     def plot_length_histograms(self):
-        lengths = []
-        for ex in self.dataset:
-            winner = utils.get_winner(ex)
-            if winner is None:
-                continue
-            turns = utils.get_turns_per_agent(ex)
-            total_turns = turns[0] + turns[1]
-            lengths.append(total_turns)
+        dialogues = self.load_features().dialogues
+        dialogues = dialogues[dialogues.winner.notnull()]
+        lengths = (dialogues.turns_0 + dialogues.turns_1).values
 
         hist, bins = np.histogram(lengths)
 
@@ -548,34 +659,27 @@ class StrategyAnalyzer(object):
 
     def plot_price_trends(self, top_n=10):
         labels = ['buyer_wins', 'seller_wins']
-        for (group, lbl) in zip([self.buyer_wins, self.seller_wins], labels):
+        prices = self.load_features().prices
+        # If the number is greater than the list price or significantly lower
+        # than the buyer's target it's probably not a price
+        prices = prices[(prices.norm_price >= 0.) & (prices.norm_price <= 2.)]
+        agent_trends = {key: group.norm_price.tolist() for key, group in prices.groupby(['chat_id', 'agent'], sort=False)}
+        for (group, lbl) in zip(self.group_outcomes_and_roles(), labels):
             plt.figure(figsize=(10, 6))
             trends = []
-            for chat in group:
-                winner = utils.get_winner(chat)
-                margin = utils.get_margin(chat)
-                if margin > 1.0 or margin < 0.:
-                    continue
-                if winner is None:
-                    continue
-
-                # print "Winner: Agent {:d}\tWin margin: {:.2f}".format(winner, margin)
-                if winner == -1 or winner == 0:
-                    trend = self.get_price_trend(self.price_tracker, chat, agent=0)
-                    if len(trend) > 1:
-                        trends.append((margin, chat, trend))
-                if winner == -1 or winner == 1:
-                    trend = self.get_price_trend(self.price_tracker, chat, agent=1)
-                    if len(trend) > 1:
-                        trends.append((margin, chat,  trend))
-
-                # print ""
+            group = group[(group.winner_margin >= 0.) & (group.winner_margin <= 1.0)]
+            for chat in group.itertuples():
+                for agent in (0, 1):
+                    if chat.winner == -1 or chat.winner == agent:
+                        trend = agent_trends.get((chat.chat_id, agent), [])
+                        if len(trend) > 1:
+                            trends.append((chat.winner_margin, chat, trend))
 
             sorted_trends = sorted(trends, key=lambda x:x[0], reverse=True)
             for (idx, (margin, chat, trend)) in enumerate(sorted_trends[:top_n]):
-                print '{:s}: Chat {:s}\tMargin: {:.2f}'.format(lbl, chat['uuid'], margin)
+                print '{:s}: Chat {:s}\tMargin: {:.2f}'.format(lbl, chat.chat_id, margin)
                 print 'Trend: ', trend
-                print chat['scenario']['kbs']
+                print 'Listing price: {}\tBuyer target: {}'.format(chat.listing_price, chat.buyer_target)
                 print ""
                 plt.plot(trend, label='Margin={:.2f}'.format(margin))
             plt.legend()
@@ -704,6 +808,8 @@ if __name__ == "__main__":
     parser.add_argument('--max-examples', type=int, default=100, help='Maximum number of examples to run')
     parser.add_argument('--html-visualize', action='store_true', help='Output html files')
     parser.add_argument('--mpld3-plugin', default=None, help='Javascript of the mpld3 plugin')
+    parser.add_argument('--num-workers', type=int, default=1, help='Number of processes to build and label dialogues')
+    parser.add_argument('--cache', default=None, help='Directory of labeled dialogues and feature tables cached by inputs and labels (no cache by default)')
     options.add_price_tracker_arguments(parser)
     HTMLVisualizer.add_html_visualizer_arguments(parser)
     args = parser.parse_args()
@@ -715,7 +821,7 @@ if __name__ == "__main__":
     surveys_path = [os.path.join(args.output_dir, 'transcripts', 'surveys.json')]
     stats_output = os.path.join(args.output_dir, 'stats')
 
-    analyzer = StrategyAnalyzer(transcripts_path, surveys_path, stats_output, args.price_tracker_model, 'data/liwc.pkl', args.max_examples)
+    analyzer = StrategyAnalyzer(transcripts_path, surveys_path, stats_output, args.price_tracker_model, 'data/liwc.pkl', args.max_examples, args.num_workers, args.cache)
     analyzer.create_dataframe()
 
     if args.html_visualize:
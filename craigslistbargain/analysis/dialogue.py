@@ -2,7 +2,7 @@ import math
 import json
 import re
 from collections import defaultdict
-from itertools import izip, ifilter
+from itertools import izip
 import nltk
 from nltk.corpus import stopwords
 from nltk import pos_tag
@@ -27,6 +27,9 @@ class DialogueStage(object):
     DISCUSS = 1
     CONCLUDE = 2
 
+def _word_counts():
+    return defaultdict(int)
+
 class Utterance(object):
     def __init__(self, raw_text, tokens, action='message'):
         self.text = raw_text
@@ -36,7 +39,8 @@ class Utterance(object):
         self.keywords = []
         self.speech_acts = []
         self.stage = -1
-        self.categories = defaultdict(lambda : defaultdict(int))
+        # Module-level default factory so that utterances can be pickled
+        self.categories = defaultdict(_word_counts)
 
         if self.action == 'message':
             self.prices = [token for token in self.tokens if is_entity(token)]
@@ -277,8 +281,8 @@ class Dialogue(object):
         for utterance in self.iter_utterances():
             if utterance.action == 'message':
                 tokens = self._treebank_to_liwc_token(utterance.tokens)
-                for token in ifilter(lambda x: not is_entity(x), tokens):
-                    cats = liwc.lookup(token)
+                tokens = [token for token in tokens if not is_entity(token)]
+                for token, cats in izip(tokens, liwc.lookup_batch(tokens)):
                     for cat in cats:
                         utterance.categories[cat][token] += 1
 
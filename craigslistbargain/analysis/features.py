@@ -0,0 +1,198 @@
+'''
+Columnar feature tables of labeled dialogues for analysis and plots.
+
+A FeatureTable has three pandas DataFrames keyed by chat_id:
+    dialogues: one row per chat (targets, outcome, winner, margins, turn counts, eval scores)
+    utterances: one row per utterance (turn, role, stage, length, act_* and cat_* counts)
+    prices: one row per price mention (agent, price and price normalized by the targets)
+Rows are computed once from Dialogue objects and their raw chats, saved as
+uncompressed numpy arrays (one per column) in a .npz file, and new chats are
+appended without recomputing the others.
+'''
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from cocoa.analysis.utils import get_turns_per_agent
+from cocoa.core.util import atomic_open
+
+from dialogue import Dialogue
+import utils
+
+class FeatureTable(object):
+    tables = ('dialogues', 'utterances', 'prices')
+
+    def __init__(self, dialogues=None, utterances=None, prices=None):
+        self.dialogues = dialogues if dialogues is not None else pd.DataFrame(columns=['chat_id'])
+        self.utterances = utterances if utterances is not None else pd.DataFrame(columns=['chat_id'])
+        self.prices = prices if prices is not None else pd.DataFrame(columns=['chat_id'])
+
+    def __len__(self):
+        return len(self.dialogues)
+
+    @property
+    def chat_ids(self):
+        return set(self.dialogues.chat_id)
+
+    @classmethod
+    def dialogue_row(cls, dialogue, raw):
+        roles = {agent: kb.facts['personal']['Role'] for agent, kb in enumerate(dialogue.kbs)}
+        turns = get_turns_per_agent(raw)
+        winner = utils.get_winner(raw)
+        has_deal = Dialogue.has_deal(dialogue.outcome)
+        row = {
+                'chat_id': dialogue.chat_id,
+                'post_id': dialogue.post_id,
+                'buyer_target': dialogue.buyer_target,
+                'listing_price': dialogue.listing_price,
+                'has_deal': has_deal,
+                'agreed': Dialogue.agreed_deal(dialogue.outcome),
+                'final_price': dialogue.outcome['offer']['price'] if has_deal else np.nan,
+                'margin_seller': dialogue.margins['seller'] if has_deal else np.nan,
+                'margin_buyer': dialogue.margins['buyer'] if has_deal else np.nan,
+                # utils.get_winner: NaN if no agreement, -1 if tie, otherwise winner agent
+                'winner': np.nan if winner is None else winner,
+                # Margin of the winner (utils.get_margin)
+                'winner_margin': utils.get_margin(raw) if winner is not None else -1.,
+                'role_0': roles[0],
+                'role_1': roles[1],
+                'turns_0': turns[0],
+                'turns_1': turns[1],
+                'num_turns': dialogue.num_turns(),
+                'num_tokens': dialogue.num_tokens(),
+                }
+        for q in dialogue.eval_questions:
+            for r in ('buyer', 'seller'):
+                key = 'eval_{question}_{role}'.format(question=q, role=r)
+                try:
+                    row[key] = dialogue.eval_scores[r][q]
+                except KeyError:
+                    row[key] = -1
+        return row
+
+    @classmethod
+    def utterance_rows(cls, dialogue):
+        rows = []
+        for i, turn in enumerate(dialogue.turns):
+            for u in turn.iter_utterances():
+                row = {
+                        'chat_id': dialogue.chat_id,
+                        'turn': i,
+                        'agent': turn.agent,
+                        'role': turn.role,
+                        'action': u.action,
+                        'stage': u.stage,
+                        'num_tokens': u.num_tokens(),
+                        'num_prices': len(u.prices),
+                        }
+                for a in u.speech_acts:
+                    row['act_{}'.format(a[0].name)] = 1
+                for cat, word_count in u.categories.iteritems():
+                    row['cat_{}'.format(cat)] = sum(word_count.values())
+                rows.append(row)
+        return rows
+
+    @classmethod
+    def price_rows(cls, dialogue):
+        seller_target = dialogue.listing_price
+        buyer_target = dialogue.buyer_target
+        rows = []
+        for i, turn in enumerate(dialogue.turns):
+            for price in turn.iter_prices():
+                price = float(price.canonical.value)
+                rows.append({
+                    'chat_id': dialogue.chat_id,
+                    'turn': i,
+                    'agent': turn.agent,
+                    'action': turn.action,
+                    'price': price,
+                    # 0 at the seller's target and 1 at the buyer's target
+                    'norm_price': (seller_target - price) / (seller_target - buyer_target),
+                    })
+        return rows
+
+    @classmethod
+    def _frame(cls, rows, columns):
+        df = pd.DataFrame(rows, columns=columns)
+        # Missing act_* and cat_* are zero counts
+        counts = [c for c in df.columns if c.startswith('act_') or c.startswith('cat_')]
+        if counts:
+            df[counts] = df[counts].fillna(0).astype(np.int64)
+            df = df[[c for c in df.columns if c not in counts] + sorted(counts)]
+        return df
+
+    def append(self, dialogues, raws):
+        '''
+        Add the rows of labeled `dialogues` whose chats are not in the table yet.
+        :param raws: raw chats of the dialogues
+        '''
+        old = self.chat_ids
+        rows = defaultdict(list)
+        for dialogue, raw in zip(dialogues, raws):
+            if dialogue.chat_id in old:
+                continue
+            old.add(dialogue.chat_id)
+            rows['dialogues'].append(self.dialogue_row(dialogue, raw))
+            rows['utterances'].extend(self.utterance_rows(dialogue))
+            rows['prices'].extend(self.price_rows(dialogue))
+        if not rows:
+            return 0
+        for name in self.tables:
+            df = getattr(self, name)
+            new = self._frame(rows[name], None if rows[name] else df.columns)
+            if len(df) > 0:
+                # act_* and cat_* seen only in new rows (or only in old rows) are zeros
+                new = pd.concat([df, new], ignore_index=True, sort=False)
+                new = self._frame(new, new.columns)
+            setattr(self, name, new)
+        return len(rows['dialogues'])
+
+    def select(self, chat_ids):
+        '''
+        Return a table of `chat_ids` (in that order).
+        '''
+        order = pd.Series(np.arange(len(chat_ids)), index=chat_ids)
+        tables = []
+        for name in self.tables:
+            df = getattr(self, name)
+            df = df[df.chat_id.isin(order.index)]
+            # Stable sort by the position of the chat
+            index = np.argsort(order[df.chat_id].values, kind='mergesort')
+            tables.append(df.iloc[index].reset_index(drop=True))
+        return FeatureTable(*tables)
+
+    @classmethod
+    def _frame_arrays(cls, name, df):
+        arrays = {}
+        for i, c in enumerate(df.columns):
+            values = df[c].values
+            if values.dtype == object:
+                values = values.astype(unicode)
+            arrays['{}_c{}'.format(name, i)] = values
+        arrays['{}_columns'.format(name)] = np.array(df.columns, dtype=unicode)
+        return arrays
+
+    @classmethod
+    def _load_frame(cls, name, arrays):
+        columns = [str(c) for c in arrays['{}_columns'.format(name)]]
+        return pd.DataFrame({c: arrays['{}_c{}'.format(name, i)] for i, c in enumerate(columns)}, columns=columns)
+
+    def save(self, path):
+        '''
+        Write the tables to the .npz file `path` (see atomic_open).
+        '''
+        arrays = {}
+        for name in self.tables:
+            arrays.update(self._frame_arrays(name, getattr(self, name)))
+        # np.savez would append .npz to a file name
+        with atomic_open(path) as fout:
+            np.savez(fout, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        try:
+            return cls(*[cls._load_frame(name, arrays) for name in cls.tables])
+        finally:
+            arrays.close()
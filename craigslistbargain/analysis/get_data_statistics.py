@@ -1,13 +1,18 @@
 __author__ = 'anushabala'
 
 from argparse import ArgumentParser
-from cocoa.core.negotiation.tokenizer import tokenize
+from itertools import islice
 import json
 import os
 from scipy import stats as scipy_stats
+
+from cocoa.core.util import iter_json, read_json
+from cocoa.analysis.statistics import Statistic, compute_statistics
+from cocoa.analysis.utils import get_turns_per_agent, get_total_tokens_per_agent, get_avg_time_taken
+
+from core.tokenizer import tokenize
 import tf_idf
 import ngram
-import utils
 
 
 def get_dialogue_tokens(transcript):
@@ -29,13 +34,26 @@ def get_normalized_overlap(description, observed_tokens):
     return mentions / len(observed_tokens)
 
 
-def description_overlap(transcript):
-    all_desc_tokens = [set(tokenize(s)) for s in transcript["scenario"]["kbs"][0]["item"]["Description"]]
+def get_description_tokens(scenario):
     description = set()
-    for s in all_desc_tokens:
-        description.update(s)
-
-    description.update(set(tokenize(transcript["scenario"]["kbs"][0]["item"]["Title"])))
+    for s in scenario["kbs"][0]["item"]["Description"]:
+        description.update(tokenize(s))
+    description.update(tokenize(scenario["kbs"][0]["item"]["Title"]))
+    return description
+
+
+def description_overlap(transcript, descriptions=None):
+    """
+    :param descriptions: dict from scenario uuid to description tokens, filled as
+        scenarios are seen (scenarios are shared by many transcripts)
+    """
+    scenario = transcript["scenario"]
+    if descriptions is None:
+        description = get_description_tokens(scenario)
+    else:
+        description = descriptions.get(scenario["uuid"])
+        if description is None:
+            description = descriptions[scenario["uuid"]] = get_description_tokens(scenario)
     agent_tokens = get_dialogue_tokens(transcript)
 
     overlap = {0: get_normalized_overlap(description, agent_tokens[0]),
@@ -44,93 +62,125 @@ def description_overlap(transcript):
     return overlap
 
 
-def compute_avg_description_overlap(transcripts, surveyed_chats):
-    num_agents = 0
-    total_overlap = 0.
-    for t in transcripts:
-        if t["uuid"] not in surveyed_chats:
-            continue
-
-        overlap = description_overlap(t)
-        total_overlap += overlap[0] + overlap[1]
-        num_agents += 2
-
-    return total_overlap / num_agents
-
-
-def get_overlap_correlation(transcripts, surveys, questions=("persuasive", "negotiator")):
-    avg_overlaps = []
-    ratings = dict((q, []) for q in questions)
-    for t in transcripts:
-        cid = t["uuid"]
-        overlap = description_overlap(t)
-        if cid not in surveys.keys():
-            continue
-        chat_survey = surveys[cid]
-        if "0" in chat_survey.keys() and len(chat_survey["0"].keys()) > 0:
-            avg_overlaps.append(overlap[0])
-            for q in questions:
-                ratings[q].append(chat_survey["0"][q])
-        if "1" in chat_survey.keys() and len(chat_survey["1"].keys()) > 0:
-            avg_overlaps.append(overlap[1])
-            for q in questions:
-                ratings[q].append(chat_survey["1"][q])
-
-    correlations = dict((q, scipy_stats.pearsonr(avg_overlaps, ratings[q])) for q in questions)
-
-    return correlations
-
-
-def compute.core.statistics(transcripts, stats, surveyed_chats):
-    total_turns = {"total": 0.}
-    total_tokens = {"total": 0.}
-    total_chats = {"total": 0.}
-    total_time = {"total": 0.}
-    for t in transcripts:
-        if t["uuid"] not in surveyed_chats:
-            continue
-        turns = utils.get_turns_per_agent(t)
-        tokens = utils.get_total_tokens_per_agent(t)
-        time = utils.get_avg_time_taken(t)
-
-        # Note: this check is redundant now because we already filter for chats that have surveys, and only chats
-        # that are complete / partial can be submitted with surveys. This check is just here to be compatible with
-        # previous batches where the interface allowed submissions of incomplete/partial chats
-        # 06/01/2017 -- disabled this check because the rejection criteria have changed - by default just look at all chats with surveys
-        # if reject_transcript(t):
-        #     continue
-
-        scenario = t["scenario"]
-        category = scenario["category"]
-        agent_types = t["agents"]
-        agent = "human"
-        if agent_types["0"] != agent:
-            agent = agent_types["0"]
-        elif agent_types["1"] != agent:
-            agent = agent_types["1"]
-
-        name = "{:s}_{:s}".format(agent, category)
-        if name not in total_turns:
-            total_turns[name] = 0.
-            total_chats[name] = 0.
-            total_tokens[name] = 0.
-            total_time[name] = 0.
-
-        total_chats["total"] += 1
-        total_turns["total"] += turns[0] + turns[1]
-        total_tokens["total"] += tokens[0] + tokens[1]
-        total_time["total"] += time
-
-        total_chats[name] += 1
-        total_turns[name] += turns[0] + turns[1]
-        total_tokens[name] += tokens[0] + tokens[1]
-        total_time[name] += time
-
-    for key in total_chats.keys():
-        stats["turns"][key] = total_turns[key] / total_chats[key]
-        stats["tokens"][key] = total_tokens[key] / (total_chats[key] * 2)
-        stats["num_completed"][key] = total_chats[key]
-        stats["time"][key] = total_time[key] / total_chats[key]
+def get_group(transcript):
+    agent_types = transcript["agents"]
+    agent = "human"
+    if agent_types["0"] != agent:
+        agent = agent_types["0"]
+    elif agent_types["1"] != agent:
+        agent = agent_types["1"]
+    return "{:s}_{:s}".format(agent, transcript["scenario"]["category"])
+
+
+class ChatStatistic(Statistic):
+    """
+    Average of a value of surveyed chats, in total and by agent type and category.
+    """
+    def __init__(self, surveyed_chats):
+        self.surveyed_chats = set(surveyed_chats)
+        super(ChatStatistic, self).__init__()
+
+    def value(self, transcript):
+        raise NotImplementedError
+
+    def update(self, transcript):
+        # Note: we only look at chats that have surveys; only chats that are complete / partial can be
+        # submitted with surveys.
+        # 06/01/2017 -- the rejection criteria have changed - by default just look at all chats with surveys
+        if transcript["uuid"] not in self.surveyed_chats:
+            return
+        value = self.value(transcript)
+        self.add("total", value)
+        self.add(get_group(transcript), value)
+
+
+class NumTurns(ChatStatistic):
+    name = "turns"
+
+    def value(self, transcript):
+        turns = get_turns_per_agent(transcript)
+        return turns[0] + turns[1]
+
+
+class NumTokens(ChatStatistic):
+    """Number of tokens per agent."""
+    name = "tokens"
+
+    def value(self, transcript):
+        tokens = get_total_tokens_per_agent(transcript)
+        return (tokens[0] + tokens[1]) / 2.
+
+
+class TimeTaken(ChatStatistic):
+    name = "time"
+
+    def value(self, transcript):
+        return get_avg_time_taken(transcript)
+
+
+class NumCompleted(ChatStatistic):
+    name = "num_completed"
+
+    def value(self, transcript):
+        return 1
+
+    def result(self):
+        return {key: float(summary.count) for key, summary in self.summaries.iteritems()}
+
+
+class DescriptionOverlap(Statistic):
+    """Average overlap between the messages of an agent and the item description."""
+    name = "avg_description_overlap"
+
+    def __init__(self, surveyed_chats):
+        self.surveyed_chats = set(surveyed_chats)
+        self.descriptions = {}
+        super(DescriptionOverlap, self).__init__()
+
+    def update(self, transcript):
+        if transcript["uuid"] not in self.surveyed_chats:
+            return
+        overlap = description_overlap(transcript, self.descriptions)
+        self.add("total", overlap[0])
+        self.add("total", overlap[1])
+
+    def result(self):
+        return self.summaries["total"].mean
+
+
+class OverlapCorrelation(Statistic):
+    """Pearson correlation between description overlap and survey ratings of agents."""
+    name = "overlap_correlation"
+
+    def __init__(self, surveys, questions=("persuasive", "negotiator")):
+        self.surveys = surveys
+        self.questions = questions
+        self.descriptions = {}
+        super(OverlapCorrelation, self).__init__()
+
+    def reset(self):
+        self.overlaps = []
+        self.ratings = dict((q, []) for q in self.questions)
+
+    def update(self, transcript):
+        cid = transcript["uuid"]
+        if cid not in self.surveys:
+            return
+        overlap = description_overlap(transcript, self.descriptions)
+        chat_survey = self.surveys[cid]
+        for agent in (0, 1):
+            if str(agent) in chat_survey and len(chat_survey[str(agent)]) > 0:
+                self.overlaps.append(overlap[agent])
+                for q in self.questions:
+                    self.ratings[q].append(chat_survey[str(agent)][q])
+
+    def merge(self, other):
+        self.overlaps.extend(other.overlaps)
+        for q in self.questions:
+            self.ratings[q].extend(other.ratings[q])
+
+    def result(self):
+        return dict((q, scipy_stats.pearsonr(self.overlaps, self.ratings[q])) for q in self.questions)
 
 
 def pretty_print_stats(stats, label):
@@ -139,28 +189,27 @@ def pretty_print_stats(stats, label):
         print "\t{key: <20}: {val:2.3f}".format(key=key, val=stats[key])
 
 
-def get_statistics(transcripts, survey_data, questions=("persuasive", "negotiator")):
+def get_statistics(transcripts, survey_data, questions=("persuasive", "negotiator"), num_workers=1, overlap=False):
+    """
+    Compute all statistics in one pass over `transcripts` (an iterable, e.g. from iter_json).
+    """
     surveyed_chats = survey_data[0].keys()
     surveys = survey_data[1]
 
     stats_out_path = os.path.join(stats_output, "stats.json")
     statsfile = open(stats_out_path, 'w')
-    stats = {
-        "avg_description_overlap": {},
-        "turns": {},
-        "tokens": {},
-        "num_completed": {},
-        "time": {}
-    }
-    # stats["avg_description_overlap"] = avg_overlap = compute_avg_description_overlap(transcripts, surveyed_chats)
-    compute.core.statistics(transcripts, stats, surveyed_chats)
-
-    # print "Avg. description overlap: %2.4f" % avg_overlap
-
-    # corr = get_overlap_correlation(transcripts, surveys, questions)
-    # print "Correlations between ratings and persuasivness:"
-    # for q in questions:
-    #     print "%s" % q, corr[q]
+    statistics = [NumTurns(surveyed_chats), NumTokens(surveyed_chats), NumCompleted(surveyed_chats), TimeTaken(surveyed_chats)]
+    if overlap:
+        statistics.extend([DescriptionOverlap(surveyed_chats), OverlapCorrelation(surveys, questions)])
+    stats = {"avg_description_overlap": {}}
+    stats.update(compute_statistics(statistics, transcripts, num_workers=num_workers))
+
+    if overlap:
+        print "Avg. description overlap: %2.4f" % stats["avg_description_overlap"]
+        corr = stats["overlap_correlation"]
+        print "Correlations between ratings and persuasivness:"
+        for q in questions:
+            print "%s" % q, corr[q]
 
     json.dump(stats, statsfile)
 
@@ -226,22 +275,31 @@ if __name__ == "__main__":
     parser.add_argument('--limit', type=int, default=-1, help='Analyze the first N transcripts')
     parser.add_argument('--tf-idf', action='store_true', help='Whether to perform tf-idf analysis or not')
     parser.add_argument('--ngram', action='store_true', help='Whether to perform ngram analysis or not')
+    parser.add_argument('--description-overlap', action='store_true', help='Compute the overlap between messages and item descriptions')
+    parser.add_argument('--num-workers', type=int, default=1, help='Number of processes to compute statistics')
     args = parser.parse_args()
     out_dir = args.output_dir
     if not os.path.exists(out_dir):
         raise ValueError("Output directory {:s} doesn't exist".format(out_dir))
 
-    transcripts = json.load(open(os.path.join(out_dir, "transcripts", "transcripts.json"), 'r'))
+    transcripts_path = os.path.join(out_dir, "transcripts", "transcripts.json")
+    # Transcripts are streamed; only the tf-idf and ngram analyses load all of them
+    transcripts = iter_json(transcripts_path)
     if args.limit > 0:
-        transcripts = transcripts[:args.limit]
-    survey_data = json.load(open(os.path.join(out_dir, "transcripts", "surveys.json"), 'r'))
+        transcripts = islice(transcripts, args.limit)
+    survey_data = read_json(os.path.join(out_dir, "transcripts", "surveys.json"))
 
     stats_output = os.path.join(out_dir, "stats")
     print stats_output
     if not os.path.exists(stats_output):
         os.makedirs(stats_output)
 
-    get_statistics(transcripts, survey_data)
+    get_statistics(transcripts, survey_data, num_workers=args.num_workers, overlap=args.description_overlap)
+
+    if args.tf_idf or args.ngram:
+        transcripts = read_json(transcripts_path)
+        if args.limit > 0:
+            transcripts = transcripts[:args.limit]
 
     if args.tf_idf:
         # tf_idf_by_category(transcripts)
@@ -0,0 +1,136 @@
+'''
+LIWC lexicon: maps words to psycholinguistic categories.
+
+Entries are words ("happy") or prefixes with a wildcard ("happ*"). A word gets
+the categories of its exact entry if there is one, otherwise those of the
+longest wildcard entry that is a prefix of it. The lexicon is compiled into a
+character trie whose nodes store the categories of the exact and wildcard
+entries ending there as bitsets, so a lookup is a single walk down the word.
+`lookup_scan` is the direct implementation over all entries, kept as the
+reference (see scripts/benchmark_liwc.py).
+'''
+import re
+from collections import defaultdict
+
+from cocoa.core.util import read_pickle, write_pickle
+
+class TrieNode(object):
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        self.children = {}
+        # Bitsets of categories of "word" and "word*" entries ending at this
+        # node (None if there is no such entry)
+        self.exact = None
+        self.prefix = None
+
+class LIWC(object):
+    # Number of looked up words memoized
+    cache_size = 100000
+
+    def __init__(self, lexicon):
+        '''
+        :param lexicon: dict from entry ("word" or "prefix*") to a list of categories
+        '''
+        self.lexicon = lexicon
+        self.categories = sorted(set(c for cats in lexicon.itervalues() for c in cats))
+        self.category_bit = {c: 1 << i for i, c in enumerate(self.categories)}
+        self.root = self._build_trie(lexicon)
+        # bitset -> tuple of categories
+        self._bitset_categories = {0: ()}
+        # word -> tuple of categories
+        self._cache = {}
+
+    def _build_trie(self, lexicon):
+        root = TrieNode()
+        for entry, cats in lexicon.iteritems():
+            wildcard = entry.endswith('*')
+            if wildcard:
+                entry = entry[:-1]
+            node = root
+            for char in entry:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = TrieNode()
+                node = child
+            bitset = 0
+            for c in cats:
+                bitset |= self.category_bit[c]
+            if wildcard:
+                node.prefix = (node.prefix or 0) | bitset
+            else:
+                node.exact = (node.exact or 0) | bitset
+        return root
+
+    @classmethod
+    def from_pkl(cls, path):
+        return cls(read_pickle(path))
+
+    def to_pkl(self, path):
+        write_pickle(self.lexicon, path)
+
+    @classmethod
+    def from_dic(cls, path):
+        '''
+        Read a dictionary in the LIWC .dic format: a header of category ids and
+        names between two "%" lines, followed by lines of an entry and its category ids.
+        '''
+        names = {}
+        lexicon = defaultdict(list)
+        with open(path, 'r') as fin:
+            sections = re.split(r'^%\s*$', fin.read(), flags=re.M)
+        for line in sections[1].strip().split('\n'):
+            id_, name = line.split()[:2]
+            names[id_] = name
+        for line in sections[2].strip().split('\n'):
+            fields = line.split()
+            if fields:
+                lexicon[fields[0]].extend(names[id_] for id_ in fields[1:] if id_ in names)
+        return cls(dict(lexicon))
+
+    def lookup_bitset(self, word):
+        node = self.root
+        # Longest wildcard entry matched so far
+        prefix = node.prefix or 0
+        for char in word:
+            node = node.children.get(char)
+            if node is None:
+                return prefix
+            if node.prefix is not None:
+                prefix = node.prefix
+        return prefix if node.exact is None else node.exact
+
+    def _categories(self, bitset):
+        cats = self._bitset_categories.get(bitset)
+        if cats is None:
+            cats = tuple(c for c in self.categories if bitset & self.category_bit[c])
+            self._bitset_categories[bitset] = cats
+        return cats
+
+    def lookup(self, word):
+        '''
+        :return: tuple of categories of `word`
+        '''
+        cats = self._cache.get(word)
+        if cats is None:
+            cats = self._categories(self.lookup_bitset(word))
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[word] = cats
+        return cats
+
+    def lookup_batch(self, words):
+        return [self.lookup(word) for word in words]
+
+    def lookup_scan(self, word):
+        '''
+        Reference lookup scanning all entries.
+        '''
+        if word in self.lexicon:
+            return tuple(sorted(set(self.lexicon[word])))
+        best = None
+        for entry, cats in self.lexicon.iteritems():
+            if entry.endswith('*') and word.startswith(entry[:-1]):
+                if best is None or len(entry) > len(best[0]):
+                    best = (entry, cats)
+        return tuple(sorted(set(best[1]))) if best else ()
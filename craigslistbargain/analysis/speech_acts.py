@@ -1,6 +1,8 @@
 from collections import namedtuple
 import re
 
+import numpy as np
+
 SpeechAct = namedtuple('SpeechAct', ['name', 'abrv'])
 
 class SpeechActs(object):
@@ -20,6 +22,26 @@ class SpeechActs(object):
     #ACT = [GEN_QUESTION, PRICE_QUESTION, GEN_STATEMENT, PRICE_STATEMENT, GREETING, AGREEMENT, PERSON, COND, POS, NEG, REPEAT_PRICE, COUNTER_ARGUMENT]
 
 
+def compile_any(patterns, flags=0):
+    """Compile a list of patterns into one alternation.
+    """
+    return re.compile('|'.join('(?:{})'.format(p) for p in patterns), flags)
+
+def compile_named(pattern_sets, flags=0):
+    """Compile sets of patterns into one regex to be matched at the start of a
+    text. Each set is (name, patterns, search): group `name` is not None iff
+    one of the patterns matches, anywhere in the text if `search` is True
+    (as re.search), otherwise at the start (as re.match). Each set is an
+    optional lookahead, so a single match reports all sets.
+    """
+    parts = []
+    for name, patterns, search in pattern_sets:
+        prefix = r'[\s\S]*?' if search else ''
+        parts.append(r'(?:(?={}(?P<{}>{}))|)'.format(
+            prefix, name, '|'.join('(?:{})'.format(p) for p in patterns)))
+    return re.compile(''.join(parts), flags)
+
+
 class SpeechActAnalyzer(object):
     agreement_patterns = [
         r'^that works[.!]*$',
@@ -71,6 +93,75 @@ class SpeechActAnalyzer(object):
 
     person_words = set(['husband', 'wife', 'son', 'daughter', 'grandma', 'grandmother', 'grandpa', 'grandfarther', 'kid', 'mom', 'dad', 'mother', 'father', 'uncle', 'aunt', 'friend', 'she', 'he', 'brother', 'sister'])
 
+    # Pattern sets compiled once
+    price_re = compile_any(price_patterns)
+    pos_re = compile_any(pos_patterns, re.IGNORECASE)
+    neg_re = compile_any(neg_patterns, re.IGNORECASE)
+    agreement_re = compile_any(agreement_patterns, re.IGNORECASE)
+    side_offer_re = compile_any(side_offer_patterns, re.IGNORECASE)
+    greeting_re = compile_any(greeting_patterns, re.IGNORECASE)
+
+    # All pattern sets, for classify. Price patterns are case-sensitive and the
+    # others are not, which needs two regexes (no scoped flags in Python 2).
+    acts_re = (
+            compile_named([('vague_price', price_patterns, True)]),
+            compile_named([
+                ('agreement', agreement_patterns, False),
+                ('positive', pos_patterns, False),
+                ('negative', neg_patterns, False),
+                ('side_offer', side_offer_patterns, True),
+                ('greeting', greeting_patterns, True),
+                ], re.IGNORECASE),
+            )
+
+    # Labels returned by classify
+    acts = ('question', 'price', 'vague_price', 'agreement', 'positive', 'negative', 'side_offer', 'greeting', 'person')
+
+    @classmethod
+    def classify(cls, utterance):
+        """Return the set of labels in `cls.acts` of the utterance in one pass
+        over its text and tokens. 'price' means that the utterance mentions
+        prices, 'vague_price' that it talks about prices (is_price) and
+        'positive'/'negative' follow sentiment.
+        """
+        labels = set()
+        for regex in cls.acts_re:
+            for name, match in regex.match(utterance.text).groupdict().iteritems():
+                if match is not None:
+                    labels.add(name)
+        if 'positive' in labels:
+            labels.discard('negative')
+        if cls.is_question(utterance):
+            labels.add('question')
+        if utterance.prices:
+            labels.add('price')
+        tokens = utterance.tokens
+        if not cls.greeting_words.isdisjoint(tokens):
+            labels.add('greeting')
+        if not cls.person_words.isdisjoint(tokens):
+            labels.add('person')
+        return labels
+
+    @classmethod
+    def classify_batch(cls, utterances):
+        """Classify utterances of a corpus.
+        :return: bool array of size len(utterances) x len(cls.acts)
+        """
+        index = {act: i for i, act in enumerate(cls.acts)}
+        # Texts repeat a lot in dialogue corpora ("deal", "hi", ...)
+        cache = {}
+        rows, cols = [], []
+        for i, utterance in enumerate(utterances):
+            key = (utterance.text, tuple(utterance.tokens), len(utterance.prices) > 0)
+            acts = cache.get(key)
+            if acts is None:
+                acts = cache[key] = [index[act] for act in cls.classify(utterance)]
+            rows.extend([i] * len(acts))
+            cols.extend(acts)
+        labels = np.zeros((len(utterances), len(cls.acts)), dtype=bool)
+        labels[rows, cols] = True
+        return labels
+
     @classmethod
     def is_question(cls, utterance):
         tokens = utterance.tokens
@@ -82,10 +173,7 @@ class SpeechActAnalyzer(object):
 
     @classmethod
     def is_price(cls, utterance):
-        for pattern in cls.price_patterns:
-            if re.search(pattern, utterance.text):
-                return True
-        return False
+        return cls.price_re.search(utterance.text) is not None
 
     @classmethod
     def has_person(cls, utterance):
@@ -103,12 +191,10 @@ class SpeechActAnalyzer(object):
 
     @classmethod
     def sentiment(cls, utterance):
-        for pattern in cls.pos_patterns:
-            if re.match(pattern, utterance.text, re.IGNORECASE) is not None:
-                return 1
-        for pattern in cls.neg_patterns:
-            if re.match(pattern, utterance.text, re.IGNORECASE) is not None:
-                return -1
+        if cls.pos_re.match(utterance.text) is not None:
+            return 1
+        if cls.neg_re.match(utterance.text) is not None:
+            return -1
         return 0
 
         for token in utterance.tokens:
@@ -120,17 +206,11 @@ class SpeechActAnalyzer(object):
 
     @classmethod
     def is_agreement(cls, utterance):
-        for pattern in cls.agreement_patterns:
-            if re.match(pattern, utterance.text, re.IGNORECASE) is not None:
-                return True
-        return False
+        return cls.agreement_re.match(utterance.text) is not None
 
     @classmethod
     def has_side_offer(cls, utterance):
-        for pattern in cls.side_offer_patterns:
-            if re.search(pattern, utterance.text, re.IGNORECASE):
-                return True
-        return False
+        return cls.side_offer_re.search(utterance.text) is not None
 
     @classmethod
     def has_price(cls, utterance):
@@ -141,10 +221,7 @@ class SpeechActAnalyzer(object):
         for token in utterance.tokens:
             if token in cls.greeting_words:
                 return True
-        for pattern in cls.greeting_patterns:
-            if re.search(pattern, utterance.text, re.IGNORECASE):
-                return True
-        return False
+        return cls.greeting_re.search(utterance.text) is not None
 
     @classmethod
     def get_speech_acts(cls, utterance, prev_turn=None):
@@ -153,13 +230,15 @@ class SpeechActAnalyzer(object):
             acts.append((SpeechAct(utterance.action, utterance.action), None))
             return acts
 
-        if cls.is_question(utterance):
+        labels = cls.classify(utterance)
+
+        if 'question' in labels:
             acts.append((SpeechActs.QUESTION, None))
 
-        if cls.has_price(utterance):
+        if 'price' in labels:
             acts.append((SpeechActs.PRICE, None))
 
-        if cls.has_side_offer(utterance):
+        if 'side_offer' in labels:
             acts.append((SpeechActs.SIDE_OFFER, None))
         #else:
         #    sentiment = cls.sentiment(text, linked_tokens)
@@ -171,10 +250,10 @@ class SpeechActAnalyzer(object):
         #if cls.is_agreement(text):
         #    acts.append(SpeechActs.AGREEMENT)
 
-        if cls.is_greeting(utterance):
+        if 'greeting' in labels:
             acts.append((SpeechActs.GREETING, None))
 
-        if cls.has_person(utterance):
+        if 'person' in labels:
             acts.append((SpeechActs.PERSON, None))
 
         #if cls.condition(linked_tokens):
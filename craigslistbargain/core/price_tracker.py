@@ -1,13 +1,16 @@
 import math
 import re
-from collections import defaultdict
-from itertools import chain
+import weakref
+from collections import defaultdict, namedtuple
+from itertools import chain, izip
 
 from cocoa.core.entity import Entity, CanonicalEntity
 from cocoa.core.util import read_json, write_pickle, read_pickle
 
 from tokenizer import tokenize
 
+_price_chars_re = re.compile(r'[\$\,]')
+_non_number_chars_re = re.compile(r'[^\w0-9\.,]')
 
 class PriceScaler(object):
     @classmethod
@@ -69,9 +72,21 @@ class PriceScaler(object):
         p = cls._scale_price(kb, p)
         return price._replace(canonical=price.canonical._replace(value=p))
 
+# KB data used to link prices, see PriceTracker.kb_info
+KBInfo = namedtuple('KBInfo', ['numbers', 'list_price', 'scale_parameters'])
+
+def has_dollar(token):
+    return token[0] == '$' or token[-1] == '$'
+
 class PriceTracker(object):
+    # Maximum number of parsed tokens kept by parse_number
+    number_cache_size = 100000
+
     def __init__(self, model_path):
         self.model = read_pickle(model_path)
+        # KB -> KBInfo. KBs are assumed not to change once linked against.
+        self.kb_cache = weakref.WeakKeyDictionary()
+        self.number_cache = {}
 
     @classmethod
     def get_price(cls, token):
@@ -85,7 +100,7 @@ class PriceTracker(object):
 
     @classmethod
     def process_string(cls, token):
-        token = re.sub(r'[\$\,]', '', token)
+        token = _price_chars_re.sub('', token)
         try:
             if token.endswith('k'):
                 token = str(float(token.replace('k', '')) * 1000)
@@ -93,34 +108,81 @@ class PriceTracker(object):
             pass
         return token
 
+    def parse_number(self, token):
+        """Return float(process_string(token)), or None if it is not a number.
+        """
+        try:
+            return self.number_cache[token]
+        except KeyError:
+            pass
+        try:
+            number = float(self.process_string(token))
+        except ValueError:
+            number = None
+        if len(self.number_cache) >= self.number_cache_size:
+            self.number_cache.clear()
+        self.number_cache[token] = number
+        return number
+
     def is_price(self, left_context, right_context):
         if left_context in self.model['left'] and right_context in self.model['right']:
             return True
         else:
             return False
 
-    def get_kb_numbers(self, kb):
-        title = tokenize(re.sub(r'[^\w0-9\.,]', ' ', kb.facts['item']['Title']))
-        description = tokenize(re.sub(r'[^\w0-9\.,]', ' ', ' '.join(kb.facts['item']['Description'])))
+    def _get_kb_numbers(self, kb):
+        title = tokenize(_non_number_chars_re.sub(' ', kb.facts['item']['Title']))
+        description = tokenize(_non_number_chars_re.sub(' ', ' '.join(kb.facts['item']['Description'])))
         numbers = set()
         for token in chain(title, description):
-            try:
-                numbers.add(float(self.process_string(token)))
-            except ValueError:
-                continue
+            number = self.parse_number(token)
+            if number is not None:
+                numbers.add(number)
         return numbers
 
+    def kb_info(self, kb):
+        """KB data used by link_entity, computed once per KB.
+        """
+        info = self.kb_cache.get(kb)
+        if info is None:
+            # Errors (e.g. t == b) are raised by PriceScaler if a price needs scaling
+            try:
+                b, t = PriceScaler.get_price_range(kb)
+                scale_parameters = PriceScaler.get_parameters(b, t)
+            except Exception:
+                scale_parameters = None
+            info = KBInfo(frozenset(self._get_kb_numbers(kb)), kb.facts['item']['Price'], scale_parameters)
+            self.kb_cache[kb] = info
+        return info
+
+    def get_kb_numbers(self, kb):
+        return self.kb_info(kb).numbers
+
+    @classmethod
+    def _scale_price(cls, kb, kb_info, p):
+        """Same as PriceScaler._scale_price with the cached parameters.
+        """
+        if kb_info is None or kb_info.scale_parameters is None:
+            return PriceScaler._scale_price(kb, p)
+        w, c = kb_info.scale_parameters
+        p = w * p + c
+        # Discretize to two digits
+        p = float('{:.2f}'.format(p))
+        return p
+
     def link_entity(self, raw_tokens, kb=None, scale=True, price_clip=None):
         tokens = ['<s>'] + raw_tokens + ['</s>']
         entity_tokens = []
         if kb:
-            kb_numbers = self.get_kb_numbers(kb)
-            list_price = kb.facts['item']['Price']
+            kb_info = self.kb_info(kb)
+            kb_numbers = kb_info.numbers
+            list_price = kb_info.list_price
+        else:
+            kb_info = None
         for i in xrange(1, len(tokens)-1):
             token = tokens[i]
-            try:
-                number = float(self.process_string(token))
-                has_dollar = lambda token: token[0] == '$' or token[-1] == '$'
+            number = self.parse_number(token)
+            if number is not None:
                 # Check context
                 if not has_dollar(token) and \
                         not self.is_price(tokens[i-1], tokens[i+1]):
@@ -137,23 +199,37 @@ class PriceTracker(object):
                         if number != list_price and number in kb_numbers:
                             number = None
                     if number is not None and price_clip is not None:
-                        scaled_price = PriceScaler._scale_price(kb, number)
+                        scaled_price = self._scale_price(kb, kb_info, number)
                         if abs(scaled_price) > price_clip:
                             number = None
-            except ValueError:
-                number = None
             if number is None:
                 new_token = token
             else:
                 assert not math.isnan(number)
                 if scale:
-                    scaled_price = PriceScaler._scale_price(kb, number)
+                    scaled_price = self._scale_price(kb, kb_info, number)
                 else:
                     scaled_price = number
                 new_token = Entity(surface=token, canonical=CanonicalEntity(value=scaled_price, type='price'))
             entity_tokens.append(new_token)
         return entity_tokens
 
+    def link_entities(self, token_lists, kbs=None, scale=True, price_clip=None):
+        """Link prices in a batch of utterances.
+
+        Args:
+            token_lists (list[list[str]])
+            kbs (list[KB]): KB of each utterance (or None).
+
+        Returns:
+            list[list]: output of `link_entity` for each utterance.
+
+        """
+        if kbs is None:
+            kbs = [None] * len(token_lists)
+        return [self.link_entity(tokens, kb=kb, scale=scale, price_clip=price_clip)
+                for tokens, kb in izip(token_lists, kbs)]
+
     @classmethod
     def train(cls, examples, output_path=None):
         '''
@@ -1,11 +1,24 @@
-import nltk
-nltk.download('punkt')
-from nltk.tokenize import word_tokenize
+# -*- coding: utf-8 -*-
+'''
+Tokenizer for negotiation dialogues.
+
+`tokenize` memoizes one of two tokenizers (see get_backend):
+    nltk: `tokenize_nltk`, the original tokenizer based on nltk.word_tokenize,
+        used when the NLTK punkt model is installed (it is never downloaded here).
+    regex: `tokenize_regex` reproduces nltk.word_tokenize (Punkt sentence splitting
+        followed by the Treebank word tokenizer) with precompiled regular expressions
+        and without loading NLTK. Treebank rules are local to space-separated chunks,
+        so each chunk is tokenized once and cached; Punkt is approximated by a rule
+        deciding whether a chunk ending with a period ends a sentence.
+scripts/benchmark_tokenizer.py reports where the two differ on transcripts.
+'''
 import re
 import string
 
+from cocoa.core.util import LRUCache
+
 def is_number(s):
-    if re.match(r'[.,0-9]+', s):
+    if _number_re.match(s):
         return True
     else:
         return False
@@ -53,17 +66,204 @@ def stick_marker_sign(tokens):
             in_brackets = False
     return new_tokens
 
+_number_re = re.compile(r'[.,0-9]+')
+# NLTK would not tokenize "xx..", so normalize dots to "...".
+_dots_re = re.compile(r'\.{2,}')
+# Remove some weird chars
+_weird_chars_re = re.compile(r'\\|>|/')
+
+# Rules of the Treebank tokenizer used by nltk.word_tokenize, in order.
+_starting_quotes = [
+        (re.compile(u'([«“‘„]|[`]+)', re.U), r' \1 '),
+        (re.compile(r'^\"'), r'``'),
+        (re.compile(r'(``)'), r' \1 '),
+        (re.compile(r"([ \(\[{<])(\"|\'{2})"), r'\1 `` '),
+        (re.compile(r"(?i)(\')(?!re|ve|ll|m|t|s|d)(\w)\b", re.U), r'\1 \2'),
+        ]
+_final_period = (re.compile(r'([^\.])(\.)([\]\)}>"\'' u'»”’ ' r']*)\s*$', re.U), r'\1 \2 \3 ')
+_punctuation = [
+        (re.compile(r'([:,])([^\d])'), r' \1 \2'),
+        (re.compile(r'([:,])$'), r' \1 '),
+        (re.compile(r'\.\.\.'), r' ... '),
+        (re.compile(r'[;@#$%&]'), r' \g<0> '),
+        (re.compile(r'([^\.])(\.)([\]\)}>"\']*)\s*$'), r'\1 \2\3 '),
+        (re.compile(r'[?!]'), r' \g<0> '),
+        (re.compile(r"([^'])' "), r"\1 ' "),
+        (re.compile(r'[\]\[\(\)\{\}\<\>]'), r' \g<0> '),
+        (re.compile(r'--'), r' -- '),
+        ]
+_ending_quotes = [
+        (re.compile(u'([»”’])', re.U), r' \1 '),
+        (re.compile(r'"'), " '' "),
+        (re.compile(r'(\S)(\'\')'), r'\1 \2 '),
+        (re.compile(r"([^' ])('[sS]|'[mM]|'[dD]|') "), r"\1 \2 "),
+        (re.compile(r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) "), r"\1 \2 "),
+        ]
+_contractions = [re.compile(p) for p in (
+        r"(?i)\b(can)(?#X)(not)\b",
+        r"(?i)\b(d)(?#X)('ye)\b",
+        r"(?i)\b(gim)(?#X)(me)\b",
+        r"(?i)\b(gon)(?#X)(na)\b",
+        r"(?i)\b(got)(?#X)(ta)\b",
+        r"(?i)\b(lem)(?#X)(me)\b",
+        r"(?i)\b(mor)(?#X)('n)\b",
+        r"(?i)\b(wan)(?#X)(na)\s",
+        r"(?i) ('t)(?#X)(is)\b",
+        r"(?i) ('t)(?#X)(was)\b",
+        )]
+
+def _treebank_tokenize(text, sentence_final):
+    for regexp, substitution in _starting_quotes:
+        text = regexp.sub(substitution, text)
+    if sentence_final:
+        regexp, substitution = _final_period
+        text = regexp.sub(substitution, text)
+    for regexp, substitution in _punctuation:
+        text = regexp.sub(substitution, text)
+    text = ' ' + text + ' '
+    for regexp, substitution in _ending_quotes:
+        text = regexp.sub(substitution, text)
+    for regexp in _contractions:
+        text = regexp.sub(r' \1 \2 ', text)
+    return text.split()
+
+# Chunk that is not the last of its sentence: the sentinel stands for the following
+# chunks so that end-of-sentence rules do not apply.
+_sentinel = ' X'
+
+# (chunk, sentence_initial, sentence_final) -> tokens
+_chunk_cache = LRUCache(100000)
+
+def _tokenize_chunk(chunk, sentence_initial, sentence_final):
+    key = (chunk, sentence_initial, sentence_final)
+    tokens = _chunk_cache.get(key)
+    if tokens is None:
+        # Start-of-sentence rules only apply to the first chunk
+        text = chunk if sentence_initial else ' ' + chunk
+        if sentence_final:
+            tokens = _treebank_tokenize(text, True)
+        else:
+            tokens = _treebank_tokenize(text + _sentinel, False)[:-1]
+        _chunk_cache.put(key, tokens)
+    return tokens
+
+# Approximation of the Punkt sentence tokenizer (english.pickle) on lowercased chat:
+# a token ending with a period ends the sentence unless it is an abbreviation, or
+# it is a number or an initial followed by a lowercase word.
+abbreviations = set(['mr', 'mrs', 'ms', 'dr', 'jr', 'sr', 'st', 'vs', 'etc', 'e.g', 'i.e',
+    'a.m', 'p.m', 'u.s', 'inc', 'ltd', 'co', 'corp', 'approx', 'appt', 'apt',
+    'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec'])
+_punkt_token_re = re.compile(r'[\(\"\`{\[:;&\#\*@\)}\]\-,]*(\S*)$')
+_punkt_number_re = re.compile(r'^-?[\.,]?\d[\d,\.-]*\.?$')
+_punkt_initial_re = re.compile(r'[^\W\d]\.$', re.U)
+
+def _ends_sentence(chunk, next_chunk):
+    if not chunk.endswith('.'):
+        return False
+    token = _punkt_token_re.search(chunk).group(1)
+    type_ = token[:-1].lower()
+    if type_ in abbreviations or ('-' in type_ and type_.split('-')[-1] in abbreviations):
+        return False
+    if (_punkt_number_re.match(token) or _punkt_initial_re.match(token)) and next_chunk[0].islower():
+        return False
+    return True
+
+# Closing quotes and brackets allowed after the final period of a sentence
+_closing_re = re.compile(u'[\\]\\)}>"\'»”’]+$', re.U)
+
+def _is_closing(chunk):
+    # A quote after a space is an opening quote (``)
+    return _closing_re.match(chunk) and not (chunk.startswith('"') or chunk.startswith("''"))
+
+def _word_tokenize(utterance):
+    chunks = utterance.split(' ')
+    chunks = [chunk for chunk in chunks if chunk]
+    n = len(chunks)
+    sentence_ends = [i == n - 1 or _ends_sentence(chunks[i], chunks[i+1]) for i in xrange(n)]
+    # The final period rule applies to the last chunk of a sentence, and also
+    # reaches back over trailing chunks of closing quotes/brackets.
+    sentence_final = list(sentence_ends)
+    for i in xrange(n - 2, -1, -1):
+        if not sentence_ends[i] and sentence_final[i+1] and _is_closing(chunks[i+1]):
+            sentence_final[i] = True
+    tokens = []
+    sentence_initial = True
+    for i, chunk in enumerate(chunks):
+        tokens.extend(_tokenize_chunk(chunk, sentence_initial, sentence_final[i]))
+        sentence_initial = sentence_ends[i]
+    return tokens
+
+def tokenize_regex(utterance, lowercase=True):
+    '''
+    Regex tokenizer approximating tokenize_nltk without NLTK.
+    '''
+    if lowercase:
+        utterance = utterance.lower()
+    utterance = _dots_re.sub('...', utterance)
+    utterance = _weird_chars_re.sub(' ', utterance)
+    tokens = _word_tokenize(utterance)
+    #tokens = stick_marker_sign(tokens)
+    tokens = stick_dollar_sign(tokens)
+    return tokens
+
+# (utterance, lowercase) -> tokens
+_cache = LRUCache(100000)
+
+# 'nltk' or 'regex', see get_backend
+_backend = None
+
+def get_backend():
+    '''
+    Tokenizer used by tokenize: 'nltk' if the punkt model is installed, otherwise
+    'regex' (decided on the first call, unless set by set_backend).
+    '''
+    global _backend
+    if _backend is None:
+        try:
+            import nltk.data
+            nltk.data.find('tokenizers/punkt/english.pickle')
+            _backend = 'nltk'
+        except (ImportError, LookupError):
+            _backend = 'regex'
+    return _backend
+
+def set_backend(backend):
+    '''
+    :param backend: 'nltk', 'regex' or None (choose on the next call)
+    '''
+    global _backend
+    assert backend in ('nltk', 'regex', None)
+    _backend = backend
+    _cache.clear()
+
 def tokenize(utterance, lowercase=True):
     '''
     'hi there!' => ['hi', 'there', '!']
     '''
+    key = (utterance, lowercase)
+    tokens = _cache.get(key)
+    if tokens is None:
+        if get_backend() == 'nltk':
+            tokens = tokenize_nltk(utterance, lowercase)
+        else:
+            tokens = tokenize_regex(utterance, lowercase)
+        _cache.put(key, tokens)
+    # Callers may modify the list
+    return list(tokens)
+
+def tokenize_batch(utterances, lowercase=True):
+    return [tokenize(utterance, lowercase) for utterance in utterances]
+
+def tokenize_nltk(utterance, lowercase=True):
+    '''
+    Original tokenizer based on nltk.word_tokenize (requires the punkt model).
+    '''
+    from nltk.tokenize import word_tokenize
     #utterance = utterance.encode('utf-8')
     if lowercase:
         utterance = utterance.lower()
-    # NLTK would not tokenize "xx..", so normalize dots to "...".
-    utterance = re.sub(r'\.{2,}', '...', utterance)
-    # Remove some weird chars
-    utterance = re.sub(r'\\|>|/', ' ', utterance)
+    utterance = _dots_re.sub('...', utterance)
+    utterance = _weird_chars_re.sub(' ', utterance)
     tokens = word_tokenize(utterance)
     #tokens = stick_marker_sign(tokens)
     tokens = stick_dollar_sign(tokens)
@@ -84,4 +284,3 @@ def detokenize(tokens):
 if __name__ == '__main__':
     print tokenize("i have 10,000$!..")
     print tokenize("i haven't $10,000")
-
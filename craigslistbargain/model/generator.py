@@ -4,15 +4,13 @@ from core.tokenizer import detokenize
 
 class Generator(BaseGenerator):
     def get_filter(self, used_templates=None, category=None, role=None, context_tag=None, tag=None, **kwargs):
-        locs = [super(Generator, self).get_filter(used_templates)]
         assert category and role
-        self._add_filter(locs, self.templates.role == role)
-        self._add_filter(locs, self.templates.category == category)
+        constraints = [('role', role), ('category', category)]
         if tag:
-            self._add_filter(locs, self.templates.tag == tag)
+            constraints.append(('tag', tag))
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
-        return self._select_filter(locs)
+            constraints.append(('context_tag', context_tag))
+        return self._select_filter(used_templates, constraints)
 
 class Templates(BaseTemplates):
     def ambiguous_template(self, template):
@@ -7,6 +7,7 @@ from sklearn.feature_extraction.text import TfidfVectorizer
 from cocoa.core.dataset import read_examples
 from cocoa.core.entity import is_entity
 from cocoa.core.util import read_pickle, write_json
+from cocoa.model.generator import TemplateIndex
 
 from core.scenario import Scenario
 from core.tokenizer import detokenize
@@ -29,18 +30,13 @@ class Templates(object):
         # TODO: context + response?
         documents = self.templates['context'].values
         self.tfidf_matrix = self.vectorizer.fit_transform(documents)
+        self.index = TemplateIndex(self.templates, self.tfidf_matrix)
 
     def search(self, context, category=None, role=None, context_tag=None, response_tag=None, used_templates=None, T=1.):
-        loc = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates).values
+        selected = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates)
         features = self.vectorizer.transform([context])
-        scores = self.tfidf_matrix * features.T
-
-        scores = scores.todense()[loc]
-        rows = self.templates[loc]
-
-        scores = np.squeeze(np.array(scores))
-        ids = np.argsort(scores)[::-1][:20]
-        rows = rows.iloc[ids]
+        rows = self.index.search(features, selected, topk=20)
+        rows = self.templates.iloc[rows]
         counts = rows['count'].values
         return self.sample(counts, rows, T=T)
 
@@ -55,28 +51,18 @@ class Templates(object):
         return template
 
     def get_filter(self, category=None, role=None, context_tag=None, response_tag=None, used_templates=None):
-        locs = []
-        loc = True
-        if used_templates:
-            loc = (~self.templates.id.isin(used_templates))
-            locs.append(loc)
         assert category and role
-        loc = loc & (self.templates.category == category) & (self.templates.role == role)
-        locs.append(loc)
+        levels = [[('category', category), ('role', role)]]
         if response_tag:
-            loc = loc & (self.templates.response_tag == response_tag)
-            locs.append(loc)
+            levels.append(levels[-1] + [('response_tag', response_tag)])
         if context_tag:
-            loc = loc & (self.templates.context_tag == context_tag)
-            locs.append(loc)
-        for loc in locs[::-1]:
-            if np.sum(loc) > 0:
-                return loc
-        return locs[0]
+            levels.append(levels[-1] + [('context_tag', context_tag)])
+        return self.index.select(levels, used_templates=used_templates)
 
     def choose(self, used_templates=None, category=None, role=None, context_tag=None, response_tag=None, T=1.):
-        loc = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates)
-        templates = self.templates[loc]
+        partition, available = self.get_filter(category=category, role=role, context_tag=context_tag, response_tag=response_tag, used_templates=used_templates)
+        rows = partition.rows if available is None else partition.rows[available]
+        templates = self.templates.iloc[rows]
         if len(templates) > 0:
             counts = templates['count'].values
             return self.sample(counts, templates, T)
@@ -122,16 +108,17 @@ class TemplateExtractor(object):
     def parse_utterance(cls, utterance):
         """Get speech acts of the utterance.
         """
+        labels = SpeechActAnalyzer.classify(utterance)
         acts = []
-        if SpeechActAnalyzer.is_question(utterance):
+        if 'question' in labels:
             acts.append('question')
-        if utterance.prices:
+        if 'price' in labels:
             acts.append('price')
-        if SpeechActAnalyzer.is_price(utterance):
+        if 'vague_price' in labels:
             acts.append('vague-price')
-        if SpeechActAnalyzer.is_agreement(utterance):
+        if 'agreement' in labels:
             acts.append('agree')
-        if SpeechActAnalyzer.is_greeting(utterance):
+        if 'greeting' in labels:
             acts.append('greet')
         return acts
 
@@ -0,0 +1,56 @@
+'''
+Compare the trie-based LIWC lookup (LIWC.lookup) with the reference lookup
+scanning all entries (LIWC.lookup_scan) on the tokens of transcripts: report
+tokens with different categories and the labeling throughput of each.
+'''
+import sys
+import time
+from argparse import ArgumentParser
+
+from cocoa.core.util import read_json
+
+from core.tokenizer import tokenize
+sys.path.append('analysis')
+from liwc import LIWC
+
+def read_tokens(paths, max_examples):
+    tokens = []
+    num_examples = 0
+    for path in paths:
+        for raw in read_json(path):
+            if max_examples >= 0 and num_examples >= max_examples:
+                break
+            num_examples += 1
+            for event in raw['events']:
+                if event['action'] == 'message' and event['data']:
+                    tokens.extend(tokenize(event['data']))
+    return tokens
+
+def timed(func, tokens):
+    start = time.time()
+    outputs = [func(token) for token in tokens]
+    return outputs, time.time() - start
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--transcripts', nargs='+', help='Path to JSON transcripts')
+    parser.add_argument('--liwc', help='Path to the LIWC lexicon (.pkl or .dic)')
+    parser.add_argument('--max-examples', default=-1, type=int)
+    args = parser.parse_args()
+
+    if args.liwc.endswith('.dic'):
+        liwc = LIWC.from_dic(args.liwc)
+    else:
+        liwc = LIWC.from_pkl(args.liwc)
+    tokens = read_tokens(args.transcripts, args.max_examples)
+    print '{} tokens, {} LIWC entries'.format(len(tokens), len(liwc.lexicon))
+
+    reference, scan_time = timed(liwc.lookup_scan, tokens)
+    # Without the memo cache
+    trie, trie_time = timed(lambda w: liwc._categories(liwc.lookup_bitset(w)), tokens)
+    _, cached_time = timed(liwc.lookup, tokens)
+
+    num_diff = sum(1 for ref, out in zip(reference, trie) if ref != out)
+    print 'different tokens: {}'.format(num_diff)
+    for name, t in (('scan', scan_time), ('trie', trie_time), ('trie (cached)', cached_time)):
+        print '{}: {:.2f}s, {:.0f} tokens/s'.format(name, t, len(tokens) / max(t, 1e-6))
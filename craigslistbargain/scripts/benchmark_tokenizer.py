@@ -0,0 +1,64 @@
+'''
+Divergence report of the regex tokenizer (core.tokenizer.tokenize_regex) against
+the NLTK-based tokenizer (tokenize_nltk) on transcripts: utterances with
+different outputs and the time taken by each tokenizer. Requires the NLTK punkt
+model. core.tokenizer.tokenize uses NLTK whenever punkt is installed.
+'''
+import time
+from argparse import ArgumentParser
+from collections import Counter
+
+from cocoa.core.util import read_json
+
+from core import tokenizer
+from core.tokenizer import tokenize_nltk, tokenize_regex
+
+def read_utterances(paths, max_examples):
+    utterances = []
+    num_examples = 0
+    for path in paths:
+        for raw in read_json(path):
+            if max_examples >= 0 and num_examples >= max_examples:
+                break
+            num_examples += 1
+            for event in raw['events']:
+                if event['action'] == 'message' and event['data']:
+                    utterances.append(event['data'])
+    return utterances
+
+def timed(func, utterances):
+    start = time.time()
+    outputs = [func(u) for u in utterances]
+    return outputs, time.time() - start
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--transcripts', nargs='+', help='Path to JSON transcripts')
+    parser.add_argument('--max-examples', default=-1, type=int)
+    parser.add_argument('--num-show', default=20, type=int, help='Number of divergent utterances to print')
+    args = parser.parse_args()
+
+    utterances = read_utterances(args.transcripts, args.max_examples)
+    print '{} utterances'.format(len(utterances))
+
+    reference, nltk_time = timed(tokenize_nltk, utterances)
+    # Filling the chunk cache
+    fast, fast_time = timed(tokenize_regex, utterances)
+    # With the utterance and chunk caches (second pass over the data)
+    tokenizer.set_backend('regex')
+    tokenizer.tokenize_batch(utterances)
+    _, cached_time = timed(tokenizer.tokenize, utterances)
+
+    diffs = Counter()
+    num_diff = 0
+    for utterance, ref, out in zip(utterances, reference, fast):
+        if ref != out:
+            num_diff += 1
+            diffs[(utterance, tuple(ref), tuple(out))] += 1
+
+    print 'divergent utterances: {} ({:.4f}%)'.format(num_diff, 100. * num_diff / max(1, len(utterances)))
+    for (utterance, ref, out), count in diffs.most_common(args.num_show):
+        print '{} x {!r}'.format(count, utterance)
+        print '  nltk: {}'.format(' | '.join(ref))
+        print '  fast: {}'.format(' | '.join(out))
+    print 'nltk: {:.2f}s, fast: {:.2f}s, fast (cached): {:.2f}s'.format(nltk_time, fast_time, cached_time)
@@ -12,6 +12,7 @@ from core.event import Event
 from session import Session
 from neural.preprocess import markers, Dialogue
 from neural.batcher import Batch
+from neural.generator import LFSampler
 
 class NeuralSession(Session):
     def __init__(self, agent, kb, env):
@@ -62,6 +63,9 @@ class NeuralSession(Session):
 
     def send(self):
         tokens = self.generate()
+        return self._tokens_to_event(tokens)
+
+    def _tokens_to_event(self, tokens):
         if tokens is None:
             return None
         self.dialogue.add_utterance(self.agent, list(tokens))
@@ -167,6 +171,89 @@ class PytorchNeuralSession(NeuralSession):
 
         return entity_tokens
 
+    def batch_key(self):
+        # Stateful models carry a decoder state per session and LFSampler
+        # only decodes one example at a time.
+        if self.stateful or isinstance(self.generator, LFSampler):
+            return super(PytorchNeuralSession, self).batch_key()
+        return (type(self), id(self.env))
+
+    @classmethod
+    def send_batch(cls, sessions):
+        if len(sessions) == 1:
+            return [sessions[0].send()]
+        tokens_batch = cls.generate_batch(sessions)
+        return [session._tokens_to_event(tokens) for session, tokens in izip(sessions, tokens_batch)]
+
+    @classmethod
+    def _pad_rows(cls, rows, pad):
+        max_len = max(len(row) for row in rows)
+        array = np.full([len(rows), max_len], pad, dtype=np.int32)
+        for i, row in enumerate(rows):
+            array[i, :len(row)] = row
+        return array
+
+    @classmethod
+    def _create_multi_batch(cls, sessions):
+        """Create one batch for `sessions` sharing the same env.
+        `context_data['session_ids']` maps (length-sorted) batch rows back to sessions.
+        """
+        env = sessions[0].env
+        batcher = env.dialogue_batcher
+        num_context = Dialogue.num_context
+
+        encoder_inputs, encoder_context, decoder_inputs, targets = [], [], [], []
+        for session in sessions:
+            session.convert_to_int()
+            encoder_turns = batcher._get_turn_batch_at([session.dialogue], Dialogue.ENC, None)
+            encoder_inputs.append(batcher.get_encoder_inputs(encoder_turns)[0])
+            encoder_context.append([turn[0] for turn in batcher.get_encoder_context(encoder_turns, num_context)])
+            decoder_inputs.append(session.get_decoder_inputs()[0])
+            targets.append(encoder_turns[0][0])
+
+        pad = batcher.pad
+        encoder_args = {
+                        'inputs': cls._pad_rows(encoder_inputs, pad),
+                        'context': [cls._pad_rows([c[i] for c in encoder_context], pad)
+                            for i in xrange(num_context)],
+                    }
+        decoder_args = {
+                        'inputs': cls._pad_rows(decoder_inputs, pad),
+                        'context': batcher.create_context_batch([s.dialogue for s in sessions], batcher.kb_pad),
+                        'targets': cls._pad_rows(targets, pad),
+                    }
+
+        context_data = {
+                'agents': [s.agent for s in sessions],
+                'kbs': [s.kb for s in sessions],
+                'session_ids': range(len(sessions)),
+                }
+
+        # Sort by length for the packed encoder
+        return Batch(encoder_args, decoder_args, context_data,
+                env.vocab, sort_by_length=True, num_context=num_context, cuda=env.cuda)
+
+    @classmethod
+    def generate_batch(cls, sessions):
+        """Generate the next utterance of each session in one model call.
+
+        Returns:
+            tokens_batch (list[list]): entity tokens aligned with `sessions`.
+
+        """
+        for session in sessions:
+            if len(session.dialogue.agents) == 0:
+                session.dialogue._add_utterance(1 - session.agent, [])
+        batch = cls._create_multi_batch(sessions)
+        output_data = sessions[0].generator.generate_batch(batch, gt_prefix=sessions[0].gt_prefix)
+
+        tokens_batch = [None] * len(sessions)
+        for i, session_id in enumerate(batch.context_data['session_ids']):
+            session = sessions[session_id]
+            predictions = output_data["predictions"][i][0]
+            tokens_batch[session_id] = session.builder.build_target_tokens(predictions, session.kb)
+        return tokens_batch
+
     def _is_valid(self, tokens):
         if not tokens:
             return False
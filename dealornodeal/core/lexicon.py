@@ -1,5 +1,7 @@
 import re
+from itertools import chain
 from cocoa.core.entity import Entity
+from cocoa.core.util import LRUCache
 
 class Lexicon(object):
     """Detect item and numbers in a list of tokens.
@@ -12,14 +14,31 @@ class Lexicon(object):
 
     word_to_num = {'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10}
 
+    # Number of other tokens whose linking result is cached
+    cache_size = 10000
+
     def __init__(self, items):
         self.items = items
+        # One alternative (capturing group) per item, tried in order. Like the
+        # per-item patterns it replaces, it matches a prefix of the token.
+        item_patterns = []
+        for item in items:
+            pattern = r'{}s?'.format(item)
+            if item == 'ball':
+                pattern += r'|(?:basket)?balls?'
+            item_patterns.append('({})'.format(pattern))
+        self.item_pattern = re.compile('|'.join(item_patterns))
+
+        # Common surface forms are linked once here; other tokens go through the LRU cache.
+        tokens = chain(items, [item + 's' for item in items], ['basketball', 'basketballs'],
+                self.word_to_num, [str(n) for n in xrange(11)])
+        self.token_to_entity = {token: self._link_token(token) for token in tokens}
+        self.cache = LRUCache(self.cache_size)
 
     def detect_item(self, token):
-        for item in self.items:
-            if re.match(r'{}s?'.format(item), token) or \
-                (item == 'ball' and re.match(r'(basket)?balls?', token)):
-                    return Entity.from_elements(surface=token, value=item, type='item')
+        m = self.item_pattern.match(token)
+        if m:
+            return Entity.from_elements(surface=token, value=self.items[m.lastindex - 1], type='item')
         return False
 
     def detect_number(self, token):
@@ -34,8 +53,32 @@ class Lexicon(object):
             return Entity.from_elements(surface=token, value=n, type='number')
         return False
 
+    def _link_token(self, token):
+        return self.detect_item(token) or self.detect_number(token) or token
+
+    def link_token(self, token):
+        entity = self.token_to_entity.get(token)
+        if entity is None:
+            entity = self.cache.get(token)
+            if entity is None:
+                entity = self._link_token(token)
+                self.cache.put(token, entity)
+        return entity
+
     def link_entity(self, tokens):
-        return [(self.detect_item(token) or self.detect_number(token) or token) for token in tokens]
+        return [self.link_token(token) for token in tokens]
+
+    def link_entities(self, token_lists):
+        """Link a batch of utterances, e.g. a whole corpus during preprocessing.
+
+        Args:
+            token_lists (list[list[str]])
+
+        Returns:
+            list[list]: output of `link_entity` for each list of tokens.
+
+        """
+        return [[self.link_token(token) for token in tokens] for tokens in token_lists]
 
 ############### TEST ###############
 if __name__ == '__main__':
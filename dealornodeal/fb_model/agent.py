@@ -249,59 +249,86 @@ class BatchedRolloutAgent(LstmRolloutAgent):
         self.eos = self.model.word_dict.get_idx('<eos>')
         self.eod = self.model.word_dict.get_idx('<selection>')
 
-    def _find(self, seq, tokens):
-        n = seq.size(0)
-        for i in range(n):
-            if seq[i] in tokens:
-                return i
-        return n
+    def _first_pos(self, mask):
+        """Index of the first True entry in each column of `mask`, or its length if none."""
+        return np.where(mask.any(0), mask.argmax(0), mask.shape[0])
+
+    def _choose_batch(self, words, lang_hs, lengths):
+        """Batched version of _choose(sample=False) over padded dialogues.
+
+        Returns the value of the most likely choice and its probability for each dialogue.
+        """
+        choices = self.domain.generate_choices(self.context)
+        logits = self.model.generate_choice_logits_batch(words, lang_hs, self.ctx_h, lengths)
+
+        # logits of the valid choices: (bsz, num_choices)
+        choice_logit = 0
+        for i in range(self.domain.selection_length()):
+            idxs = [self.model.item_dict.get_idx(c[i]) for c in choices]
+            idxs = self.model.to_device(Variable(torch.LongTensor(idxs)))
+            choice_logit = choice_logit + logits[i].index_select(1, idxs)
+
+        prob = F.softmax(choice_logit, dim=1)
+        p_agree, idx = prob.max(1)
+        values = self.domain.choice_values(self.context)
+        return values[idx.data.cpu().numpy()], p_agree.data.cpu().numpy()
 
     def write(self):
         batch_outs, batch_lang_hs = self.model.write_batch(
             self.args.rollout_bsz, self.lang_h, self.ctx_h, self.args.temperature)
 
-        counts, scores, states = defaultdict(float), defaultdict(int), defaultdict(list)
-        for i in range(self.args.rollout_bsz):
-            outs = batch_outs.narrow(1, i, 1).squeeze(1).data.cpu()
-            lang_hs = batch_lang_hs.narrow(1, i, 1).squeeze(1)
-
-            # find the end of the dialogue
-            eod_pos = self._find(outs, [self.eod])
-            if eod_pos == outs.size(0):
-                # unfinished dialogue, don't count this
-                continue
-
-            # find the end of the first utterance
-            first_turn_length = self._find(outs, [self.eos, self.eod]) + 1
-            move = outs.narrow(0, 0, first_turn_length)
-            sent = ' '.join(self.model.word_dict.i2w(move.numpy()))
-            sent_lang_hs = lang_hs.narrow(0, 0, first_turn_length + 1)
-            lang_h = lang_hs.narrow(0, first_turn_length + 1, 1).unsqueeze(0)
-
-            dialog_lang_hs = lang_hs.narrow(0, 0, eod_pos + 1)
-            dialog_words = Variable(self.model.to_device(outs.narrow(0, 0, eod_pos + 1)))
-            choice, _, p_agree = self._choose(
-                torch.cat(self.lang_hs + [dialog_lang_hs]),
-                torch.cat(self.words + [dialog_words]).squeeze().unsqueeze(1), sample=False)
-
-            # group by the first utterance
-            counts[sent] += 1
-            scores[sent] += self.domain.score(self.context, choice) * p_agree
-            states[sent] = (lang_h, sent_lang_hs, move)
+        outs = batch_outs.data.cpu().numpy()
+        # find the end of the dialogue and the end of the first utterance
+        eod_pos = self._first_pos(outs == self.eod)
+        first_turn_length = self._first_pos((outs == self.eod) | (outs == self.eos)) + 1
+
+        # unfinished dialogues don't count
+        finished = np.nonzero(eod_pos < outs.shape[0])[0]
+        if len(finished) == 0:
+            return None
+        eod_pos, first_turn_length = eod_pos[finished], first_turn_length[finished]
+
+        # choose items for all finished rollouts together
+        dialog_len = int(eod_pos.max()) + 1
+        idx = Variable(self.model.to_device(torch.LongTensor(finished)))
+        dialog_words = batch_outs.narrow(0, 0, dialog_len).index_select(1, idx)
+        dialog_lang_hs = batch_lang_hs.narrow(0, 0, dialog_len).index_select(1, idx)
+        lengths = eod_pos + 1
+        if self.words:
+            history_words = torch.cat([w.view(-1) for w in self.words]).unsqueeze(1)
+            history_lang_hs = torch.cat(self.lang_hs).unsqueeze(1)
+            dialog_words = torch.cat([history_words.expand(
+                history_words.size(0), len(finished)), dialog_words])
+            dialog_lang_hs = torch.cat([history_lang_hs.expand(
+                history_lang_hs.size(0), len(finished), history_lang_hs.size(2)), dialog_lang_hs])
+            lengths = lengths + history_words.size(0)
+        values, p_agree = self._choose_batch(dialog_words, dialog_lang_hs, lengths.tolist())
+
+        # group by the first utterance
+        moves = np.full((len(finished), first_turn_length.max()), -1, dtype=outs.dtype)
+        in_move = np.arange(moves.shape[1]) < first_turn_length[:, None]
+        moves[in_move] = outs[:moves.shape[1], finished].T[in_move]
+        _, first_ids, groups, counts = np.unique(moves, axis=0,
+            return_index=True, return_inverse=True, return_counts=True)
+        scores = np.bincount(groups, weights=values * p_agree, minlength=len(counts))
 
         # filter out the candidates that appeared less than 'threshold' times
         for threshold in range(self.args.rollout_count_threshold, -1, -1):
-            cands = [k for k in counts if counts[k] >= threshold]
-            if cands:
-                sent = max(cands, key=lambda k: scores[k] / counts[k])
-                lang_h, sent_lang_hs, move = states[sent]
-                self.lang_h = lang_h
-                self.lang_hs.append(sent_lang_hs)
+            cands = np.nonzero(counts >= threshold)[0]
+            if len(cands) > 0:
+                best = cands[np.argmax(scores[cands] / counts[cands])]
+                i = finished[first_ids[best]]
+                length = first_turn_length[first_ids[best]]
+
+                move = batch_outs.narrow(1, i, 1).squeeze(1).data.cpu().narrow(0, 0, length)
+                lang_hs = batch_lang_hs.narrow(1, i, 1).squeeze(1)
+                self.lang_h = lang_hs.narrow(0, length + 1, 1).unsqueeze(0)
+                self.lang_hs.append(lang_hs.narrow(0, 0, length + 1))
                 self.words.append(self.model.word2var('YOU:').unsqueeze(1))
                 self.words.append(self.model.to_device(Variable(move)))
                 assert (torch.cat(self.words).size()[0] == torch.cat(self.lang_hs).size()[0])
 
-                return sent.split(' ')
+                return self.model.word_dict.i2w(move.numpy())
 
 
 class RlAgent(LstmAgent):
@@ -8,6 +8,9 @@ A collection of the implemented negotiation domain.
 """
 
 import re
+import itertools
+
+import numpy as np
 
 
 def get_domain(name):
@@ -72,11 +75,23 @@ class Domain(object):
         """
         pass
 
+    def choice_values(self, ctx):
+        """Scores all the choices returned by generate_choices.
+
+        ctx: a list of strings that represents a context for the negotiation.
+        """
+        pass
+
 
 class ObjectDivisionDomain(Domain):
     """Instance of the object division domain."""
     def __init__(self):
         self.item_pattern = re.compile('^item([0-9])=([0-9\-])+$')
+        # caches keyed by the tuple of item counts
+        self._choice_tables = {}
+        self._choices = {}
+        # cache of parsed 'itemX=Y' strings
+        self._parsed_choices = {}
 
     def selection_length(self):
         return 6
@@ -84,24 +99,40 @@ class ObjectDivisionDomain(Domain):
     def input_length(self):
         return 3
 
+    def choice_table(self, cnts):
+        """All valid divisions for the item counts `cnts`.
+
+        Returns an int array of shape (num_choices, num_items) with the number
+        of each item we take, in the same order as generate_choices.
+        """
+        cnts = tuple(cnts)
+        table = self._choice_tables.get(cnts)
+        if table is None:
+            table = np.array(list(itertools.product(*[range(n + 1) for n in cnts])),
+                dtype=np.int64).reshape(-1, len(cnts))
+            self._choice_tables[cnts] = table
+        return table
+
     def generate_choices(self, inpt):
         cnts, _ = self.parse_context(inpt)
-
-        def gen(cnts, idx=0, choice=[]):
-            if idx >= len(cnts):
+        cnts = tuple(cnts)
+        choices = self._choices.get(cnts)
+        if choices is None:
+            choices = []
+            for choice in self.choice_table(cnts):
                 left_choice = ['item%d=%d' % (i, c) for i, c in enumerate(choice)]
                 right_choice = ['item%d=%d' % (i, n - c) for i, (n, c) in enumerate(zip(cnts, choice))]
-                return [left_choice + right_choice]
-            choices = []
-            for c in range(cnts[idx] + 1):
-                choice.append(c)
-                choices += gen(cnts, idx + 1, choice)
-                choice.pop()
-            return choices
-        choices = gen(cnts)
-        choices.append(['<no_agreement>'] * self.selection_length())
-        choices.append(['<disconnect>'] * self.selection_length())
-        return choices
+                choices.append(left_choice + right_choice)
+            choices.append(['<no_agreement>'] * self.selection_length())
+            choices.append(['<disconnect>'] * self.selection_length())
+            self._choices[cnts] = choices
+        return list(choices)
+
+    def choice_values(self, ctx):
+        cnts, vals = self.parse_context(ctx)
+        values = self.choice_table(cnts).dot(np.array(vals, dtype=np.int64))
+        # <no_agreement> and <disconnect> are worth nothing
+        return np.append(values, [0, 0])
 
     def parse_context(self, ctx):
         cnts = [int(n) for n in ctx[0::2]]
@@ -123,10 +154,14 @@ class ObjectDivisionDomain(Domain):
         return score
 
     def parse_choice(self, choice):
-        match = self.item_pattern.match(choice)
-        assert match is not None, 'choice %s' % choice
-        # Returns item idx and it's count
-        return (int(match.groups()[0]), int(match.groups()[1]))
+        parsed = self._parsed_choices.get(choice)
+        if parsed is None:
+            match = self.item_pattern.match(choice)
+            assert match is not None, 'choice %s' % choice
+            # Returns item idx and it's count
+            parsed = (int(match.groups()[0]), int(match.groups()[1]))
+            self._parsed_choices[choice] = parsed
+        return parsed
 
     def parse_human_choice(self, inpt, output):
         cnts = self.parse_context(inpt)[0]
@@ -147,12 +182,11 @@ class ObjectDivisionDomain(Domain):
 
     def score_choices(self, choices, ctxs):
         assert len(choices) == len(ctxs)
-        cnts = [int(x) for x in ctxs[0][0::2]]
-        agree, scores = True, [0 for _ in range(len(ctxs))]
-        for i, n in enumerate(cnts):
-            for agent_id, (choice, ctx) in enumerate(zip(choices, ctxs)):
-                taken = self._to_int(choice[i][-1])
-                n -= taken
-                scores[agent_id] += int(ctx[2 * i + 1]) * taken
-            agree = agree and (n == 0)
+        cnts = np.array([int(x) for x in ctxs[0][0::2]])
+        n = len(cnts)
+        # (num_agents, num_items) counts taken and values
+        taken = np.array([[self._to_int(choice[i][-1]) for i in range(n)] for choice in choices])
+        vals = np.array([[int(x) for x in ctx[1:2 * n:2]] for ctx in ctxs])
+        agree = bool(np.all(taken.sum(0) == cnts))
+        scores = [int(x) for x in (taken * vals).sum(1)]
         return agree, scores
@@ -12,7 +12,6 @@ import argparse
 import sys
 import time
 import random
-import itertools
 import re
 import pdb
 
@@ -67,20 +66,6 @@ def compute_score(vals, picks):
     return np.sum([v * p for v, p in zip(vals, picks)])
 
 
-def gen_choices(cnts, idx=0, choice=[]):
-    """Generate all the valid choices.
-    It generates both yours and your opponent choices.
-    """
-    if idx >= len(cnts):
-        return [(choice[:], [n - c for n, c in zip(cnts, choice)]),]
-    choices = []
-    for c in range(cnts[idx] + 1):
-        choice.append(c)
-        choices += gen_choices(cnts, idx + 1, choice)
-        choice.pop()
-    return choices
-
-
 def main():
     parser = argparse.ArgumentParser(
         description='A script to compute Pareto efficiency')
@@ -109,13 +94,13 @@ def main():
         avg_agree += 1
         score1 = compute_score(vals1, picks1)
         score2 = compute_score(vals2, picks2)
-        choices = gen_choices(cnts)
-        can_improve = False
-        for cand1, cand2 in choices:
-            cand_score1 = compute_score(vals1, cand1)
-            cand_score2 = compute_score(vals2, cand2)
-            if (cand_score1 > score1 and cand_score2 >= score2) or (cand_score1 >= score1 and cand_score2 > score2):
-                can_improve = True
+        # scores of all the possible divisions for both agents
+        table = domain.choice_table(cnts)
+        cand_scores1 = table.dot(vals1)
+        cand_scores2 = (np.array(cnts) - table).dot(vals2)
+        can_improve = bool(np.any(
+            ((cand_scores1 > score1) & (cand_scores2 >= score2)) |
+            ((cand_scores1 >= score1) & (cand_scores2 > score2))))
 
         avg_score1 += score1
         avg_score2 += score2
@@ -28,8 +28,11 @@ class TimeMetric(object):
         self.n += 1
 
     def value(self):
-        self.n = max(1, self.n)
-        return 1.0 * self.t / self.n
+        return 1.0 * self.t / max(1, self.n)
+
+    def merge(self, other):
+        self.t += other.t
+        self.n += other.n
 
     def show(self):
         return '%.3fs' % (1. * self.value())
@@ -49,8 +52,11 @@ class NumericMetric(object):
         self.n += n
 
     def value(self):
-        self.n = max(1, self.n)
-        return 1.0 * self.k / self.n
+        return 1.0 * self.k / max(1, self.n)
+
+    def merge(self, other):
+        self.k += other.k
+        self.n += other.n
 
 
 class PercentageMetric(NumericMetric):
@@ -76,12 +82,15 @@ class TextMetric(object):
         pass
 
     def value(self):
-        self.n = max(1, self.n)
-        return 1. * self.k / self.n
+        return 1. * self.k / max(1, self.n)
 
     def show(self):
         return '%.2f' % (1. * self.value())
 
+    def merge(self, other):
+        self.k += other.k
+        self.n += other.n
+
 
 class NGramMetric(TextMetric):
     """Metric that evaluates n gramms."""
@@ -112,6 +121,9 @@ class UniquenessMetric(object):
     def value(self):
         return len(self.seen)
 
+    def merge(self, other):
+        self.seen.update(other.seen)
+
     def show(self):
         return str(self.value())
 
@@ -136,12 +148,15 @@ class SimilarityMetric(object):
         self.history.append(sen)
 
     def value(self):
-        self.n = max(1, self.n)
-        return 1. * self.k / self.n
+        return 1. * self.k / max(1, self.n)
 
     def show(self):
         return '%.2f' % (1. * self.value())
 
+    def merge(self, other):
+        self.k += other.k
+        self.n += other.n
+
 
 class MetricsContainer(object):
     """A container that stores and updates several metrics."""
@@ -183,6 +198,12 @@ class MetricsContainer(object):
     def value(self, name):
         return self.metrics[name].value()
 
+    def merge(self, other):
+        """Adds the statistics recorded by another container with the same metrics."""
+        assert list(self.metrics.keys()) == list(other.metrics.keys())
+        for k, m in self.metrics.items():
+            m.merge(other.metrics[k])
+
     def show(self):
         return ' '.join(['%s=%s' % (k, v.show()) for k, v in self.metrics.iteritems()])
 
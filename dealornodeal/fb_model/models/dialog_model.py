@@ -19,6 +19,8 @@ import torch.nn.functional as F
 import torch.nn.init
 from torch.autograd import Variable
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence as pack
+from torch.nn.utils.rnn import pad_packed_sequence as unpack
 
 from data import STOP_TOKENS
 from domain import get_domain
@@ -219,6 +221,53 @@ class DialogModel(modules.CudaModule):
         logits = [decoder.forward(h).squeeze(0) for decoder in self.sel_decoders]
         return logits
 
+    def generate_choice_logits_batch(self, inpt, lang_h, ctx_h, lengths):
+        """Batched version of generate_choice_logits for sequences of different lengths.
+
+        inpt: (seq_len, bsz) padded words.
+        lang_h: (seq_len, bsz, nhid_lang) padded language model hidden states.
+        ctx_h: context hidden state shared by all sequences.
+        lengths: a list of sequence lengths.
+        Returns a list of (bsz, len(item_dict)) logits, one per item.
+        """
+        bsz = inpt.size(1)
+        # pack_padded_sequence expects decreasing lengths
+        sorted_lengths, order = torch.sort(torch.LongTensor(lengths), 0, descending=True)
+        _, unorder = torch.sort(order, 0)
+        order = Variable(self.to_device(order))
+        unorder = Variable(self.to_device(unorder))
+
+        # run a birnn over the concatenation of the input embeddings and
+        # language model hidden states
+        inpt_emb = self.word_encoder(inpt.index_select(1, order))
+        h = torch.cat([lang_h.index_select(1, order), inpt_emb], 2)
+        h = self.dropout(h)
+
+        # runs selection rnn over the hidden state h
+        attn_h = self.zero_hid(bsz, self.args.nhid_attn, copies=2)
+        self.sel_rnn.flatten_parameters()
+        h, _ = self.sel_rnn(pack(h, sorted_lengths.tolist()), attn_h)
+        h, _ = unpack(h)
+        h = h.index_select(1, unorder).transpose(0, 1).contiguous()
+
+        # perform attention over the unpadded positions only
+        seq_len = h.size(1)
+        logit = self.attn(h.view(-1, 2 * self.args.nhid_attn)).view(bsz, seq_len)
+        pad_mask = torch.arange(0, seq_len).long().unsqueeze(0).expand(bsz, seq_len) >= \
+            torch.LongTensor(lengths).unsqueeze(1).expand(bsz, seq_len)
+        logit = logit.masked_fill(Variable(self.to_device(pad_mask)), -float('inf'))
+        prob = F.softmax(logit, dim=1).unsqueeze(2).expand_as(h)
+        attn = torch.sum(torch.mul(h, prob), 1)
+
+        # concatenate attention and context hidden and pass it to the selection encoder
+        ctx_h = ctx_h.view(1, -1).expand(bsz, ctx_h.size(-1))
+        h = torch.cat([attn, ctx_h], 1)
+        h = self.sel_encoder.forward(h)
+
+        # generate logits for each item separately
+        logits = [decoder.forward(h) for decoder in self.sel_decoders]
+        return logits
+
     def write_batch(self, bsz, lang_h, ctx_h, temperature, max_words=100):
         """Generate sentenses for a batch simultaneously."""
         eod = self.word_dict.get_idx('<selection>')
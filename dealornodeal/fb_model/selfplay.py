@@ -8,9 +8,17 @@ Selfplaying util.
 """
 
 import argparse
+import os
 import pdb
 import re
 import random
+import shutil
+import traceback
+import multiprocessing
+try:
+    import queue as queue_module
+except ImportError:
+    import Queue as queue_module
 
 import numpy as np
 import torch
@@ -33,10 +41,11 @@ class SelfPlay(object):
         self.args = args
         self.logger = logger if logger else DialogLogger()
 
-    def run(self):
+    def run(self, ctx_list=None):
         n = 0
+        ctx_list = self.ctx_gen.iter() if ctx_list is None else ctx_list
         # goes through the list of contexes and kicks off a dialogue
-        for ctxs in self.ctx_gen.iter():
+        for ctxs in ctx_list:
             n += 1
             self.logger.dump('=' * 80)
             self.dialog.run(ctxs, self.logger)
@@ -56,6 +65,91 @@ def get_agent_type(model, smart=False, fast=False):
         assert False, 'unknown model type: %s' % (model)
 
 
+def make_dialog(args):
+    """Loads Alice and Bob and puts them in a dialogue."""
+    alice_model = utils.load_model(args.alice_model_file)
+    alice_ty = get_agent_type(alice_model, args.smart_alice, args.fast_rollout)
+    alice = alice_ty(alice_model, args, name='Alice')
+
+    bob_model = utils.load_model(args.bob_model_file)
+    bob_ty = get_agent_type(bob_model, args.smart_bob, args.fast_rollout)
+    bob = bob_ty(bob_model, args, name='Bob')
+
+    return Dialog([alice, bob], args)
+
+
+def _run_shard(worker_id, args, ctx_list, log_file, queue):
+    """Runs selfplay over a shard of the contexes and sends back the metrics.
+
+    If the shard fails, the traceback is sent back instead of the metrics.
+    """
+    try:
+        utils.set_seed(args.seed + worker_id)
+        # the workers already use all the cores
+        torch.set_num_threads(1)
+        dialog = make_dialog(args)
+        logger = DialogLogger(verbose=args.verbose, log_file=log_file)
+        selfplay = SelfPlay(dialog, None, args, logger)
+        selfplay.run(ctx_list)
+    except Exception:
+        queue.put((worker_id, None, traceback.format_exc()))
+        return
+    queue.put((worker_id, dialog.metrics, None))
+
+
+def run_parallel(args, ctx_gen):
+    """Partitions the contexes across args.num_workers processes.
+
+    Each worker loads its own models and writes its own log, the logs are
+    concatenated into args.log_file in the order of the shards.
+    Returns the merged metrics; raises RuntimeError if any worker failed.
+    """
+    ctx_list = list(ctx_gen.iter())
+    num_workers = max(1, min(args.num_workers, len(ctx_list)))
+    log_files = ['%s.%d' % (args.log_file, i) if args.log_file else ''
+        for i in range(num_workers)]
+
+    queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_run_shard,
+        args=(i, args, ctx_list[i::num_workers], log_files[i], queue))
+        for i in range(num_workers)]
+    for p in workers:
+        p.start()
+    # collect the results before joining, so that the queue is drained
+    results, errors = {}, {}
+    while len(results) + len(errors) < num_workers:
+        try:
+            worker_id, metrics, error = queue.get(timeout=1)
+        except queue_module.Empty:
+            # a worker killed (e.g. by a signal) never reports back
+            for i, p in enumerate(workers):
+                if p.exitcode not in (None, 0) and i not in results and i not in errors:
+                    errors[i] = 'exited with code %d\n' % p.exitcode
+            continue
+        if error is not None:
+            errors[worker_id] = error
+        else:
+            results[worker_id] = metrics
+    for p in workers:
+        p.join()
+    if errors:
+        raise RuntimeError('selfplay failed in %d of %d workers:\n%s' % (
+            len(errors), num_workers,
+            '\n'.join('worker %d:\n%s' % (i, errors[i]) for i in sorted(errors))))
+
+    metrics = results[0]
+    for i in range(1, num_workers):
+        metrics.merge(results[i])
+
+    if args.log_file:
+        with open(args.log_file, 'w') as fout:
+            for log_file in log_files:
+                with open(log_file, 'r') as fin:
+                    shutil.copyfileobj(fin, fout)
+                os.remove(log_file)
+    return metrics
+
+
 def main():
     parser = argparse.ArgumentParser(description='selfplaying script')
     parser.add_argument('--alice_model_file', type=str,
@@ -90,21 +184,21 @@ def main():
         help='file with the reference text')
     parser.add_argument('--domain', type=str, default='object_division',
         help='domain for the dialogue')
+    parser.add_argument('--num_workers', type=int, default=1,
+        help='number of processes to selfplay with')
     args = parser.parse_args()
 
     utils.set_seed(args.seed)
 
-    alice_model = utils.load_model(args.alice_model_file)
-    alice_ty = get_agent_type(alice_model, args.smart_alice, args.fast_rollout)
-    alice = alice_ty(alice_model, args, name='Alice')
+    ctx_gen = ContextGenerator(args.context_file)
 
-    bob_model = utils.load_model(args.bob_model_file)
-    bob_ty = get_agent_type(bob_model, args.smart_bob, args.fast_rollout)
-    bob = bob_ty(bob_model, args, name='Bob')
+    if args.num_workers > 1:
+        metrics = run_parallel(args, ctx_gen)
+        print(' '.join(['%s=%s' % (k, v) for k, v in metrics.dict().items()]))
+        return
 
-    dialog = Dialog([alice, bob], args)
+    dialog = make_dialog(args)
     logger = DialogLogger(verbose=args.verbose, log_file=args.log_file)
-    ctx_gen = ContextGenerator(args.context_file)
 
     selfplay = SelfPlay(dialog, ctx_gen, args, logger)
     selfplay.run()
@@ -1,4 +1,3 @@
-import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 
 from cocoa.model.generator import Templates as BaseTemplates, Generator as BaseGenerator
@@ -9,17 +8,15 @@ from parser import Parser
 class Generator(BaseGenerator):
     def get_filter(self, used_templates=None, proposal_type=None, context_tag=None, tag=None, **kwargs):
         print 'filter:', proposal_type, context_tag, tag
-        locs = [super(Generator, self).get_filter(used_templates)]
+        constraints = []
         if proposal_type:
-            self._add_filter(locs, self.templates.proposal_type == proposal_type)
-            # proposal_type must be satisfied
-            if np.sum(locs[-1]) == 0:
-                return None
+            constraints.append(('proposal_type', proposal_type))
         if tag:
-            self._add_filter(locs, self.templates.tag == tag)
+            constraints.append(('tag', tag))
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
-        return self._select_filter(locs)
+            constraints.append(('context_tag', context_tag))
+        # proposal_type must be satisfied
+        return self._select_filter(used_templates, constraints, required=1 if proposal_type else 0)
 
 class Templates(BaseTemplates):
     def ambiguous_template(self, template):
@@ -242,6 +242,19 @@ class EntityRanker(object):
         #print "Score: ", self.classifier.predict(features_transformed)
         return self.classifier.predict_proba(features_transformed)
 
+    def score_batch(self, span, entities, agent, uuid):
+        """
+        Score a span against a list of entities in one call to the classifier
+        :param span:
+        :param entities: List of entity strings
+        :param agent:
+        :param uuid:
+        :return: Array of shape (len(entities), 2), row i is score(span, entities[i], agent, uuid)
+        """
+        features = [self._feature_func(span, entity, agent, uuid) for entity in entities]
+        features_transformed = self.vectorizer.transform(features)
+        return self.classifier.predict_proba(features_transformed)
+
 
 if __name__ == "__main__":
     # TODO: Handle keeping terms like "m.d." intact rather than removing punctuation
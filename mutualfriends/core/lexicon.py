@@ -1,13 +1,17 @@
 import collections
 import editdistance
+import gc
 import json
+import multiprocessing
 import re
 import random
 import os.path
-from collections import defaultdict
+import weakref
+from collections import defaultdict, namedtuple
+from itertools import izip
 from fuzzywuzzy import fuzz
 
-from cocoa.core.util import read_pickle, write_pickle
+from cocoa.core.util import read_pickle, write_pickle, write_pickle_atomic, hash_json, LRUCache
 from cocoa.core.entity import Entity, is_entity
 from lexicon_utils import get_prefixes, get_acronyms, get_edits, get_morphological_variants
 
@@ -16,33 +20,137 @@ def add_lexicon_arguments(parser):
     parser.add_argument('--learned-lex', default=False, action='store_true', help='if true have entity linking in lexicon use learned system')
     parser.add_argument('--inverse-lexicon', help='Path to inverse lexicon data')
     parser.add_argument('--lexicon', help='Path to lexicon')
+    parser.add_argument('--lexicon-cache', default=None, help='Directory of lexicons cached by schema and stop words (used when --lexicon is not given; no cache by default)')
+    parser.add_argument('--lexicon-workers', default=1, type=int, help='Number of processes used to build the lexicon')
+
+def entity_synonyms(entity_type):
+    """
+    Computes all variants (synonyms) for each token of a canonical entity
+    :param entity_type: (entity, type)
+    :return: list of synonyms without duplicates
+    """
+    entity, type = entity_type
+    phrases = []
+    mod_entity = entity
+    for s in [' of ', ' - ', '-']:
+        mod_entity = mod_entity.replace(s, ' ')
+
+    # Add all tokens in entity -- we only compute token-level edits (except for acronyms/prefixes...)
+    entity_tokens = mod_entity.split(' ')
+    phrases.extend([t for t in entity_tokens])
+
+    synonyms = []
+    if entity == 'facebook':
+        synonyms.append('fb')
+
+    # General
+    for phrase in phrases:
+        synonyms.append(phrase)
+        if type != 'person':
+            synonyms.extend(get_edits(phrase))
+            synonyms.extend(get_morphological_variants(phrase))
+            synonyms.extend(get_prefixes(phrase, min_length=1))
+        if phrase in ('and', '&', "'n"):
+            synonyms.extend(['and', '&', "'n"])
+
+    # Multi-token level variants: UPenn, uc berkeley
+    if len(mod_entity.split(" ")) > 1:
+        phrase_level_prefixes = get_prefixes(mod_entity, min_length=1, max_length=5)
+        phrase_level_acronyms = get_acronyms(mod_entity)
+        synonyms.extend(phrase_level_acronyms)
+        synonyms.extend(phrase_level_prefixes)
+
+    return list(set(synonyms))
 
 class BaseLexicon(object):
     """
     Base lexicon class defining general purpose functions for any lexicon
     """
-    def __init__(self, schema, learned_lex, stop_words=None, lexicon_path=None):
+    # Bump when compute_synonyms changes so that cached lexicons are rebuilt
+    version = 1
+
+    def __init__(self, schema, learned_lex, stop_words=None, lexicon_path=None, cache=None, num_workers=1):
+        """
+        The lexicon is built (or loaded) on first access of self.lexicon.
+        :param lexicon_path: Path to a lexicon pickle. It is loaded as is if it
+            exists (it is never overwritten), otherwise the computed lexicon is written there.
+        :param cache: Directory of computed lexicons named by a hash of the
+            schema entities and stop words, used when lexicon_path is not given
+        :param num_workers: Number of processes used to compute synonyms
+        """
         self.schema = schema
         # if True, lexicon uses learned system
         self.learned_lex = learned_lex
         self.entities = set()
         self.word_counts = defaultdict(int)  # Counts of words that show up in entities
-        self.lexicon = defaultdict(list)  # Mapping from string -> list of (entity, type)
+        self._lexicon = None  # Mapping from string -> list of (entity, type)
         with open(stop_words, 'r') as fin:
             self.stop_words = set([x.strip() for x in fin.read().split()][:1000])
             self.stop_words.update(['one', '1', 'two', '2', 'three', '3', 'four', '4', 'five', '5', 'six', '6', 'seven', '7', 'eight', '8', 'nine', '9', 'ten', '10'])
         self.load_entities()
 
-        if not lexicon_path or not os.path.exists(lexicon_path):
-            self.compute_synonyms()
-            print 'Created lexicon: %d phrases mapping to %d entities, %f entities per phrase' % (len(self.lexicon), len(self.entities), sum([len(x) for x in self.lexicon.values()])/float(len(self.lexicon)))
-            if lexicon_path is not None:
-                print 'Dump lexicon to {}'.format(lexicon_path)
-                write_pickle(self.lexicon, lexicon_path)
+        self.cache_key = self._cache_key()
+        self.lexicon_path = lexicon_path
+        if not lexicon_path and cache:
+            self.cache_path = os.path.join(cache, 'lexicon_%s.pkl' % self.cache_key)
         else:
-            print 'Load lexicon from {}'.format(lexicon_path)
-            self.lexicon = read_pickle(lexicon_path)
+            self.cache_path = None
+        self.num_workers = num_workers
 
+    def _cache_key(self):
+        """
+        Hash of everything the lexicon is computed from.
+        """
+        return hash_json([self.version, sorted(self.entities), sorted(self.stop_words)])
+
+    @property
+    def lexicon(self):
+        if self._lexicon is None:
+            self._lexicon = self._load_lexicon()
+        return self._lexicon
+
+    @lexicon.setter
+    def lexicon(self, lexicon):
+        self._lexicon = lexicon
+
+    def _load_lexicon(self):
+        # The lexicon has millions of small objects; the cyclic GC only slows down
+        # building or unpickling it
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._load_or_compute_lexicon()
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _load_or_compute_lexicon(self):
+        if self.lexicon_path and os.path.exists(self.lexicon_path):
+            # A given lexicon (e.g. shipped or curated) is used as is
+            print 'Load lexicon from {}'.format(self.lexicon_path)
+            lexicon = read_pickle(self.lexicon_path)
+            # A lexicon from the cache (see below)
+            if set(lexicon.keys()) == set(['key', 'lexicon']):
+                lexicon = lexicon['lexicon']
+            return lexicon
+
+        cache_path = self.cache_path
+        if cache_path and os.path.exists(cache_path):
+            cached = read_pickle(cache_path)
+            if cached.get('key') == self.cache_key:
+                print 'Load lexicon from {}'.format(cache_path)
+                return cached['lexicon']
+            print 'Lexicon at {} is outdated'.format(cache_path)
+
+        lexicon = self.compute_synonyms(self.num_workers)
+        print 'Created lexicon: %d phrases mapping to %d entities, %f entities per phrase' % (len(lexicon), len(self.entities), sum([len(x) for x in lexicon.values()])/float(len(lexicon)))
+        if self.lexicon_path:
+            print 'Dump lexicon to {}'.format(self.lexicon_path)
+            write_pickle(lexicon, self.lexicon_path)
+        elif cache_path:
+            print 'Dump lexicon to {}'.format(cache_path)
+            write_pickle_atomic({'key': self.cache_key, 'lexicon': lexicon}, cache_path)
+        return lexicon
 
     def load_entities(self):
         for type_, values in self.schema.values.iteritems():
@@ -56,17 +164,54 @@ class BaseLexicon(object):
                 self.word_counts[word] += 1
         self.entities.add((entity, type))
 
+    def compute_synonyms(self, num_workers=1):
+        """
+        Computes all variants (synonyms) for each token of every canonical entity.
+        Synonyms of entities are computed in parallel and merged in the order of
+        self.entities, so the result does not depend on num_workers.
+        :return: Mapping from string -> list of (entity, type)
+        """
+        entities = list(self.entities)
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                entity_synonyms_list = pool.map(entity_synonyms, entities, chunksize=max(1, len(entities) / (num_workers * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            entity_synonyms_list = map(entity_synonyms, entities)
+
+        lexicon = defaultdict(list)
+        for entity, synonyms in izip(entities, entity_synonyms_list):
+            # Add to lexicon
+            for synonym in synonyms:
+                if self.stop_words and synonym not in self.word_counts and synonym in self.stop_words:
+                    continue
+                lexicon[synonym].append(entity)
+        return lexicon
+
     def lookup(self, phrase):
         return self.lexicon.get(phrase, [])
 
 
 
+# KB data used to link entities, see Lexicon.kb_info
+KBInfo = namedtuple('KBInfo', ['entities', 'entity_types', 'fingerprint'])
+
 class Lexicon(BaseLexicon):
     """
     Lexicon that only computes per token entity transforms rather than per phrase transforms (except for prefixes/acronyms)
     """
-    def __init__(self, schema, learned_lex=False, entity_ranker=None, scenarios_json=None, stop_words=None, lexicon_path=None):
-        super(Lexicon, self).__init__(schema, learned_lex, stop_words, lexicon_path)
+    # Number of (span, KB) matches memoized by score_and_match
+    match_cache_size = 100000
+    # Number of span candidate lists memoized by _link_spans
+    span_cache_size = 100000
+    # Tokens skipped when intersecting the candidates of a span
+    span_stop_words = set(['of'])
+
+    def __init__(self, schema, learned_lex=False, entity_ranker=None, scenarios_json=None, stop_words=None, lexicon_path=None, cache=None, num_workers=1):
+        super(Lexicon, self).__init__(schema, learned_lex, stop_words, lexicon_path, cache, num_workers)
         # TODO: Remove hard-coding (use list of common words/phrases/stop words)
         self.common_phrases = set(["went", "to", "and", "of", "my", "the", "names", "any",
                                    "friends", "at", "for", "in", "many", "partner", "all", "we",
@@ -86,6 +231,16 @@ class Lexicon(BaseLexicon):
         else:
             print "Using rule-based lexicon..."
 
+        # Built on the first call of link_entity
+        self._link_index = None
+        self.match_cache = LRUCache(self.match_cache_size)
+        self.span_cache = LRUCache(self.span_cache_size)
+        self._entity_tokens_cache = {}
+        # KB -> KBInfo. KBs are assumed not to change once linked against.
+        self.kb_cache = weakref.WeakKeyDictionary()
+        # (entities, entity types) -> fingerprint, shared by KBs with the same content
+        self._kb_fingerprints = {}
+
 
     def _process_kbs(self, scenarios_json):
         """
@@ -121,156 +276,198 @@ class Lexicon(BaseLexicon):
         self.uuid_to_kbs_with_types = uuid_to_kbs_with_types
 
 
-    def compute_synonyms(self):
+    def _build_link_index(self):
         """
-        Computes all variants (synonyms) for each token of every canonical entity
-        :return:
+        Index of self.lexicon for link_entity: each candidate (entity, type) gets an id
+        and each phrase maps to a bitmap (python int) of its candidate ids, so that
+        intersecting the candidates of tokens in a span is a bitwise and.
+        :return: (phrase -> bitmap, id -> candidate)
         """
-        # Keep track of tokens we have seen to handle repeats
-        for entity, type in self.entities:
-            phrases = []
-            mod_entity = entity
-            for s in [' of ', ' - ', '-']:
-                mod_entity = mod_entity.replace(s, ' ')
-
-            # Add all tokens in entity -- we only compute token-level edits (except for acronyms/prefixes...)
-            entity_tokens = mod_entity.split(' ')
-            phrases.extend([t for t in entity_tokens])
-
-            synonyms = []
-            if entity == 'facebook':
-                synonyms.append('fb')
-
-            # General
-            for phrase in phrases:
-                synonyms.append(phrase)
-                if type != 'person':
-                    synonyms.extend(get_edits(phrase))
-                    synonyms.extend(get_morphological_variants(phrase))
-                    synonyms.extend(get_prefixes(phrase, min_length=1))
-                if phrase in ('and', '&', "'n"):
-                    synonyms.extend(['and', '&', "'n"])
-
-            # Multi-token level variants: UPenn, uc berkeley
-            if len(mod_entity.split(" ")) > 1:
-                phrase_level_prefixes = get_prefixes(mod_entity, min_length=1, max_length=5)
-                phrase_level_acronyms = get_acronyms(mod_entity)
-                synonyms.extend(phrase_level_acronyms)
-                synonyms.extend(phrase_level_prefixes)
-
-
-            # Add to lexicon
-            for synonym in set(synonyms):
-                if self.stop_words and synonym not in self.word_counts and synonym in self.stop_words:
-                    continue
-                self.lexicon[synonym].append((entity, type))
+        phrase_bitmaps = {}
+        candidate_ids = {}
+        candidates = []
+        for phrase, phrase_candidates in self.lexicon.iteritems():
+            bitmap = 0
+            for c in phrase_candidates:
+                if c not in candidate_ids:
+                    candidate_ids[c] = len(candidates)
+                    candidates.append(c)
+                bitmap |= 1 << candidate_ids[c]
+            phrase_bitmaps[phrase] = bitmap
+        return phrase_bitmaps, candidates
+
+    @property
+    def link_index(self):
+        if self._link_index is None:
+            self._link_index = self._build_link_index()
+        return self._link_index
+
+    def _lookup_candidates(self, raw):
+        """
+        Intersection of the candidates of the tokens in a span (except stop words).
+        score_and_match takes the first of equally scored candidates, so the order
+        of the list (which comes from set intersections) determines the match.
+        """
+        candidate_entities = None
+        for idx, token in enumerate(raw):
+            results = self.lookup(token)
+            if idx == 0: candidate_entities = results
+            if token not in self.span_stop_words:
+                candidate_entities = list(set(candidate_entities).intersection(set(results)))
+        return candidate_entities
+
+    def _span_candidates(self, raw):
+        """
+        Memoized _lookup_candidates of a span (tuple of tokens).
+        """
+        candidates = self.span_cache.get(raw)
+        if candidates is None:
+            candidates = self._lookup_candidates(raw)
+            self.span_cache.put(raw, candidates)
+        return candidates
 
-    def score_and_match(self, span, candidates, agent, uuid, kb_entities, kb_entity_types, known_kb=True):
+    def kb_info(self, kb):
+        """
+        Entities, entity types and fingerprint of `kb`, computed once per KB object.
+        KBs with the same entities and entity types get the same fingerprint.
+        """
+        info = self.kb_cache.get(kb)
+        if info is None:
+            entities = frozenset(kb.entity_set)
+            entity_types = frozenset(kb.entity_type_set)
+            fingerprint = self._kb_fingerprints.setdefault((entities, entity_types), len(self._kb_fingerprints))
+            info = KBInfo(entities, entity_types, fingerprint)
+            self.kb_cache[kb] = info
+        return info
+
+    def score_and_match(self, span, candidates, agent, uuid, kb_entities, kb_entity_types, known_kb=True, kb_fingerprint=None):
         """
         Score the given span with the list of candidate entities and returns best match
+        Results are memoized by (span, candidates, KB fingerprint, known_kb) since the same
+        spans recur within and across dialogues with the same KB.
         :param span:
         :param candidates:
         :param kb_entities: Set of entities mentioned in both agents KBs
         :param agent: Agent id whose span is being entity linked
         :param uuid: uuid of scenario containing KB for given agent
+        :param kb_fingerprint: Hashable identifying (kb_entities, kb_entity_types), see kb_info;
+            if None the sets themselves are used
         :return:
         """
-        # Use heuristic scoring system
-        #print 'span:', span
-        if not self.learned_lex:
-            entity_scores = []
-            for c in candidates:
-                #print 'c:', c
-                # Clean up punctuation
-                c_s = re.sub("-", " ", c[0])
-                span_tokens = span.split()
-                entity_tokens = c_s.split()
-
-                ed = editdistance.eval(span, c[0])
-                # Filter false positives
-                if c[1] not in kb_entity_types:
-                    continue
+        if kb_fingerprint is None:
+            kb_fingerprint = (frozenset(kb_entities), frozenset(kb_entity_types))
+        key = (span, tuple(candidates), kb_fingerprint, known_kb)
+        if self.learned_lex:
+            # Ranker features depend on the scenario
+            key += (agent, uuid)
+        best_match = self.match_cache.get(key)
+        if best_match is None:
+            if not self.learned_lex:
+                best_match = self._heuristic_match(span, candidates, kb_entities, kb_entity_types, known_kb)
+            else:
+                best_match = self._ranker_match(span, candidates, agent, uuid)
+            self.match_cache.put(key, best_match)
+        return best_match
 
-                def is_stopwords():
-                    if span == c[0]:
-                        return False
-                    if len(span_tokens) == 1 and span in self.stop_words:
-                        return True
-                    if span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
-                        return True
-                    all_stop = True
-                    for x in span_tokens:
-                        if x not in self.stop_words:
-                            all_stop = False
-                            break
-                    if all_stop:
-                        return True
-                    return False
-
-                if is_stopwords():
-                    continue
-                if len(span_tokens) > len(entity_tokens):
-                    continue
-                if c[0] not in kb_entities and known_kb:
-                    # Prioritize exact match
-                    if c[0] == span:
-                        score = 0
-                    else:
-                        continue
-                elif span in entity_tokens:
+    def _entity_tokens(self, entity):
+        tokens = self._entity_tokens_cache.get(entity)
+        if tokens is None:
+            # Clean up punctuation
+            c_s = re.sub("-", " ", entity)
+            tokens = (c_s, c_s.split())
+            self._entity_tokens_cache[entity] = tokens
+        return tokens
+
+    def _span_is_stopwords(self, span_tokens):
+        """
+        Whether a span is a stop word phrase, unless it matches the candidate exactly
+        (see _heuristic_scores).
+        """
+        span = ' '.join(span_tokens)
+        if len(span_tokens) == 1 and span in self.stop_words:
+            return True
+        if span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
+            return True
+        for x in span_tokens:
+            if x not in self.stop_words:
+                return False
+        return True
+
+    def _heuristic_scores(self, span, candidates, kb_entities, kb_entity_types, known_kb):
+        """
+        Heuristic scores of all candidates of a span; lower is better.
+        :return: list of (entity, type, score) for candidates that are not filtered out
+        """
+        span_tokens = span.split()
+        span_is_stopwords = self._span_is_stopwords(span_tokens)
+        entity_scores = []
+        for c in candidates:
+            # Filter false positives
+            if c[1] not in kb_entity_types:
+                continue
+            if span_is_stopwords and span != c[0]:
+                continue
+            c_s, entity_tokens = self._entity_tokens(c[0])
+            if len(span_tokens) > len(entity_tokens):
+                continue
+            if c[0] not in kb_entities and known_kb:
+                # Prioritize exact match
+                if c[0] == span:
                     score = 0
-                # Prioritize multi phrase spans contained in entity
-                elif len(span_tokens) > 1 and span in c_s:
-                    score = 1
                 else:
-                    score = ed + 2
-                # Prioritize entity in KB even if we are not sure
-                if not known_kb and c[0] not in kb_entities and c[0] != span:
-                    score += 3
-
-                entity_scores.append(c + (score,))
-
-            # Sort entity scores
-            if len(entity_scores) == 0:
-                return (span, None)
-            entity_scores = sorted(entity_scores, key=lambda x: x[2])
-
-            # If exact match or substring match with an entity
-            entity, type_, score = entity_scores[0]
-
-            # Be more cautious when not known_kb; +3 because previous prioritization
-            if score > 8 and not known_kb:
-                best_match = (span, None)
-            elif (score > 5 and len(entity_scores) > 1) or span in self.common_phrases:
-                best_match = (span, None)
+                    continue
+            elif span in entity_tokens:
+                score = 0
+            # Prioritize multi phrase spans contained in entity
+            elif len(span_tokens) > 1 and span in c_s:
+                score = 1
             else:
-                best_match = (entity, type_)
-
-            #if score <= 5:
-            #    if span not in self.common_phrases:
-            #        best_match = (entity, type_)
-            #    else:
-            #        best_match = (span, None)
-            #else:
-            #    best_match = (span, None)
+                score = editdistance.eval(span, c[0]) + 2
+            # Prioritize entity in KB even if we are not sure
+            if not known_kb and c[0] not in kb_entities and c[0] != span:
+                score += 3
+
+            entity_scores.append(c + (score,))
+        return entity_scores
+
+    def _heuristic_match(self, span, candidates, kb_entities, kb_entity_types, known_kb):
+        # Use heuristic scoring system
+        entity_scores = self._heuristic_scores(span, candidates, kb_entities, kb_entity_types, known_kb)
+
+        # Sort entity scores
+        if len(entity_scores) == 0:
+            return (span, None)
+        entity_scores = sorted(entity_scores, key=lambda x: x[2])
+
+        # If exact match or substring match with an entity
+        entity, type_, score = entity_scores[0]
+
+        # Be more cautious when not known_kb; +3 because previous prioritization
+        if score > 8 and not known_kb:
+            best_match = (span, None)
+        elif (score > 5 and len(entity_scores) > 1) or span in self.common_phrases:
+            best_match = (span, None)
         else:
-            # Use learned ranker
-            entity_scores = []
-            for c in candidates:
-                score = self.entity_ranker.score(span, c[0], agent, uuid).squeeze()
-                entity_scores.append(c + (score[0] - score[1],))
+            best_match = (entity, type_)
+        return best_match
 
-            # Where does original span fit into all this? If smaller than some threshold
-            span_score = self.entity_ranker.score(span, span, agent, uuid).squeeze()
+    def _ranker_match(self, span, candidates, agent, uuid):
+        # Use learned ranker; score all candidates and the span itself in one batch
+        scores = self.entity_ranker.score_batch(span, [c[0] for c in candidates] + [span], agent, uuid)
+        scores = scores[:, 0] - scores[:, 1]
+        entity_scores = [c + (score,) for c, score in izip(candidates, scores[:-1])]
 
-            # Sort entity scores
-            entity_scores = sorted(entity_scores, key=lambda x: x[2])
-            best_entity = entity_scores[0][:3]
+        # Where does original span fit into all this? If smaller than some threshold
+        span_score = scores[-1]
 
-            if (span_score[0] - span_score[1]) < best_entity[2]:
-                best_match = (span, None)
-            else:
-                best_match = best_entity[:2]
+        # Sort entity scores
+        entity_scores = sorted(entity_scores, key=lambda x: x[2])
+        best_entity = entity_scores[0][:3]
+
+        if span_score < best_entity[2]:
+            best_match = (span, None)
+        else:
+            best_match = best_entity[:2]
 
         return best_match
 
@@ -298,30 +495,75 @@ class Lexicon(BaseLexicon):
         combined_entity_tokens.extend(cache)
         return combined_entity_tokens
 
-    def link_entity(self, raw_tokens, return_entities=False, agent=1, uuid="NONE", kb=None, mentioned_entities=None, known_kb=True):
+    def _match_span(self, phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, kb_fingerprint, known_kb):
+        if kb_entities is not None:
+            return self.score_and_match(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, known_kb, kb_fingerprint)
+        else:
+            # TODO: Fix default system, if no kb_entities provided -- only returns random candidate now
+            return random.sample(candidate_entities, 1)[0]
+
+    def _link_spans(self, raw_tokens, agent, uuid, kb_entities, kb_entity_types, kb_fingerprint, known_kb, max_span_length=6):
         """
-        Add detected entities to each token
-        Example: ['i', 'work', 'at', 'apple'] => ['i', 'work', 'at', ('apple', ('apple','company'))]
-        Note: Linking works differently here because we are considering intersection of lists across
-        token spans so that "univ of penn" will lookup in our lexicon table for "univ" and "penn"
-        (disregarding stop words and special tokens) and find their intersection
-        :param return_entities: Whether to return entities found in utterance
-        :param agent: Agent (0,1) whose utterance is being linked
-        :param uuid: uuid of scenario being used for testing whether candidate entity is in KB
+        Longest-match linking in one left-to-right pass over raw_tokens.
+        At each position the candidate bitmaps of spans of increasing length are
+        computed incrementally (stop words are skipped except for the first token),
+        then spans are tried from the longest non-empty one down. The bitmaps only
+        tell which spans have candidates; the candidates that are scored are listed
+        by _span_candidates, in the same order as in _link_spans_by_lookup.
+        :return: (linked tokens, found entities)
         """
-        if kb is not None:
-            kb_entities = kb.entity_set
-            if mentioned_entities is not None:
-                kb_entities = kb_entities.union(mentioned_entities)
-            kb_entity_types = kb.entity_type_set
-        else:
-            kb_entities = None
-            kb_entity_types = None
+        phrase_bitmaps = self.link_index[0]
+        stop_words = self.span_stop_words
+        bitmaps = [phrase_bitmaps.get(token, 0) for token in raw_tokens]
+        n = len(raw_tokens)
+        i = 0
+        found_entities = []
+        linked = []
+        while i < n:
+            span_bitmaps = [bitmaps[i]]
+            for j in xrange(i + 1, min(i + max_span_length, n)):
+                bitmap = span_bitmaps[-1]
+                if raw_tokens[j] not in stop_words:
+                    bitmap &= bitmaps[j]
+                if not bitmap:
+                    break
+                span_bitmaps.append(bitmap)
+
+            matched = False
+            for l in xrange(len(span_bitmaps), 0, -1):
+                # Single character token so disregard candidate entities.
+                # The last token is exempt: _link_spans_by_lookup has already tried it
+                # as a truncated longer span.
+                if l == 1 and len(raw_tokens[i]) == 1 and i + 1 < n:
+                    break
+                if not span_bitmaps[l-1]:
+                    continue
+                raw = tuple(raw_tokens[i:i+l])
+                phrase = ' '.join(raw)
+                candidate_entities = self._span_candidates(raw)
+                best_match = self._match_span(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, kb_fingerprint, known_kb)
+                # If best_match is entity from KB add to list
+                if best_match[1] is not None:
+                    # Return as (surface form, (canonical, type))
+                    linked.append((phrase, best_match))
+                    found_entities.append((phrase, best_match))
+                    i += l
+                    matched = True
+                    break
 
+            if not matched:
+                linked.append(raw_tokens[i])
+                i += 1
+        return linked, found_entities
+
+    def _link_spans_by_lookup(self, raw_tokens, agent, uuid, kb_entities, kb_entity_types, kb_fingerprint, known_kb):
+        """
+        Reference implementation of _link_spans that looks up and intersects the
+        candidates of every span. Slow; kept to check the index against.
+        """
         i = 0
         found_entities = []
         linked = []
-        stop_words = set(['of'])
         while i < len(raw_tokens):
             candidate_entities = None
             single_char = False
@@ -330,11 +572,7 @@ class Lexicon(BaseLexicon):
                 phrase = ' '.join(raw_tokens[i:i+l])
                 raw = raw_tokens[i:i+l]
 
-                for idx, token in enumerate(raw):
-                    results = self.lookup(token)
-                    if idx == 0: candidate_entities = results
-                    if token not in stop_words:
-                        candidate_entities = list(set(candidate_entities).intersection(set(results)))
+                candidate_entities = self._lookup_candidates(raw)
 
                 # Single character token so disregard candidate entities
                 if l == 1 and len(phrase) == 1:
@@ -343,11 +581,7 @@ class Lexicon(BaseLexicon):
 
                 # Found some match
                 if len(candidate_entities) > 0:
-                    if kb_entities is not None:
-                        best_match = self.score_and_match(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, known_kb)
-                    else:
-                        # TODO: Fix default system, if no kb_entities provided -- only returns random candidate now
-                        best_match = random.sample(candidate_entities, 1)[0]
+                    best_match = self._match_span(phrase, candidate_entities, agent, uuid, kb_entities, kb_entity_types, kb_fingerprint, known_kb)
                     # If best_match is entity from KB add to list
                     if best_match[1] is not None:
                         # Return as (surface form, (canonical, type))
@@ -367,6 +601,38 @@ class Lexicon(BaseLexicon):
                 linked.append(raw_tokens[i])
                 i += 1
 
+        return linked, found_entities
+
+    def link_entity(self, raw_tokens, return_entities=False, agent=1, uuid="NONE", kb=None, mentioned_entities=None, known_kb=True, use_index=True):
+        """
+        Add detected entities to each token
+        Example: ['i', 'work', 'at', 'apple'] => ['i', 'work', 'at', ('apple', ('apple','company'))]
+        Note: Linking works differently here because we are considering intersection of lists across
+        token spans so that "univ of penn" will lookup in our lexicon table for "univ" and "penn"
+        (disregarding stop words and special tokens) and find their intersection
+        :param return_entities: Whether to return entities found in utterance
+        :param agent: Agent (0,1) whose utterance is being linked
+        :param uuid: uuid of scenario being used for testing whether candidate entity is in KB
+        :param use_index: If False, use the (slow) reference linker instead of the bitmap index
+        """
+        if kb is not None:
+            kb_entities, kb_entity_types, kb_fingerprint = self.kb_info(kb)
+            if mentioned_entities:
+                # Only mentioned entities not in the KB change the memo key
+                mentioned = frozenset(e for e in mentioned_entities if e not in kb_entities)
+                if mentioned:
+                    kb_entities = kb_entities.union(mentioned)
+                    kb_fingerprint = (kb_fingerprint, mentioned)
+        else:
+            kb_entities = None
+            kb_entity_types = None
+            kb_fingerprint = None
+
+        if use_index:
+            linked, found_entities = self._link_spans(raw_tokens, agent, uuid, kb_entities, kb_entity_types, kb_fingerprint, known_kb)
+        else:
+            linked, found_entities = self._link_spans_by_lookup(raw_tokens, agent, uuid, kb_entities, kb_entity_types, kb_fingerprint, known_kb)
+
         linked = self.combine_repeated_entity(linked)
 
         # Convert to Entity
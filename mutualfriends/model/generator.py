@@ -1,23 +1,22 @@
 from collections import defaultdict
-import numpy as np
 from cocoa.model.generator import Templates as BaseTemplates, Generator as BaseGenerator
 from core.tokenizer import detokenize
 
 class Generator(BaseGenerator):
     def get_filter(self, used_templates=None, signature=None, context_tag=None, tag=None, **kwargs):
-        locs = [super(Generator, self).get_filter(used_templates)]
+        constraints = []
         if signature:
-            self._add_filter(locs, self.templates.signature == signature)
-            # signature must be satisfied
-            if np.sum(locs[-1]) == 0:
-                print 'no signature=', signature
-                return None
+            constraints.append(('signature', signature))
         if tag:
             print 'tag=', tag
-            self._add_filter(locs, self.templates.tag == tag)
+            constraints.append(('tag', tag))
         if context_tag:
-            self._add_filter(locs, self.templates.context_tag == context_tag)
-        return self._select_filter(locs)
+            constraints.append(('context_tag', context_tag))
+        # signature must be satisfied
+        selected = self._select_filter(used_templates, constraints, required=1 if signature else 0)
+        if selected is None:
+            print 'no signature=', signature
+        return selected
 
 class Templates(BaseTemplates):
     def _get_entities(self, template):
@@ -1,6 +1,7 @@
-from collections import defaultdict
+import weakref
+from collections import defaultdict, namedtuple
 import numpy as np
-from itertools import izip, islice, chain, repeat
+from itertools import izip, islice, chain, repeat, count
 from cocoa.model.vocab import Vocabulary
 from cocoa.core.entity import is_entity
 from graph_embedder_config import GraphEmbedderConfig
@@ -75,6 +76,14 @@ class GraphBatch(object):
     def __init__(self, graphs):
         self.graphs = graphs
         self.batch_size = len(graphs)
+        # Padded node data and paths are allocated once and then updated in place
+        # with nodes added to each graph since the last call; see _batch_node_data.
+        self._node_data = None
+        self._paths = None
+        # (reset_id, number of nodes) of each graph in self._node_data
+        self._filled_nodes = [None] * self.batch_size
+        # reset_id of each graph in self._paths
+        self._filled_paths = [None] * self.batch_size
 
     def _max_num_nodes(self):
         return max([graph.nodes.size for graph in self.graphs])
@@ -83,39 +92,91 @@ class GraphBatch(object):
         return max([graph.paths.shape[0] for graph in self.graphs])
 
     def _max_num_paths_per_node(self):
-        return max([max([paths.shape[0] for paths in graph.node_paths]) for graph in self.graphs])
-
-    def _make_batch(self, shape, fill_value, dtype, attr):
-        batch_data = np.full(shape, fill_value, dtype=dtype)
-        for i, graph in enumerate(self.graphs):
-            data = getattr(graph, attr)
-            batch_data[i][:data.shape[0]] = data
-        return batch_data
-
-    def _batch_node_ids(self, max_num_nodes):
-        return self._make_batch((self.batch_size, max_num_nodes), Graph.metadata.NODE_PAD, np.int32, 'node_ids')
-
-    def _batch_mask(self, max_num_nodes):
-        mask = np.full((self.batch_size, max_num_nodes), False, dtype=np.bool)
+        return max([graph.max_num_paths_per_node for graph in self.graphs])
+
+    def _resize(self, old, shape, fill_value):
+        new = np.full(shape, fill_value, dtype=old.dtype)
+        overlap = tuple(slice(0, min(m, n)) for m, n in izip(old.shape, shape))
+        new[overlap] = old[overlap]
+        return new
+
+    def _allocate_node_data(self, max_num_nodes, max_num_paths_per_node):
+        metadata = Graph.metadata
+        shapes = {
+                'node_ids': ((self.batch_size, max_num_nodes), metadata.NODE_PAD, np.int32),
+                'mask': ((self.batch_size, max_num_nodes), False, np.bool),
+                'entity_ids': ((self.batch_size, max_num_nodes), metadata.ENTITY_PAD, np.int32),
+                'node_paths': ((self.batch_size, max_num_nodes, max_num_paths_per_node), metadata.PAD_PATH_ID, np.int32),
+                'node_feats': ((self.batch_size, max_num_nodes, metadata.feat_size), 0, np.float32),
+                }
+        if self._node_data is None:
+            self._node_data = {k: np.full(shape, fill_value, dtype=dtype)
+                    for k, (shape, fill_value, dtype) in shapes.iteritems()}
+        elif self._node_data['node_paths'].shape != shapes['node_paths'][0]:
+            # Keep data of nodes that are already filled
+            self._node_data = {k: self._resize(self._node_data[k], shape, fill_value)
+                    for k, (shape, fill_value, dtype) in shapes.iteritems()}
+            for i, filled in enumerate(self._filled_nodes):
+                if filled is not None and filled[1] > max_num_nodes:
+                    self._filled_nodes[i] = None
+
+    def _fill_node_data(self, i, graph, start):
+        '''
+        Copy data of nodes [start:] of graph to row i.
+        '''
+        data = self._node_data
+        n = graph.nodes.size
+        if start == 0:
+            # Clear data of the previous dialogue
+            metadata = Graph.metadata
+            data['node_ids'][i] = metadata.NODE_PAD
+            data['mask'][i] = False
+            data['entity_ids'][i] = metadata.ENTITY_PAD
+            data['node_paths'][i] = metadata.PAD_PATH_ID
+            data['node_feats'][i] = 0
+        data['node_ids'][i, start:n] = graph.node_ids[start:n]
+        data['mask'][i, start:n] = True
+        data['entity_ids'][i, start:n] = graph.entity_ids[start:n]
+        data['node_feats'][i, start:n] = graph.feats[start:n]
+        node_paths = graph.node_paths[start:n]
+        lengths = np.array([len(paths) for paths in node_paths], dtype=np.int32)
+        if lengths.sum() > 0:
+            mask = np.arange(data['node_paths'].shape[2]) < lengths[:, np.newaxis]
+            data['node_paths'][i, start:n][mask] = np.concatenate(node_paths)
+
+    def _batch_node_data(self, max_num_nodes, max_num_paths_per_node):
+        '''
+        Padded node_ids, mask, entity_ids, node_paths and node_feats. Only nodes added
+        since the last call (or all nodes of a graph that has been reset) are copied.
+        '''
+        self._allocate_node_data(max_num_nodes, max_num_paths_per_node)
         for i, graph in enumerate(self.graphs):
-            mask[i][:len(graph.node_ids)] = True
-        return mask
-
-    def _batch_entity_ids(self, max_num_nodes):
-        return self._make_batch((self.batch_size, max_num_nodes), Graph.metadata.ENTITY_PAD, np.int32, 'entity_ids')
+            n = graph.nodes.size
+            filled = self._filled_nodes[i]
+            if filled is None or filled[0] != graph.reset_id or filled[1] > n:
+                start = 0
+            else:
+                start = filled[1]
+            if start < n or filled is None:
+                self._fill_node_data(i, graph, start)
+            self._filled_nodes[i] = (graph.reset_id, n)
+        return self._node_data
 
     def _batch_paths(self, max_num_paths):
-        return self._make_batch((self.batch_size, max_num_paths, 3), 0, np.int32, 'paths')
-
-    def _batch_node_paths(self, max_num_nodes, max_num_paths_per_node):
-        batch_data = np.full((self.batch_size, max_num_nodes, max_num_paths_per_node), Graph.metadata.PAD_PATH_ID, dtype=np.int32)
+        '''
+        Paths only change when a graph is reset.
+        '''
+        shape = (self.batch_size, max_num_paths, 3)
+        if self._paths is None or self._paths.shape != shape:
+            self._paths = np.zeros(shape, dtype=np.int32)
+            self._filled_paths = [None] * self.batch_size
         for i, graph in enumerate(self.graphs):
-            for j, node_path in enumerate(graph.node_paths):
-                batch_data[i][j][:len(node_path)] = node_path
-        return batch_data
-
-    def _batch_node_feats(self, max_num_nodes):
-        return self._make_batch((self.batch_size, max_num_nodes, Graph.metadata.feat_size), 0, np.float32, 'feats')
+            if self._filled_paths[i] != graph.reset_id:
+                paths = graph.paths
+                self._paths[i, :paths.shape[0]] = paths
+                self._paths[i, paths.shape[0]:] = 0
+                self._filled_paths[i] = graph.reset_id
+        return self._paths
 
     def update_entities(self, tokens, stage=None):
         assert len(tokens) == self.batch_size
@@ -212,16 +273,18 @@ class GraphBatch(object):
         Return entity_mask and node_ids.
         '''
         node_ids = np.full(entities.shape, -1, dtype=np.int32)
-        graph_iter = chain.from_iterable((repeat(graph, entities.shape[1]) for graph in self.graphs))
-        for entity_id, node_id, graph in izip(np.nditer(entities), np.nditer(node_ids, op_flags=['readwrite']), graph_iter):
-            entity_id = entity_id[()]
-            if entity_id != -1:
-                try:
-                    # [()]: entity_id is a 0-dim ndarray
-                    node_id[...] = graph.nodes.to_ind(Graph.metadata.entity_map.to_word(entity_id))
-                except KeyError:
-                    # A padded node is predicted and the entity is <unk>
-                    pass
+        for i, graph in enumerate(self.graphs):
+            # Look up each distinct entity once
+            entity_ids, inds = np.unique(entities[i], return_inverse=True)
+            entity_node_ids = np.full(entity_ids.shape, -1, dtype=np.int32)
+            for j, entity_id in enumerate(entity_ids):
+                if entity_id != -1:
+                    try:
+                        entity_node_ids[j] = graph.nodes.to_ind(Graph.metadata.entity_map.to_word(entity_id))
+                    except KeyError:
+                        # A padded node is predicted and the entity is <unk>
+                        pass
+            node_ids[i] = entity_node_ids[inds]
         return node_ids
 
     def _pred_to_node_id(self, preds, offset):
@@ -237,6 +300,8 @@ class GraphBatch(object):
         - At the beginning of a dialogue, provide zero utterance matrices; during the dialogue
           we will get updated utterance matrices from GraphEmbedder.
         - node_ids, entity_ids, paths, node_paths, node_feats
+        Returned arrays are copies of the persistent padded arrays, so results of
+        earlier calls are not changed by later calls.
         '''
         encoder_entity_lists = self.update_graph(encoder_tokens, stage='encoding')
         decoder_entity_lists = self.update_graph(decoder_tokens, stage='decoding')
@@ -254,25 +319,29 @@ class GraphBatch(object):
         # TODO: entities -> update_entities
         # *_nodes: for looking up entity embeddings
         batch = {
-                 'node_ids': self._batch_node_ids(max_num_nodes),
-                 'mask': self._batch_mask(max_num_nodes),
-                 'entity_ids': self._batch_entity_ids(max_num_nodes),
-                 'paths': self._batch_paths(max_num_paths),
-                 'node_paths': self._batch_node_paths(max_num_nodes, max_num_paths_per_node),
-                 'node_feats': self._batch_node_feats(max_num_nodes),
+                 'paths': self._batch_paths(max_num_paths).copy(),
                  'utterances': utterances,
                  'encoder_entities': self._batch_entity_lists(encoder_entity_lists, self.pad_utterance_id),
                  'decoder_entities': self._batch_entity_lists(decoder_entity_lists, self.pad_utterance_id),
                  'encoder_nodes': None if encoder_entities is None else self._entity_to_node_id(encoder_entities),
                  'decoder_nodes': None if decoder_entities is None else self._entity_to_node_id(decoder_entities),
                 }
+        for k, v in self._batch_node_data(max_num_nodes, max_num_paths_per_node).iteritems():
+            batch[k] = v.copy()
         return batch
 
+# KB part of a Graph, shared by graphs of the same KB
+KBGraph = namedtuple('KBGraph', ['metadata', 'nodes', 'entity_ids', 'paths', 'feats', 'node_paths', 'max_num_paths_per_node'])
+
 class Graph(object):
     '''
     Maintain a (dynamic) knowledge graph of the agent.
     '''
     metadata = None
+    # KB -> KBGraph
+    kb_cache = weakref.WeakKeyDictionary()
+    # Identifies each reset so that GraphBatch knows when to refill a graph's data
+    reset_ids = count()
 
     def __init__(self, kb):
         assert Graph.metadata is not None
@@ -284,32 +353,60 @@ class Graph(object):
         Clear all information from dialogue history and only keep KB information.
         This is required during training when we go through one dialogue multiple times.
         '''
+        kb_graph = Graph.kb_cache.get(self.kb)
+        if kb_graph is None or kb_graph.metadata is not Graph.metadata:
+            kb_graph = self._build_kb_graph()
+            Graph.kb_cache[self.kb] = kb_graph
+
         # Map each node in the graph to an integer
         self.nodes = Vocabulary(unk=False)
+        self.nodes.add_words(kb_graph.nodes)
+        self.num_items = len(self.kb.items)
+
+        # Input data to feed_dict. Arrays are shared with the cache and are only
+        # replaced (never modified) when new entities are added.
+        self.node_ids = np.arange(self.nodes.size, dtype=np.int32)
+        self.entity_ids = kb_graph.entity_ids
         # All paths in the KB; each path is a 3-tuple (node_id, edge_id, node_id)
         # NOTE: The first path is always a padding path
+        self.paths = kb_graph.paths
+        self.feats = kb_graph.feats
+        self.node_paths = list(kb_graph.node_paths)
+        self.max_num_paths_per_node = kb_graph.max_num_paths_per_node
+        self.reset_id = next(Graph.reset_ids)
+
+        # Entity/token sequence in the dialogue
+        self.entities = []
+
+    def _build_kb_graph(self):
+        '''
+        Construct the KB part of the graph, which does not change during a dialogue.
+        '''
+        self.nodes = Vocabulary(unk=False)
         self.paths = [Graph.metadata.PATH_PAD]
         # Read information form KB to fill in nodes and paths
         self.num_items = len(self.kb.items)
         self.load_kb(self.kb)
 
-        # Input data to feed_dict
+        nodes = [self.nodes.to_word(i) for i in xrange(self.nodes.size)]
         self.node_ids = np.arange(self.nodes.size, dtype=np.int32)
-        self.entity_ids = np.array([Graph.metadata.entity_map.to_ind(self.nodes.to_word(i)) for i in xrange(self.nodes.size)], dtype=np.int32)
-        self.paths = np.array(self.paths, dtype=np.int32)
-        self.feats = self.get_features()
-        self.node_paths = self.get_node_paths()
-
-        # Entity/token sequence in the dialogue
-        self.entities = []
+        entity_ids = np.array([Graph.metadata.entity_map.to_ind(node) for node in nodes], dtype=np.int32)
+        node_paths = self.get_node_paths()
+        max_num_paths_per_node = max([paths.shape[0] for paths in node_paths])
+        kb_graph = KBGraph(Graph.metadata, nodes, entity_ids, self.paths, self.get_features(), node_paths, max_num_paths_per_node)
+        for array in chain([kb_graph.entity_ids, kb_graph.paths, kb_graph.feats], kb_graph.node_paths):
+            array.flags.writeable = False
+        return kb_graph
 
     def get_node_paths(self):
-        node_paths = []
-        for node_id in self.node_ids:
-            # Skip the first padding path
-            paths = [path_id for path_id, path in enumerate(self.paths) if path_id != Graph.metadata.PAD_PATH_ID and path[0] == node_id]
-            node_paths.append(np.array(paths, dtype=np.int32))
-        return node_paths
+        '''
+        Ids of paths starting from each node, from a CSR view of self.paths.
+        '''
+        # Skip the first padding path
+        sources = self.paths[1:, 0]
+        path_ids = np.argsort(sources, kind='mergesort').astype(np.int32) + 1
+        counts = np.bincount(sources, minlength=self.nodes.size)
+        return np.split(path_ids, np.cumsum(counts)[:-1])
 
     def get_input_data(self):
         '''
@@ -392,6 +489,7 @@ class Graph(object):
         '''
         for _ in entities:
             self.node_paths.append(np.array([Graph.metadata.PAD_PATH_ID]))
+        self.max_num_paths_per_node = max(self.max_num_paths_per_node, 1)
 
     def add_entity_nodes(self, entities):
         # Paths do not change, no need to update
@@ -426,54 +524,51 @@ class Graph(object):
 
     def get_features(self):
         nodes = [self.nodes.to_word(i) for i in xrange(self.nodes.size)]
+        # Degree of each node (number of paths starting from it)
+        degrees = np.bincount(self.paths[:, 0], minlength=len(nodes))
         # For entity node, -1 degree so that it excludes the edge incident to the attr node
-        feats = [[0, self._node_type(node)] if node[1] == 'item' or node[1] == 'attr'
-                else [-1, self._node_type(node)] for node in nodes]
-        # Compute degree of each node
-        for path in self.paths:
-            n1, r, n2 = path
-            feats[n1][0] += 1
-        return self.get_feat_vec(feats)
+        degrees -= np.array([0 if node[1] == 'item' or node[1] == 'attr' else 1 for node in nodes], dtype=degrees.dtype)
+        return self._feat_vec(degrees, [self._node_type(node) for node in nodes])
 
     @classmethod
     def degree_feat_size(cls):
         return 6
 
-    def _bin_degree(self, degree):
-        # NOTE: we consider degree only for attr and entity nodes (only count edges connected
-        # to item nodes).
-        assert degree <= self.num_items
-        p = degree / float(self.num_items)
-        if p == 0:
-            return 0
-        if p < 0.25:
-            return 1
-        if p >= 0.25 and p < 0.5:
-            return 2
-        if p >= 0.5 and p < 0.75:
-            return 3
-        if p >= 0.75 and p < 1:
-            return 4
-        if p == 1:
-            return 5
-
     def _get_index(self, feat_name, feat_value):
         offset, size = Graph.metadata.feat_inds[feat_name]
-        assert feat_value < size
+        assert np.all(feat_value < size)
         return offset + feat_value
 
+    def _bin_degrees(self, degrees):
+        '''
+        Bin degree / num_items into 0, (0, 0.25), [0.25, 0.5), [0.5, 0.75), [0.75, 1), 1.
+        NOTE: we consider degree only for attr and entity nodes (only count edges connected
+        to item nodes).
+        '''
+        assert np.all(degrees <= self.num_items)
+        p = degrees / float(self.num_items)
+        bins = np.searchsorted([0.25, 0.5, 0.75, 1.], p, side='right') + 1
+        bins[p == 0] = 0
+        return bins
+
+    def _feat_vec(self, degrees, node_types):
+        n = len(node_types)
+        f = np.zeros([n, Graph.metadata.feat_size])
+        if n == 0:
+            return f
+        degrees = np.asarray(degrees)
+        # Don't consider degree of item nodes (number of attrs, same for all items)
+        has_degree = np.array([not node_type.startswith('item') for node_type in node_types], dtype=np.bool)
+        rows = np.arange(n)[has_degree]
+        f[rows, self._get_index('rel_degree', self._bin_degrees(degrees[has_degree]))] = 1
+        f[rows, self._get_index('degree', degrees[has_degree])] = 1
+        type_ids = np.array([Graph.metadata.node_types.to_ind(node_type) for node_type in node_types])
+        f[np.arange(n), self._get_index('node_type', type_ids)] = 1
+        return f
+
     def get_feat_vec(self, raw_feats):
         '''
         Input: a list of features [degree, node_type] for each node
         Output: one-hot encoded numpy feature matrix
         '''
-        f = np.zeros([len(raw_feats), Graph.metadata.feat_size])
-
-        for i, (degree, node_type) in enumerate(raw_feats):
-            # Don't consider degree of item nodes (number of attrs, same for all items)
-            if not node_type.startswith('item'):
-                f[i][self._get_index('rel_degree', self._bin_degree(degree))] = 1
-                f[i][self._get_index('degree', degree)] = 1
-            f[i][self._get_index('node_type', Graph.metadata.node_types.to_ind(node_type))] = 1
-
-        return f
+        return self._feat_vec([degree for degree, _ in raw_feats], [node_type for _, node_type in raw_feats])
@@ -55,7 +55,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     schema = Schema(args.schema_path)
-    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_path=args.lexicon)
+    lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_path=args.lexicon, cache=args.lexicon_cache, num_workers=args.lexicon_workers)
     examples = read_examples(args.transcripts, args.max_examples, Scenario)
     parsed_dialogues = []
     templates = Templates()
@@ -22,7 +22,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     schema = Schema(args.schema_path)
-    lexicon = Lexicon(schema, False, stop_words=args.stop_words, lexicon_path=args.lexicon)
+    lexicon = Lexicon(schema, False, stop_words=args.stop_words, lexicon_path=args.lexicon, cache=args.lexicon_cache, num_workers=args.lexicon_workers)
     #templates = Templates.from_pickle(args.templates)
     templates = Templates()
     manager = Manager.from_pickle(args.policy)
@@ -0,0 +1,235 @@
+'''
+Parity test of the entity linker (Lexicon.link_entity, with and without the
+bitmap index) against a frozen copy of the rule-based linker it replaced
+(baseline_link_entity below) on MutualFriends transcripts. The linkers are also
+run on a copy of the lexicon in reverse order, since the candidate ids of the
+index follow the lexicon order. Exits with status 1 if any utterance is linked
+differently; also compares the speed of the linkers.
+'''
+import argparse
+import random
+import re
+import sys
+import time
+from collections import OrderedDict
+
+import editdistance
+
+from cocoa.core.schema import Schema
+from cocoa.core.dataset import read_examples
+from cocoa.core.entity import Entity
+
+from core.scenario import Scenario
+from core.lexicon import Lexicon, add_lexicon_arguments
+from core.tokenizer import tokenize
+
+########### Frozen copy of the baseline linker; do not change ###########
+
+def baseline_score_and_match(lexicon, span, candidates, kb_entities, kb_entity_types, known_kb=True):
+    entity_scores = []
+    for c in candidates:
+        # Clean up punctuation
+        c_s = re.sub("-", " ", c[0])
+        span_tokens = span.split()
+        entity_tokens = c_s.split()
+
+        ed = editdistance.eval(span, c[0])
+        # Filter false positives
+        if c[1] not in kb_entity_types:
+            continue
+
+        def is_stopwords():
+            if span == c[0]:
+                return False
+            if len(span_tokens) == 1 and span in lexicon.stop_words:
+                return True
+            if span_tokens[0] in ('and', 'or', 'to', 'from', 'of', 'in', 'at'):
+                return True
+            all_stop = True
+            for x in span_tokens:
+                if x not in lexicon.stop_words:
+                    all_stop = False
+                    break
+            if all_stop:
+                return True
+            return False
+
+        if is_stopwords():
+            continue
+        if len(span_tokens) > len(entity_tokens):
+            continue
+        if c[0] not in kb_entities and known_kb:
+            # Prioritize exact match
+            if c[0] == span:
+                score = 0
+            else:
+                continue
+        elif span in entity_tokens:
+            score = 0
+        # Prioritize multi phrase spans contained in entity
+        elif len(span_tokens) > 1 and span in c_s:
+            score = 1
+        else:
+            score = ed + 2
+        # Prioritize entity in KB even if we are not sure
+        if not known_kb and c[0] not in kb_entities and c[0] != span:
+            score += 3
+
+        entity_scores.append(c + (score,))
+
+    # Sort entity scores
+    if len(entity_scores) == 0:
+        return (span, None)
+    entity_scores = sorted(entity_scores, key=lambda x: x[2])
+
+    # If exact match or substring match with an entity
+    entity, type_, score = entity_scores[0]
+
+    # Be more cautious when not known_kb; +3 because previous prioritization
+    if score > 8 and not known_kb:
+        best_match = (span, None)
+    elif (score > 5 and len(entity_scores) > 1) or span in lexicon.common_phrases:
+        best_match = (span, None)
+    else:
+        best_match = (entity, type_)
+    return best_match
+
+def baseline_combine_repeated_entity(entity_tokens):
+    is_entity = lambda x: not isinstance(x, basestring)
+    prev_entity = None
+    max_dist = 1
+    cache = []
+    combined_entity_tokens = []
+    for i, token in enumerate(entity_tokens):
+        if is_entity(token):
+            if prev_entity is not None and token[0] != prev_entity[0] and token[1] == prev_entity[1] and (len(cache) <= max_dist):
+                surface = '%s %s %s' % (prev_entity[0], ' '.join(cache), token[0])
+                combined_entity_tokens[-1] = (surface, prev_entity[1])
+            else:
+                combined_entity_tokens.extend(cache)
+                combined_entity_tokens.append(token)
+            prev_entity = token
+            cache = []
+        elif prev_entity is None:
+            combined_entity_tokens.append(token)
+        else:
+            cache.append(token)
+    combined_entity_tokens.extend(cache)
+    return combined_entity_tokens
+
+def baseline_link_entity(lexicon, raw_tokens, kb=None, mentioned_entities=None, known_kb=True):
+    if kb is not None:
+        kb_entities = kb.entity_set
+        if mentioned_entities is not None:
+            kb_entities = kb_entities.union(mentioned_entities)
+        kb_entity_types = kb.entity_type_set
+    else:
+        kb_entities = None
+        kb_entity_types = None
+
+    i = 0
+    linked = []
+    stop_words = set(['of'])
+    while i < len(raw_tokens):
+        candidate_entities = None
+        single_char = False
+        # Find longest phrase (if any) that matches an entity
+        for l in range(6, 0, -1):
+            phrase = ' '.join(raw_tokens[i:i+l])
+            raw = raw_tokens[i:i+l]
+
+            for idx, token in enumerate(raw):
+                results = lexicon.lookup(token)
+                if idx == 0: candidate_entities = results
+                if token not in stop_words:
+                    candidate_entities = list(set(candidate_entities).intersection(set(results)))
+
+            # Single character token so disregard candidate entities
+            if l == 1 and len(phrase) == 1:
+                single_char = True
+                break
+
+            # Found some match
+            if len(candidate_entities) > 0:
+                if kb_entities is not None:
+                    best_match = baseline_score_and_match(lexicon, phrase, candidate_entities, kb_entities, kb_entity_types, known_kb)
+                else:
+                    best_match = random.sample(candidate_entities, 1)[0]
+                # If best_match is entity from KB add to list
+                if best_match[1] is not None:
+                    # Return as (surface form, (canonical, type))
+                    linked.append((phrase, best_match))
+                    i += l
+                    break
+                else:
+                    candidate_entities = None
+                    continue
+
+        if not candidate_entities or single_char:
+            linked.append(raw_tokens[i])
+            i += 1
+
+    linked = baseline_combine_repeated_entity(linked)
+
+    # Convert to Entity
+    return [Entity.from_elements(x[0], x[1][0], x[1][1]) if not isinstance(x, basestring) else x for x in linked]
+
+#########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transcripts', nargs='*', help='JSON transcripts')
+    parser.add_argument('--max-examples', default=-1, type=int)
+    parser.add_argument('--schema-path', help='Path to schema')
+    parser.add_argument('--verbose', default=False, action='store_true', help='Print mismatches')
+    add_lexicon_arguments(parser)
+    args = parser.parse_args()
+
+    schema = Schema(args.schema_path)
+    lexicon = Lexicon(schema, False, stop_words=args.stop_words, lexicon_path=args.lexicon, cache=args.lexicon_cache, num_workers=args.lexicon_workers)
+    examples = read_examples(args.transcripts, args.max_examples, Scenario)
+
+    utterances = []
+    for example in examples:
+        for event in example.events:
+            if event.action == 'message' and event.data:
+                kb = example.scenario.get_kb(event.agent)
+                utterances.append((tokenize(event.data), kb))
+
+    # Same lexicon with phrases and candidates in reverse order
+    reversed_lexicon = Lexicon(schema, False, stop_words=args.stop_words, lexicon_path=None, cache=None)
+    reversed_lexicon.lexicon = OrderedDict((phrase, candidates[::-1])
+            for phrase, candidates in reversed(lexicon.lexicon.items()))
+
+    num_mismatch = 0
+    for lexicon_name, lex in (('lexicon', lexicon), ('reversed lexicon', reversed_lexicon)):
+        # Build the index before timing
+        lex.link_index
+
+        start = time.time()
+        reference = [baseline_link_entity(lex, tokens, kb=kb) for tokens, kb in utterances]
+        times = {'baseline': time.time() - start}
+        for name, use_index in (('lookup', False), ('indexed', True)):
+            # Time the linkers without matches memoized by the previous run
+            lex.match_cache.clear()
+            lex.span_cache.clear()
+            start = time.time()
+            outputs = [lex.link_entity(tokens, kb=kb, use_index=use_index) for tokens, kb in utterances]
+            times[name] = time.time() - start
+
+            n = 0
+            for (tokens, _), ref, linked in zip(utterances, reference, outputs):
+                if ref != linked:
+                    n += 1
+                    if args.verbose:
+                        print 'tokens:', tokens
+                        print 'baseline:', ref
+                        print '{}:'.format(name), linked
+                        print '-'*10
+            print '{} linker ({}): {} utterances, {} mismatches'.format(name, lexicon_name, len(utterances), n)
+            num_mismatch += n
+        print '{}: baseline linker: {:.2f}s, lookup linker: {:.2f}s, indexed linker: {:.2f}s'.format(
+                lexicon_name, times['baseline'], times['lookup'], times['indexed'])
+
+    if num_mismatch > 0:
+        sys.exit(1)
@@ -7,6 +7,7 @@ from src.model.vocab import is_entity
 from collections import defaultdict
 from itertools import izip
 from src.model.preprocess import word_to_num
+from cocoa.analysis.statistics import Statistic, compute_statistics
 import random
 import matplotlib
 #import matplotlib.pyplot as plt
@@ -532,45 +533,6 @@ def plot_num_item_stats(item_stats_map, save_path):
     plt.savefig(save_path)
 
 
-def get_cross_talk(all_chats):
-    summary_map = {}
-    is_null = lambda x: x is None or x == 'null'
-    count = 0
-
-    def is_valid(event):
-        if is_null(event.start_time) or event.start_time >= event.time:
-            return False
-        return True
-
-    for chat in all_chats:
-        if chat["outcome"] is not None and chat["outcome"]["reward"] == 1:
-            events = [Event.from_dict(e) for e in chat["events"]]
-            for event1, event2 in izip(events, events[1:]):
-                # start_time is not available
-                if not is_valid(event2):
-                    continue
-                sent_time = float(event1.time)
-                start_time = float(event2.start_time)
-                cross_talk = 1 if start_time < sent_time else 0
-                logstats.update_summary_map(summary_map, {'cross_talk': cross_talk})
-
-                if is_valid(event1):
-                    typing_time = float(event1.time) - float(event1.start_time)
-                    assert typing_time > 0
-                    msg_len = len(event1.data)
-                    logstats.update_summary_map(summary_map, {'char_per_sec': msg_len / typing_time})
-
-    try:
-        print 'Char/Sec:', summary_map['char_per_sec']['mean']
-    except KeyError:
-        pass
-    try:
-        return summary_map['cross_talk']['mean']
-    # Cross talk only available for chats with start_time
-    except KeyError:
-        return -1
-
-
 def get_linguistic_template(template_summary_map, utterance):
     if len(utterance) == 0:
         return
@@ -606,157 +568,162 @@ def get_speech_act_histograms(speech_act_sequence_summary_map, dialog, collapsed
     speech_act_sequence_summary_map[k] += 1.
 
 
-def get_average_time_taken(all_chats, scenario_db, alphas=None, num_items=None):
-    total_time_taken = 0.0
-    total_complete = 0.0
-
-    for chat in all_chats:
-        scenario = scenario_db.get(chat["scenario_uuid"])
-        kb = scenario.get_kb(0)
-        items = len(kb.items)
-        if (alphas is not None and tuple(scenario.alphas) == alphas) \
-                or (num_items is not None and items == num_items) \
-                or (alphas is None and num_items is None):
-            if chat["outcome"] is not None and chat["outcome"]["reward"] == 1:
-                events = [Event.from_dict(e) for e in chat["events"]]
-
-                try:
-                    start_time = float(events[0].time)
-                    end_time = float(events[-1].time)
-                    total_time_taken += (end_time - start_time)
-                except ValueError:
-                    print "Error parsing event times: %s, %s" % (events[0].time, events[-1].time)
-
-                total_complete += 1
-    if total_complete == 0:
-        # no complete dialogues for this setting - should never happen with sufficient data
-        print "No complete dialogues for ", alphas
-        return -1.0
-    return total_time_taken / total_complete
-
-
-def get_average_length(all_chats, scenario_db, alphas=None, num_items=None):
-    total_length = 0.0
-    total_sentences = 0.0
-
-    for chat in all_chats:
-        scenario = scenario_db.get(chat["scenario_uuid"])
-        kb = scenario.get_kb(0)
-        items = len(kb.items)
-        if (alphas is not None and tuple(scenario.alphas) == alphas) \
-                or (num_items is not None and items == num_items) \
-                or (alphas is None and num_items is None):
-            if chat["outcome"] is not None and chat["outcome"]["reward"] == 1:
-                events = [Event.from_dict(e) for e in chat["events"]]
-                for e in events:
-                    if e.action == "message":
-                        total_sentences += 1
-                        total_length += len(e.data.split())
-    if total_sentences == 0:
-        # no complete dialogues for this setting - should never happen with sufficient data
-        print "No complete dialogues for (alphas=", alphas, ", items=", num_items, ")"
-        return -1.0
-    return total_length / total_sentences
-
-
-def get_average_sentences(all_chats, scenario_db, alphas=None, num_items=None):
-    total_length = 0.0
-    total_complete = 0.0
-    max_length = 0
-    for chat in all_chats:
-        scenario = scenario_db.get(chat["scenario_uuid"])
-        kb = scenario.get_kb(0)
-        items = len(kb.items)
-        if (alphas is not None and tuple(scenario.alphas) == alphas) \
-                or (num_items is not None and items == num_items) \
-                or (alphas is None and num_items is None):
-            l = len(chat['events'])
-            max_length = max(l, max_length)
-            if chat["outcome"] is not None and chat["outcome"]["reward"] == 1:
-                total_length += l
-                total_complete += 1
-    if total_complete == 0:
-        # no complete dialogues for this setting - should never happen with sufficient data
-        print "No complete dialogues for ", alphas
-        return -1.0
-    return total_length / total_complete
-
-
-def get_turns_vs_completed(all_chats):
-    num_turns_dict = defaultdict(dict)
-    for chat in all_chats:
+def is_complete(chat):
+    return chat["outcome"] is not None and chat["outcome"]["reward"] == 1
+
+
+def parse_events(chat):
+    # Events are parsed once for all statistics
+    chat = dict(chat)
+    chat["events"] = [Event.from_dict(e) for e in chat["events"]]
+    return chat
+
+
+class AverageTimeTaken(Statistic):
+    name = 'avg_time_taken'
+
+    def update(self, chat):
+        if is_complete(chat):
+            events = chat["events"]
+            self.add('complete', 1)
+            try:
+                start_time = float(events[0].time)
+                end_time = float(events[-1].time)
+                self.add('time', end_time - start_time)
+            except ValueError:
+                print "Error parsing event times: %s, %s" % (events[0].time, events[-1].time)
+
+    def result(self):
+        if self.summaries['complete'].count == 0:
+            # no complete dialogues - should never happen with sufficient data
+            print "No complete dialogues"
+            return -1.0
+        return self.summaries['time'].sum / self.summaries['complete'].count
+
+
+class AverageSentences(Statistic):
+    name = 'avg_turns'
+
+    def update(self, chat):
+        if is_complete(chat):
+            self.add('length', len(chat['events']))
+
+    def result(self):
+        if self.summaries['length'].count == 0:
+            print "No complete dialogues"
+            return -1.0
+        return self.summaries['length'].mean
+
+
+class AverageLength(Statistic):
+    name = 'avg_sentence_length'
+
+    def update(self, chat):
+        if is_complete(chat):
+            for e in chat["events"]:
+                if e.action == "message":
+                    self.add('length', len(e.data.split()))
+
+    def result(self):
+        if self.summaries['length'].count == 0:
+            print "No complete dialogues"
+            return -1.0
+        return self.summaries['length'].mean
+
+
+class AverageSelect(Statistic):
+    name = 'avg_select'
+
+    def update(self, chat):
         if chat["outcome"] is not None:
-            num_turns = len(chat['events'])
-            logstats.update_summary_map(num_turns_dict[num_turns],
-                                        {'complete': 1 if chat["outcome"]["reward"] == 1 else 0})
-    return {k: v['complete']['sum'] for k, v in num_turns_dict.iteritems()}
+            self.add('select', len([e for e in chat["events"] if e.action == 'select']))
+
+    def result(self):
+        return self.summaries['select'].mean
+
+
+class TurnsVsCompleted(Statistic):
+    name = 'turns_vs_completed'
+
+    def update(self, chat):
+        if chat["outcome"] is not None:
+            self.add(len(chat['events']), 1 if chat["outcome"]["reward"] == 1 else 0)
+
+    def result(self):
+        return {k: s.sum for k, s in self.summaries.iteritems()}
 
 
-def get_select_vs_completed(all_chats):
-    num_select_dict = defaultdict(dict)
-    for chat in all_chats:
+class SelectVsCompleted(TurnsVsCompleted):
+    name = 'select_vs_completed'
+
+    def update(self, chat):
         if chat["outcome"] is not None:
-            events = [Event.from_dict(e) for e in chat["events"]]
-            num_select = len([e for e in events if e.action == 'select'])
-            logstats.update_summary_map(num_select_dict[num_select],
-                                        {'complete': 1 if chat["outcome"]["reward"] == 1 else 0})
-    return {k: v['complete']['sum'] for k, v in num_select_dict.iteritems()}
+            num_select = len([e for e in chat["events"] if e.action == 'select'])
+            self.add(num_select, 1 if chat["outcome"]["reward"] == 1 else 0)
+
 
+class NumCompleted(Statistic):
+    name = 'num_completed'
 
-def get_average_select(all_chats):
-    num_select = 0
-    num_chat = 0
-    for chat in all_chats:
+    def update(self, chat):
         if chat["outcome"] is not None:
-            events = [Event.from_dict(e) for e in chat["events"]]
-            num_select += len([e for e in events if e.action == 'select'])
-            num_chat += 1
-    return num_select / float(num_chat)
-
-
-def get_num_completed(all_chats, scenario_db, alphas=None, num_items=None):
-    num_complete = 0.0
-    for chat in all_chats:
-        scenario = scenario_db.get(chat["scenario_uuid"])
-        kb = scenario.get_kb(0)
-        items = len(kb.items)
-        if (alphas is not None and tuple(scenario.alphas) == alphas) \
-                or (num_items is not None and items == num_items) \
-                or (alphas is None and num_items is None):
-            if chat["outcome"] is not None:
-                num_complete += 1.0 if chat["outcome"]["reward"] == 1 else 0.0
-
-    return num_complete
-
-
-def get_total(all_chats, scenario_db, alphas=None, num_items=None):
-    if alphas is None and num_items is None:
-        return len(all_chats)
-
-    total = 0.0
-    for chat in all_chats:
-        scenario = scenario_db.get(chat["scenario_uuid"])
-        kb = scenario.get_kb(0)
-        items = len(kb.items)
-        if (alphas is not None and tuple(scenario.alphas) == alphas) \
-                or (num_items is not None and items == num_items):
-            total += 1.0
-
-    return total
-
-
-def get_total_statistics(all_chats, scenario_db):
-    stats = {
-        'avg_time_taken': get_average_time_taken(all_chats, scenario_db),
-        'avg_turns': get_average_sentences(all_chats, scenario_db),
-        'avg_select': get_average_select(all_chats),
-        'turns_vs_completed': get_turns_vs_completed(all_chats),
-        'select_vs_completed': get_select_vs_completed(all_chats),
-        'avg_sentence_length': get_average_length(all_chats, scenario_db),
-        'num_completed': get_num_completed(all_chats, scenario_db),
-        'cross_talk': get_cross_talk(all_chats),
-        'total': get_total(all_chats, scenario_db)
-    }
+            self.add('complete', 1.0 if chat["outcome"]["reward"] == 1 else 0.0)
+
+    def result(self):
+        return self.summaries['complete'].sum
+
+
+class CrossTalk(Statistic):
+    name = 'cross_talk'
+
+    @classmethod
+    def is_valid(cls, event):
+        if event.start_time is None or event.start_time == 'null' or event.start_time >= event.time:
+            return False
+        return True
+
+    def update(self, chat):
+        if is_complete(chat):
+            events = chat["events"]
+            for event1, event2 in izip(events, events[1:]):
+                # start_time is not available
+                if not self.is_valid(event2):
+                    continue
+                sent_time = float(event1.time)
+                start_time = float(event2.start_time)
+                self.add('cross_talk', 1 if start_time < sent_time else 0)
+
+                if self.is_valid(event1):
+                    typing_time = float(event1.time) - float(event1.start_time)
+                    assert typing_time > 0
+                    self.add('char_per_sec', len(event1.data) / typing_time)
+
+    def result(self):
+        if 'char_per_sec' in self.summaries:
+            print 'Char/Sec:', self.summaries['char_per_sec'].mean
+        # Cross talk only available for chats with start_time
+        if 'cross_talk' not in self.summaries:
+            return -1
+        return self.summaries['cross_talk'].mean
+
+
+class Total(Statistic):
+    name = 'total'
+
+    def update(self, chat):
+        self.add('chat', 1)
+
+    def result(self):
+        return self.summaries['chat'].count
+
+
+def get_total_statistics(all_chats, scenario_db, num_workers=1):
+    """
+    Compute all statistics in one pass over `all_chats` (possibly a stream).
+    """
+    statistics = [AverageTimeTaken(), AverageSentences(), AverageSelect(), TurnsVsCompleted(), SelectVsCompleted(),
+                  AverageLength(), NumCompleted(), CrossTalk(), Total()]
+    stats = compute_statistics(statistics, all_chats, preprocess=parse_events, num_workers=num_workers)
     total = float(stats['total'])
     for t in stats['turns_vs_completed']:
         stats['turns_vs_completed'][t] /= total
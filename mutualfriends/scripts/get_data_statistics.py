@@ -22,6 +22,7 @@ def add_statistics_arguments(parser):
                         help='If provided, plots the relationship between alpha values and'
                              'strategy stats to the provided path.')
     parser.add_argument('--lm', help='Path to LM (.arpa)')
+    parser.add_argument('--num-workers', type=int, default=1, help='Number of processes to compute total statistics')
 
 
 def compute_statistics(args, lexicon, schema, scenario_db, transcripts):
@@ -30,7 +31,7 @@ def compute_statistics(args, lexicon, schema, scenario_db, transcripts):
 
     stats = {}
     statsfile = open(args.stats_output, 'w')
-    stats["total"] = total_stats = get_total_statistics(transcripts, scenario_db)
+    stats["total"] = total_stats = get_total_statistics(transcripts, scenario_db, args.num_workers)
     print "Aggregated total dataset statistics"
     print_group_stats(total_stats)
 
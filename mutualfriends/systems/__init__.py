@@ -13,7 +13,7 @@ def add_system_arguments(parser):
 
 def get_system(name, args, schema=None, timed=False, model_path=None):
     if name in ('rulebased', 'neural'):
-        lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_path=args.lexicon)
+        lexicon = Lexicon(schema, args.learned_lex, stop_words=args.stop_words, lexicon_path=args.lexicon, cache=args.lexicon_cache, num_workers=args.lexicon_workers)
         if args.inverse_lexicon:
             realizer = InverseLexicon.from_file(args.inverse_lexicon)
         else:
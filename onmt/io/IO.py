@@ -11,6 +11,7 @@ from onmt.io.DatasetBase import UNK_WORD, PAD_WORD, BOS_WORD, EOS_WORD
 from onmt.io.TextDataset import TextDataset
 from onmt.io.ImageDataset import ImageDataset
 from onmt.io.AudioDataset import AudioDataset
+from onmt.io.MMapDataset import filter_examples
 
 
 def _getstate(self):
@@ -258,14 +259,60 @@ def build_vocab(train_dataset_files, fields, data_type, share_vocab,
                     val = [val]
                 counter[k].update(val)
 
+    # All datasets have same num of n_src_features and n_tgt_features,
+    # getting the last one is OK.
+    return _build_vocab_from_counters(
+        counter, fields, data_type, share_vocab,
+        dataset.n_src_feats, dataset.n_tgt_feats,
+        src_vocab_size, src_words_min_frequency,
+        tgt_vocab_size, tgt_words_min_frequency)
+
+
+def build_vocab_from_corpora(src_corpus, tgt_corpus, fields, share_vocab,
+                             src_vocab_size, src_words_min_frequency,
+                             tgt_vocab_size, tgt_words_min_frequency,
+                             src_seq_length=0, tgt_seq_length=0):
+    """
+    Build the vocab of text fields from memory-mapped corpora, counting
+    the tokens of the examples kept for training (see `filter_examples`).
+
+    Args:
+        src_corpus (MMapCorpus): source training corpus.
+        tgt_corpus (MMapCorpus): target training corpus.
+        src_seq_length (int): maximum source length (0 for unlimited).
+        tgt_seq_length (int): maximum target length (0 for unlimited).
+        other args: see `build_vocab`.
+
+    Returns:
+        Dict of Fields
+    """
+    keep = filter_examples(src_corpus, tgt_corpus,
+                           src_seq_length, tgt_seq_length)
+    counter = {}
+    for k in fields:
+        counter[k] = Counter()
+    for side, corpus in (('src', src_corpus), ('tgt', tgt_corpus)):
+        for j, level_counter in enumerate(corpus.counters(keep)):
+            key = side if j == 0 else side + "_feat_" + str(j - 1)
+            counter[key] = level_counter
+
+    return _build_vocab_from_counters(
+        counter, fields, 'text', share_vocab,
+        src_corpus.n_feats, tgt_corpus.n_feats,
+        src_vocab_size, src_words_min_frequency,
+        tgt_vocab_size, tgt_words_min_frequency)
+
+
+def _build_vocab_from_counters(counter, fields, data_type, share_vocab,
+                               n_src_feats, n_tgt_feats,
+                               src_vocab_size, src_words_min_frequency,
+                               tgt_vocab_size, tgt_words_min_frequency):
     _build_field_vocab(fields["tgt"], counter["tgt"],
                        max_size=tgt_vocab_size,
                        min_freq=tgt_words_min_frequency)
     print(" * tgt vocab size: %d." % len(fields["tgt"].vocab))
 
-    # All datasets have same num of n_tgt_features,
-    # getting the last one is OK.
-    for j in range(dataset.n_tgt_feats):
+    for j in range(n_tgt_feats):
         key = "tgt_feat_" + str(j)
         _build_field_vocab(fields[key], counter[key])
         print(" * %s vocab size: %d." % (key, len(fields[key].vocab)))
@@ -276,9 +323,7 @@ def build_vocab(train_dataset_files, fields, data_type, share_vocab,
                            min_freq=src_words_min_frequency)
         print(" * src vocab size: %d." % len(fields["src"].vocab))
 
-        # All datasets have same num of n_src_features,
-        # getting the last one is OK.
-        for j in range(dataset.n_src_feats):
+        for j in range(n_src_feats):
             key = "src_feat_" + str(j)
             _build_field_vocab(fields[key], counter[key])
             print(" * %s vocab size: %d." % (key, len(fields[key].vocab)))
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped text corpora, to train on corpora larger than memory.
+
+This is a library-only path: there is no preprocess/train entry point for it
+in this tree. Corpora are built once and then used directly, e.g.:
+
+    src = MMapCorpus.build('train.src.txt', 'data/train.src', 'src')
+    tgt = MMapCorpus.build('train.tgt.txt', 'data/train.tgt', 'tgt')
+    fields = onmt.io.get_fields('text', src.n_feats, tgt.n_feats)
+    fields = onmt.io.build_vocab_from_corpora(
+        src, tgt, fields, share_vocab, src_vocab_size, src_words_min_frequency,
+        tgt_vocab_size, tgt_words_min_frequency)
+    train_iter = MMapIterator(src, tgt, fields, batch_size, device=gpu)
+    trainer.train(train_iter, epoch)
+
+Later runs load the built corpora with `MMapCorpus(prefix)`. Dynamic
+dictionaries (copy attention) are not supported.
+"""
+
+from collections import Counter
+import io
+import random
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from onmt.io.DatasetBase import ONMTDatasetBase
+
+
+class MMapCorpus(object):
+    """
+    A tokenized text corpus stored as memory-mapped integer arrays, so that
+    corpora larger than memory can be used for training.
+
+    `MMapCorpus.build` reads the text corpus once: tokens (words and
+    u"￨"-delimited features) are mapped to corpus-level ids in order of
+    appearance, written to disk by chunks, and counted. Only the dictionary
+    of the corpus is kept in memory. The files are:
+
+     `<prefix>.ids`: int32 array of size `n_tokens x n_levels`, where
+        level 0 is the word and level j > 0 is feature j - 1.
+     `<prefix>.offsets`: int64 array of size `n_lines + 1`; tokens of line
+        i are `ids[offsets[i]:offsets[i+1]]`.
+     `<prefix>.meta`: the dictionary (`itos`) and the token counts of
+        each level.
+
+    Corpus ids are mapped to vocab ids with `vocab_lookup` when batches
+    are made, so the corpus does not depend on the vocab.
+
+    Args:
+        prefix (str): path prefix of the files written by `build`.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        meta = torch.load(prefix + '.meta')
+        self.side = meta['side']
+        self.itos = meta['itos']
+        self.counts = meta['counts']
+        self.n_feats = len(self.itos) - 1
+        self.offsets = np.memmap(prefix + '.offsets', dtype=np.int64,
+                                 mode='r')
+        # np.memmap does not support empty files.
+        if self.offsets[-1] > 0:
+            self.ids = np.memmap(prefix + '.ids', dtype=np.int32, mode='r')
+            self.ids = self.ids.reshape(-1, self.n_feats + 1)
+        else:
+            self.ids = np.zeros((0, self.n_feats + 1), dtype=np.int32)
+        self.lengths = np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        """ Corpus ids of line `index`, `[len x n_levels]`. """
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def counters(self, keep=None, chunk_size=100000):
+        """
+        Args:
+            keep (bool array): lines to count, or None for all the lines.
+            chunk_size (int): number of lines read at once.
+
+        Returns:
+            A list of `Counter` of tokens for the word and each feature.
+        """
+        if keep is None or keep.all():
+            counts = self.counts
+        else:
+            counts = [np.zeros(len(itos), dtype=np.int64)
+                      for itos in self.itos]
+            for i in range(0, len(self), chunk_size):
+                start = self.offsets[i]
+                end = self.offsets[min(i + chunk_size, len(self))]
+                mask = np.repeat(keep[i:i + chunk_size],
+                                 self.lengths[i:i + chunk_size])
+                ids = self.ids[start:end][mask]
+                for level, level_counts in enumerate(counts):
+                    level_counts += np.bincount(ids[:, level],
+                                                minlength=len(level_counts))
+            counts = [level_counts.tolist() for level_counts in counts]
+        return [Counter(dict((tok, count)
+                             for tok, count in zip(itos, level_counts)
+                             if count > 0))
+                for itos, level_counts in zip(self.itos, counts)]
+
+    def vocab_lookup(self, vocab, level=0):
+        """
+        Returns:
+            int64 array mapping the corpus ids of `level` to ids in
+            `vocab` (unknown tokens are mapped to 0, i.e. UNK).
+        """
+        return np.array([vocab.stoi.get(tok, 0) for tok in self.itos[level]],
+                        dtype=np.int64)
+
+    @staticmethod
+    def build(corpus_path, prefix, side, truncate=0, chunk_size=1000000):
+        """
+        Tokenize and integerize a text corpus in one streaming pass.
+
+        Args:
+            corpus_path (str): location of a src or tgt file.
+            prefix (str): path prefix of the output files.
+            side (str): "src" or "tgt".
+            truncate (int): maximum sequence length (0 for unlimited).
+            chunk_size (int): number of tokens buffered before writing.
+
+        Returns:
+            the `MMapCorpus` of the written files.
+        """
+        assert side in ['src', 'tgt']
+        stoi = None
+        itos = None
+        counts = None
+        ids = []
+        offsets = [0]
+        n_tokens = 0
+        with io.open(corpus_path, 'r', encoding='utf-8') as corpus_file, \
+                open(prefix + '.ids', 'wb') as ids_file, \
+                open(prefix + '.offsets', 'wb') as offsets_file:
+            for line in corpus_file:
+                line = line.strip().split()
+                if truncate:
+                    line = line[:truncate]
+                words, feats, n_feats = \
+                    ONMTDatasetBase.extract_text_features(line)
+                levels = [words] + list(feats)
+                if stoi is None and n_feats >= 0:
+                    stoi = [{} for _ in levels]
+                    itos = [[] for _ in levels]
+                    counts = [[] for _ in levels]
+                if words:
+                    assert len(levels) == len(stoi), \
+                        "all lines must have the same number of features"
+                for tokens in zip(*levels):
+                    for level, tok in enumerate(tokens):
+                        i = stoi[level].get(tok)
+                        if i is None:
+                            i = stoi[level][tok] = len(itos[level])
+                            itos[level].append(tok)
+                            counts[level].append(0)
+                        counts[level][i] += 1
+                        ids.append(i)
+                n_tokens += len(words)
+                offsets.append(n_tokens)
+                if len(ids) >= chunk_size:
+                    np.array(ids, dtype=np.int32).tofile(ids_file)
+                    np.array(offsets, dtype=np.int64).tofile(offsets_file)
+                    ids = []
+                    offsets = []
+            np.array(ids, dtype=np.int32).tofile(ids_file)
+            np.array(offsets, dtype=np.int64).tofile(offsets_file)
+
+        if stoi is None:
+            itos = [[]]
+            counts = [[]]
+        torch.save({'side': side, 'itos': itos, 'counts': counts},
+                   prefix + '.meta')
+        return MMapCorpus(prefix)
+
+
+def filter_examples(src, tgt, src_seq_length=0, tgt_seq_length=0):
+    """
+    Select the examples of a pair of corpora like the `filter_pred` of
+    `TextDataset`, where a maximum length of 0 means unlimited.
+
+    Returns:
+        bool array of the examples to keep.
+    """
+    keep = src.lengths > 0
+    if src_seq_length:
+        keep &= src.lengths <= src_seq_length
+    if tgt is not None:
+        keep &= tgt.lengths > 0
+        if tgt_seq_length:
+            keep &= tgt.lengths <= tgt_seq_length
+    return keep
+
+
+class MMapBatch(object):
+    """
+    A batch served by `MMapIterator`, with the same attributes as the
+    torchtext batches of `TextDataset` that are used in training:
+    `src` (data and lengths), `tgt`, `src_feat_j`, `tgt_feat_j`, `indices`,
+    `batch_size` and `dataset`.
+    """
+    def __init__(self, dataset, batch_size):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+
+class MMapIterator(object):
+    """
+    Batch iterator over a pair of src and tgt `MMapCorpus`, with the
+    interface of the training iterators of `Trainer`. Each batch is read
+    from the memory-mapped ids and padded into `[len x batch]` tensors.
+
+    Like torchtext's pool, in training, examples are shuffled, sorted by
+    length within pools of `pool_factor` batches, and batches are
+    shuffled. Examples in a batch are sorted by decreasing src length.
+
+    Args:
+        src (MMapCorpus): source corpus.
+        tgt (MMapCorpus): target corpus, or None.
+        fields (dict): fields with vocab, as from `build_vocab_from_corpora`.
+        batch_size (int): number of examples per batch.
+        device (int): gpu device, or -1 for cpu.
+        train (bool): shuffle the data.
+        src_seq_length (int): maximum src length (0 for unlimited).
+        tgt_seq_length (int): maximum tgt length (0 for unlimited).
+        pool_factor (int): number of batches per sorting pool.
+    """
+    def __init__(self, src, tgt, fields, batch_size, device=-1, train=True,
+                 src_seq_length=0, tgt_seq_length=0, pool_factor=100):
+        if tgt is not None:
+            assert len(src) == len(tgt), \
+                "Two corpuses must have same number of lines!"
+        self.corpora = [('src', src)]
+        if tgt is not None:
+            self.corpora.append(('tgt', tgt))
+        self.fields = dict((k, f) for k, f in fields.items()
+                           if any(k == side or k.startswith(side + '_feat_')
+                                  for side, _ in self.corpora))
+        self.batch_size = batch_size
+        self.device = device
+        self.train = train
+        self.pool_factor = pool_factor
+
+        # Corpus ids -> vocab ids of each level
+        self.lookups = {}
+        for side, corpus in self.corpora:
+            for level in range(corpus.n_feats + 1):
+                key = self._key(side, level)
+                self.lookups[key] = \
+                    corpus.vocab_lookup(fields[key].vocab, level)
+
+        keep = filter_examples(src, tgt, src_seq_length, tgt_seq_length)
+        self.examples = np.nonzero(keep)[0]
+
+    def _key(self, side, level):
+        return side if level == 0 else side + '_feat_' + str(level - 1)
+
+    def __len__(self):
+        return (len(self.examples) + self.batch_size - 1) // self.batch_size
+
+    def get_cur_dataset(self):
+        return self
+
+    def _batches(self):
+        examples = self.examples
+        if not self.train:
+            for i in range(0, len(examples), self.batch_size):
+                yield examples[i:i + self.batch_size]
+            return
+        examples = np.random.permutation(examples)
+        lengths = self.corpora[0][1].lengths
+        pool_size = self.batch_size * self.pool_factor
+        for i in range(0, len(examples), pool_size):
+            pool = examples[i:i + pool_size]
+            pool = pool[np.argsort(lengths[pool], kind='mergesort')]
+            batches = [pool[j:j + self.batch_size]
+                       for j in range(0, len(pool), self.batch_size)]
+            random.shuffle(batches)
+            for batch in batches:
+                yield batch
+
+    def _pad(self, corpus, lookup, field, examples, level):
+        bos = [field.vocab.stoi[field.init_token]] \
+            if field.init_token is not None else []
+        eos = [field.vocab.stoi[field.eos_token]] \
+            if field.eos_token is not None else []
+        lengths = corpus.lengths[examples] + len(bos) + len(eos)
+        data = np.empty((lengths.max(), len(examples)), dtype=np.int64)
+        data.fill(field.vocab.stoi[field.pad_token])
+        for b, i in enumerate(examples):
+            seq = lookup[corpus[i][:, level]]
+            data[:lengths[b], b] = np.concatenate((bos, seq, eos))
+        return torch.from_numpy(data), torch.from_numpy(lengths)
+
+    def _variable(self, data):
+        if self.device >= 0:
+            data = data.cuda(self.device)
+        return Variable(data, volatile=not self.train)
+
+    def __iter__(self):
+        src_lengths = self.corpora[0][1].lengths
+        for examples in self._batches():
+            examples = examples[np.argsort(-src_lengths[examples],
+                                           kind='mergesort')]
+            batch = MMapBatch(self, len(examples))
+            batch.indices = self._variable(torch.from_numpy(examples))
+            for side, corpus in self.corpora:
+                for level in range(corpus.n_feats + 1):
+                    key = self._key(side, level)
+                    field = self.fields[key]
+                    data, lengths = self._pad(corpus, self.lookups[key],
+                                              field, examples, level)
+                    data = self._variable(data)
+                    if field.include_lengths:
+                        data = (data, lengths)
+                    setattr(batch, key, data)
+            yield batch
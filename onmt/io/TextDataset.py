@@ -96,25 +96,50 @@ class TextDataset(ONMTDatasetBase):
         corresponeding to a batch, sums together copies,
         with a dictionary word when it is ambigious.
         """
+        indices = getattr(batch, 'copy_indices', None)
+        if indices is None:
+            indices = TextDataset.copy_indices(batch, tgt_vocab, src_vocabs)
+            # Reused at every decoding step of the batch.
+            batch.copy_indices = indices
+        batch_ids, blank, fill = indices
+        if blank.numel() == 0:
+            return scores
+        # All examples at once: flatten (batch, extended vocab).
+        scores = scores.contiguous()
+        offsets = batch_ids * scores.size(2)
+        blank = offsets + blank
+        flat_scores = scores.view(scores.size(0), -1)
+        flat_scores.index_add_(1, offsets + fill,
+                               flat_scores.index_select(1, blank))
+        flat_scores.index_fill_(1, blank, 1e-10)
+        return scores
+
+    @staticmethod
+    def copy_indices(batch, tgt_vocab, src_vocabs):
+        """
+        Find the source words of the batch that are in the target vocab.
+
+        Returns:
+            (batch_ids, blank, fill) LongTensors: the copy score of
+            example batch_ids[k] at index blank[k] of the extended
+            dictionary goes to index fill[k] of `tgt_vocab`.
+        """
         offset = len(tgt_vocab)
+        batch_ids = []
+        blank = []
+        fill = []
         for b in range(batch.batch_size):
-            blank = []
-            fill = []
             index = batch.indices.data[b]
             src_vocab = src_vocabs[index]
             for i in range(1, len(src_vocab)):
                 sw = src_vocab.itos[i]
-                ti = tgt_vocab.stoi[sw]
+                ti = tgt_vocab.stoi.get(sw, 0)
                 if ti != 0:
+                    batch_ids.append(b)
                     blank.append(offset + i)
                     fill.append(ti)
-            if blank:
-                blank = torch.Tensor(blank).type_as(batch.indices.data)
-                fill = torch.Tensor(fill).type_as(batch.indices.data)
-                scores[:, b].index_add_(1, fill,
-                                        scores[:, b].index_select(1, blank))
-                scores[:, b].index_fill_(1, blank, 1e-10)
-        return scores
+        return tuple(torch.LongTensor(x).type_as(batch.indices.data)
+                     for x in (batch_ids, blank, fill))
 
     @staticmethod
     def make_text_examples_nfeats_tpl(path, truncate, side):
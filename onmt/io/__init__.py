@@ -2,12 +2,14 @@ from onmt.io.IO import collect_feature_vocabs, make_features, \
                        collect_features, get_num_features, \
                        load_fields_from_vocab, get_fields, \
                        save_fields_to_vocab, build_dataset, \
-                       build_vocab, merge_vocabs, OrderedIterator
+                       build_vocab, build_vocab_from_corpora, \
+                       merge_vocabs, OrderedIterator
 from onmt.io.DatasetBase import ONMTDatasetBase, PAD_WORD, BOS_WORD, \
                                 EOS_WORD, UNK
 from onmt.io.TextDataset import TextDataset, ShardedTextCorpusIterator
 from onmt.io.ImageDataset import ImageDataset
 from onmt.io.AudioDataset import AudioDataset
+from onmt.io.MMapDataset import MMapCorpus, MMapIterator
 
 
 __all__ = [PAD_WORD, BOS_WORD, EOS_WORD, UNK, ONMTDatasetBase,
@@ -15,6 +17,6 @@ __all__ = [PAD_WORD, BOS_WORD, EOS_WORD, UNK, ONMTDatasetBase,
            collect_features, get_num_features,
            load_fields_from_vocab, get_fields,
            save_fields_to_vocab, build_dataset,
-           build_vocab, merge_vocabs, OrderedIterator,
-           TextDataset, ImageDataset, AudioDataset,
-           ShardedTextCorpusIterator]
+           build_vocab, build_vocab_from_corpora, merge_vocabs,
+           OrderedIterator, TextDataset, ImageDataset, AudioDataset,
+           ShardedTextCorpusIterator, MMapCorpus, MMapIterator]
@@ -70,7 +70,8 @@ class MultiHeadedAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.res_dropout = nn.Dropout(dropout)
 
-    def forward(self, key, value, query, mask=None):
+    def forward(self, key, value, query, mask=None,
+                layer_cache=None, type=None):
         """
         Compute the context vector and the attention vectors.
 
@@ -82,7 +83,13 @@ class MultiHeadedAttention(nn.Module):
            query (`FloatTensor`): set of `query_len`
                  query vectors  `[batch, query_len, dim]`
            mask: binary mask indicating which keys have
-                 non-zero attention `[batch, query_len, key_len]`
+                 non-zero attention `[batch, query_len, key_len]`,
+                 including cached keys
+           layer_cache (dict): projected keys and values saved by
+                 previous decoding steps, updated in place. With
+                 `type="self"`, the new keys/values are appended to
+                 the cached ones; with `type="context"`, the keys/values
+                 (memory bank) are projected once and reused.
         Returns:
            (`FloatTensor`, `FloatTensor`) :
 
@@ -100,11 +107,6 @@ class MultiHeadedAttention(nn.Module):
         aeq(batch, batch_)
         aeq(d, d_)
         aeq(self.model_dim % 8, 0)
-        if mask is not None:
-            batch_, q_len_, k_len_ = mask.size()
-            aeq(batch_, batch)
-            aeq(k_len_, k_len)
-            aeq(q_len_ == q_len)
         # END CHECKS
 
         def shape_projection(x):
@@ -120,8 +122,36 @@ class MultiHeadedAttention(nn.Module):
                     .view(b, l, self.head_count * self.dim_per_head)
 
         residual = query
-        key_up = shape_projection(self.linear_keys(key))
-        value_up = shape_projection(self.linear_values(value))
+        if layer_cache is not None and type == "self":
+            key_up = self.linear_keys(key)
+            value_up = self.linear_values(value)
+            if layer_cache["self_keys"] is not None:
+                key_up = torch.cat([layer_cache["self_keys"], key_up], 1)
+                value_up = torch.cat([layer_cache["self_values"], value_up],
+                                     1)
+            layer_cache["self_keys"] = key_up
+            layer_cache["self_values"] = value_up
+        elif layer_cache is not None and type == "context":
+            if layer_cache["memory_keys"] is None:
+                layer_cache["memory_keys"] = self.linear_keys(key)
+                layer_cache["memory_values"] = self.linear_values(value)
+            key_up = layer_cache["memory_keys"]
+            value_up = layer_cache["memory_values"]
+        else:
+            key_up = self.linear_keys(key)
+            value_up = self.linear_values(value)
+        k_len = key_up.size(1)
+
+        # CHECKS
+        if mask is not None:
+            batch_, q_len_, k_len_ = mask.size()
+            aeq(batch_, batch)
+            aeq(k_len_, k_len)
+            aeq(q_len_ == q_len)
+        # END CHECKS
+
+        key_up = shape_projection(key_up)
+        value_up = shape_projection(value_up)
         query_up = shape_projection(self.linear_query(query))
 
         scaled = torch.bmm(query_up, key_up.transpose(1, 2))
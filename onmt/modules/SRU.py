@@ -1,7 +1,5 @@
 # flake8: noqa
 
-import subprocess
-import platform
 import os
 import re
 import argparse
@@ -17,17 +15,17 @@ class CheckSRU(argparse.Action):
         super(CheckSRU, self).__init__(option_strings, dest, **kwargs)
 
     def __call__(self, parser, namespace, values, option_string=None):
-        if values == 'SRU':
-            check_sru_requirement(abort=True)
-        # Check pass, set the args.
+        # SRU falls back to the CPU implementation if the cuda
+        # requirements are not satisfied.
         setattr(namespace, self.dest, values)
 
 
-# This SRU version implements its own cuda-level optimization,
+# The cuda version of SRU implements its own cuda-level optimization,
 # so it requires that:
 # 1. `cupy` and `pynvrtc` python package installed.
 # 2. pytorch is built with cuda support.
 # 3. library path set: export LD_LIBRARY_PATH=<cuda lib path>.
+# Otherwise SRU uses the CPU implementation (SRU_Compute_CPU).
 def check_sru_requirement(abort=False):
     """
     Return True if check pass; if check fails and abort is True,
@@ -35,15 +33,9 @@ def check_sru_requirement(abort=False):
     """
     # Check 1.
     try:
-        if platform.system() == 'Windows':
-            subprocess.check_output('pip freeze | findstr cupy', shell=True)
-            subprocess.check_output('pip freeze | findstr pynvrtc',
-                                    shell=True)
-        else:  # Unix-like systems
-            subprocess.check_output('pip freeze | grep -w cupy', shell=True)
-            subprocess.check_output('pip freeze | grep -w pynvrtc',
-                                    shell=True)
-    except subprocess.CalledProcessError:
+        import cupy
+        import pynvrtc
+    except ImportError:
         if not abort:
             return False
         raise AssertionError("Using SRU requires 'cupy' and 'pynvrtc' "
@@ -345,7 +337,8 @@ extern "C" {
 """
 
 
-if check_sru_requirement():
+SRU_CUDA = check_sru_requirement()
+if SRU_CUDA:
     from cupy.cuda import function
     from pynvrtc.compiler import Program
 
@@ -473,6 +466,115 @@ class SRU_Compute(Function):
         return grad_u, grad_x, grad_bias.sum(1).view(-1), grad_init, None
 
 
+class SRU_Recurrence(Function):
+    """
+    Elementwise recurrence of SRU over time for inputs of size
+    `[len x batch x bidir x d]`:
+    c[t] = (c[t-1] - u0[t]) * g1[t] + u0[t], with c[-1] = c0,
+    where the backward direction runs from the last time step.
+    Forward and backward loop over time like `sru_fwd` and `sru_bwd`,
+    on all the columns of a direction at once.
+    """
+    def _steps(self, length, direction):
+        if direction == 0:
+            return range(length)
+        return range(length - 1, -1, -1)
+
+    def forward(self, g1, u0, c0):
+        c = u0.new(*u0.size())
+        for j in range(u0.size(2)):
+            g1_j, u0_j, c_j = g1[:, :, j], u0[:, :, j], c[:, :, j]
+            prev = c0[:, j]
+            for t in self._steps(u0.size(0), j):
+                torch.addcmul(u0_j[t], prev - u0_j[t], g1_j[t], out=c_j[t])
+                prev = c_j[t]
+        self.save_for_backward(g1, u0, c0, c)
+        return c
+
+    def backward(self, grad_c):
+        g1, u0, c0, c = self.saved_tensors
+        grad_g1 = g1.new(*g1.size())
+        grad_u0 = u0.new(*u0.size())
+        grad_c0 = c0.new(*c0.size())
+        for j in range(u0.size(2)):
+            g1_j, u0_j, c_j = g1[:, :, j], u0[:, :, j], c[:, :, j]
+            grad_g1_j, grad_u0_j = grad_g1[:, :, j], grad_u0[:, :, j]
+            grad_c_j = grad_c[:, :, j]
+            steps = self._steps(u0.size(0), j)
+            cur = c0.new(*c0[:, j].size()).zero_()
+            # Time steps in reverse order of the forward pass.
+            for i in range(len(steps) - 1, -1, -1):
+                t = steps[i]
+                prev = c_j[steps[i-1]] if i > 0 else c0[:, j]
+                cur = cur + grad_c_j[t]
+                torch.mul(cur, prev - u0_j[t], out=grad_g1_j[t])
+                torch.mul(cur, 1 - g1_j[t], out=grad_u0_j[t])
+                cur = cur * g1_j[t]
+            grad_c0[:, j] = cur
+        return grad_g1, grad_u0, grad_c0
+
+
+class SRU_Compute_CPU(object):
+    """
+    CPU version of SRU_Compute. It computes the same formulas as the cuda
+    kernels with pytorch operations: the gates of all time steps are
+    computed at once, and only the elementwise recurrence of c loops over
+    time (see SRU_Recurrence).
+    """
+    def __init__(self, activation_type, d_out, bidirectional=False):
+        self.activation_type = activation_type
+        self.d_out = d_out
+        self.bidirectional = bidirectional
+
+    def __call__(self, u, x, bias, init=None, mask_h=None):
+        bidir = 2 if self.bidirectional else 1
+        length = x.size(0) if x.dim() == 3 else 1
+        batch = x.size(-2)
+        d = self.d_out
+        k = u.size(-1) // d
+        k_ = k // 2 if self.bidirectional else k
+
+        # Columns of u are (direction, dim, k) in the cuda kernels.
+        # unbind: a single gradient buffer for u in backward.
+        u = torch.unbind(u.contiguous().view(length, batch, bidir, d, k_), 4)
+        u0 = u[0]
+        bias = bias.view(2, bidir, d)
+        g1 = torch.sigmoid(u[1] + bias[0].expand_as(u0))
+        g2 = torch.sigmoid(u[2] + bias[1].expand_as(u0))
+        if k_ == 3:
+            x_ = x.contiguous().view(length, batch, bidir, d)
+        else:
+            x_ = u[3]
+        if init is None:
+            init = Variable(x.data.new(batch, bidir, d).zero_())
+        else:
+            init = init.contiguous().view(batch, bidir, d)
+
+        c = SRU_Recurrence()(g1, u0, init)
+
+        if self.activation_type == 1:
+            val = torch.tanh(c)
+        elif self.activation_type == 2:
+            val = torch.clamp(c, min=0)
+        else:
+            val = c
+        if mask_h is not None:
+            val = val * mask_h.view(1, batch, bidir, d).expand_as(val)
+        h = (val - x_) * g2 + x_
+
+        size = (length, batch, d*bidir) if x.dim() == 3 else (batch, d*bidir)
+        h = h.view(*size)
+        c = c.view(*size)
+        if x.dim() == 2:
+            last_hidden = c
+        elif self.bidirectional:
+            # -> directions x batch x dim
+            last_hidden = torch.stack((c[-1, :, :d], c[0, :, d:]))
+        else:
+            last_hidden = c[-1]
+        return h, last_hidden
+
+
 class SRUCell(nn.Module):
     def __init__(self, n_in, n_out, dropout=0, rnn_dropout=0,
                  bidirectional=False, use_tanh=1, use_relu=0):
@@ -526,16 +628,22 @@ class SRUCell(nn.Module):
         x_2d = x if x.dim() == 2 else x.contiguous().view(-1, n_in)
         u = x_2d.mm(self.weight)
 
+        # Use the cuda kernels when available, otherwise the CPU version.
+        if SRU_CUDA and input.is_cuda:
+            compute = SRU_Compute
+        else:
+            compute = SRU_Compute_CPU
+
         if self.training and (self.dropout > 0):
             bidir = 2 if self.bidirectional else 1
             mask_h = self.get_dropout_mask_((batch, n_out*bidir), self.dropout)
-            h, c = SRU_Compute(self.activation_type, n_out,
-                               self.bidirectional)(
+            h, c = compute(self.activation_type, n_out,
+                           self.bidirectional)(
                        u, input, self.bias, c0, mask_h
                    )
         else:
-            h, c = SRU_Compute(self.activation_type, n_out,
-                               self.bidirectional)(
+            h, c = compute(self.activation_type, n_out,
+                           self.bidirectional)(
                        u, input, self.bias, c0
                    )
 
@@ -555,6 +663,8 @@ class SRU(nn.Module):
 
     This implementation is adpoted from the author of the paper:
     https://github.com/taolei87/sru/blob/master/cuda_functional.py.
+    The cuda kernels are used for cuda inputs when `check_sru_requirement`
+    passes, otherwise the CPU implementation (`SRU_Compute_CPU`).
 
     Args:
       input_size (int): input to model
@@ -570,9 +680,6 @@ class SRU(nn.Module):
     def __init__(self, input_size, hidden_size,
                  num_layers=2, dropout=0, rnn_dropout=0,
                  bidirectional=False, use_tanh=1, use_relu=0):
-        # An entry check here, will catch on train side and translate side
-        # if requirements are not satisfied.
-        check_sru_requirement(abort=True)
         super(SRU, self).__init__()
         self.n_in = input_size
         self.n_out = hidden_size
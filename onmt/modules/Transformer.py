@@ -163,7 +163,18 @@ class TransformerDecoderLayer(nn.Module):
         # it gets TransformerDecoderLayer's cuda behavior automatically.
         self.register_buffer('mask', mask)
 
-    def forward(self, input, memory_bank, src_pad_mask, tgt_pad_mask):
+    def forward(self, input, memory_bank, src_pad_mask, tgt_pad_mask,
+                layer_cache=None, step=0):
+        """
+        Args:
+            input (`FloatTensor`): inputs at positions `step` to
+                `step + input_len` `[batch, input_len, dim]`
+            tgt_pad_mask: padding mask of all target words up to the
+                last input `[batch, input_len, step + input_len]`
+            layer_cache (dict): keys and values of previous positions and
+                of the memory bank (see `MultiHeadedAttention`)
+            step (int): number of previous positions in `layer_cache`
+        """
         # Args Checks
         input_batch, input_len, _ = input.size()
         contxt_batch, contxt_len, _ = memory_bank.size()
@@ -172,19 +183,24 @@ class TransformerDecoderLayer(nn.Module):
         src_batch, t_len, s_len = src_pad_mask.size()
         tgt_batch, t_len_, t_len__ = tgt_pad_mask.size()
         aeq(input_batch, contxt_batch, src_batch, tgt_batch)
-        aeq(t_len, t_len_, t_len__, input_len)
+        aeq(t_len, t_len_, input_len)
+        aeq(t_len__, step + input_len)
         aeq(s_len, contxt_len)
         # END Args Checks
 
-        dec_mask = torch.gt(tgt_pad_mask + self.mask[:, :tgt_pad_mask.size(1),
-                            :tgt_pad_mask.size(1)]
+        dec_mask = torch.gt(tgt_pad_mask +
+                            self.mask[:, step:step + input_len,
+                                      :step + input_len]
                             .expand_as(tgt_pad_mask), 0)
         input_norm = self.layer_norm_1(input)
         query, attn = self.self_attn(input_norm, input_norm, input_norm,
-                                     mask=dec_mask)
+                                     mask=dec_mask,
+                                     layer_cache=layer_cache, type="self")
         query_norm = self.layer_norm_2(query+input)
         mid, attn = self.context_attn(memory_bank, memory_bank, query_norm,
-                                      mask=src_pad_mask)
+                                      mask=src_pad_mask,
+                                      layer_cache=layer_cache,
+                                      type="context")
         output = self.feed_forward(mid+query+input)
 
         # CHECKS
@@ -269,17 +285,26 @@ class TransformerDecoder(nn.Module):
         memory_len, memory_batch, _ = memory_bank.size()
         aeq(tgt_batch, memory_batch)
 
+        # Keys and values of previous positions are cached in the state,
+        # so only the new positions are run through the layers.
+        step = 0
+        all_tgt = tgt
         if state.previous_input is not None:
-            tgt = torch.cat([state.previous_input, tgt], 0)
+            step = state.previous_input.size(0)
+            all_tgt = torch.cat([state.previous_input, tgt], 0)
+        if state.cache is None:
+            state.init_cache(self.num_layers)
+        if state.memory_bank is not memory_bank:
+            state.reset_memory_cache(memory_bank)
 
         src = state.src
         src_words = src[:, :, 0].transpose(0, 1)
-        tgt_words = tgt[:, :, 0].transpose(0, 1)
+        tgt_words = all_tgt[:, :, 0].transpose(0, 1)
         src_batch, src_len = src_words.size()
-        tgt_batch, tgt_len = tgt_words.size()
+        tgt_batch, all_tgt_len = tgt_words.size()
         aeq(tgt_batch, memory_batch, src_batch, tgt_batch)
         aeq(memory_len, src_len)
-        # aeq(tgt_len, tgt_len)
+        aeq(all_tgt_len, step + tgt_len)
         # END CHECKS
 
         # Initialize return variables.
@@ -289,7 +314,7 @@ class TransformerDecoder(nn.Module):
             attns["copy"] = []
 
         # Run the forward pass of the TransformerDecoder.
-        emb = self.embeddings(tgt)
+        emb = self.embeddings(tgt, step=step)
         assert emb.dim() == 3  # len x batch x embedding_dim
 
         output = emb.transpose(0, 1).contiguous()
@@ -299,26 +324,27 @@ class TransformerDecoder(nn.Module):
         src_pad_mask = src_words.data.eq(padding_idx).unsqueeze(1) \
             .expand(src_batch, tgt_len, src_len)
         tgt_pad_mask = tgt_words.data.eq(padding_idx).unsqueeze(1) \
-            .expand(tgt_batch, tgt_len, tgt_len)
+            .expand(tgt_batch, tgt_len, all_tgt_len)
 
         for i in range(self.num_layers):
             output, attn \
                 = self.transformer_layers[i](output, src_memory_bank,
-                                             src_pad_mask, tgt_pad_mask)
+                                             src_pad_mask, tgt_pad_mask,
+                                             layer_cache=state.cache[i],
+                                             step=step)
 
         output = self.layer_norm(output)
         # Process the result and update the attentions.
         outputs = output.transpose(0, 1).contiguous()
-        if state.previous_input is not None:
-            outputs = outputs[state.previous_input.size(0):]
-            attn = attn[:, state.previous_input.size(0):].squeeze()
+        if step > 0:
+            attn = attn.squeeze()
             attn = torch.stack([attn])
         attns["std"] = attn
         if self._copy:
             attns["copy"] = attn
 
         # Update the state.
-        state.update_state(tgt)
+        state.update_state(all_tgt)
 
         return outputs, state, attns
 
@@ -335,6 +361,10 @@ class TransformerDecoderState(DecoderState):
         """
         self.src = src
         self.previous_input = None
+        # Per layer keys and values of previous positions
+        # (`[batch, len, dim]`) and of the memory bank.
+        self.cache = None
+        self.memory_bank = None
 
     @property
     def _all(self):
@@ -343,11 +373,64 @@ class TransformerDecoderState(DecoderState):
         """
         return (self.previous_input, self.src)
 
+    @property
+    def _all_cached(self):
+        """
+        Cached keys and values of previous positions; the batch is the
+        first dimension. Keys and values of the memory bank only depend on
+        the memory bank and are not updated with the beam.
+        """
+        if self.cache is None:
+            return ()
+        return tuple(layer_cache[k] for layer_cache in self.cache
+                     for k in ("self_keys", "self_values")
+                     if layer_cache[k] is not None)
+
+    def init_cache(self, num_layers):
+        self.cache = [{"self_keys": None, "self_values": None,
+                       "memory_keys": None, "memory_values": None}
+                      for _ in range(num_layers)]
+
+    def reset_memory_cache(self, memory_bank):
+        """ Keys and values are recomputed for a new memory bank. """
+        self.memory_bank = memory_bank
+        if self.cache is not None:
+            for layer_cache in self.cache:
+                layer_cache["memory_keys"] = None
+                layer_cache["memory_values"] = None
+
+    def detach(self):
+        super(TransformerDecoderState, self).detach()
+        for h in self._all_cached:
+            h.detach_()
+
     def update_state(self, input):
         """ Called for every decoder forward pass. """
         self.previous_input = input
 
+    def beam_update(self, idx, positions, beam_size):
+        super(TransformerDecoderState, self).beam_update(
+            idx, positions, beam_size)
+        for e in self._all_cached:
+            br, l, d = e.size()
+            sent_states = e.view(beam_size, br // beam_size, l, d)[:, idx]
+            sent_states.data.copy_(
+                sent_states.data.index_select(0, positions))
+
     def repeat_beam_size_times(self, beam_size):
         """ Repeat beam_size times along batch dimension. """
         self.src = Variable(self.src.data.repeat(1, beam_size, 1),
                             volatile=True)
+        if self.previous_input is not None:
+            self.previous_input = Variable(
+                self.previous_input.data.repeat(1, beam_size, 1),
+                volatile=True)
+        if self.cache is not None:
+            for layer_cache in self.cache:
+                for k in ("self_keys", "self_values"):
+                    if layer_cache[k] is not None:
+                        layer_cache[k] = Variable(
+                            layer_cache[k].data.repeat(beam_size, 1, 1),
+                            volatile=True)
+        # The memory bank is repeated by the caller
+        self.reset_memory_cache(None)
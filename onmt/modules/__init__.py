@@ -18,10 +18,7 @@ from onmt.modules.WeightNorm import WeightNormConv2d
 from onmt.Models import EncoderBase, MeanEncoder, StdRNNDecoder, \
     RNNDecoderBase, InputFeedRNNDecoder, RNNEncoder, NMTModel
 
-from onmt.modules.SRU import check_sru_requirement
-can_use_sru = check_sru_requirement()
-if can_use_sru:
-    from onmt.modules.SRU import SRU
+from onmt.modules.SRU import SRU, check_sru_requirement
 
 
 # For flake8 compatibility.
@@ -34,7 +31,5 @@ __all__ = [EncoderBase, MeanEncoder, RNNDecoderBase, InputFeedRNNDecoder,
            TransformerEncoder, TransformerDecoder, Embeddings, Elementwise,
            MatrixTree, WeightNormConv2d, ConvMultiStepAttention,
            CNNEncoder, CNNDecoder, StackedLSTM, StackedGRU,
-           context_gate_factory, CopyGeneratorLossCompute, AudioEncoder]
-
-if can_use_sru:
-    __all__.extend([SRU, check_sru_requirement])
+           context_gate_factory, CopyGeneratorLossCompute, AudioEncoder,
+           SRU, check_sru_requirement]
@@ -0,0 +1,56 @@
+'''
+Compare the forward/backward time of onmt's SRU with nn.LSTM of the same hidden
+size and number of layers. Runs on CPU unless --gpu is given (the CUDA kernel is
+used on GPU when cupy and pynvrtc are installed).
+'''
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.autograd import Variable
+
+from onmt.modules.SRU import SRU, check_sru_requirement
+
+def timed(rnn, inputs, backward, num_iters):
+    # Warm up, so that one-time setup (e.g. CUDA initialization) is not timed
+    rnn(inputs)
+    if inputs.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in xrange(num_iters):
+        outputs, _ = rnn(inputs)
+        if backward:
+            rnn.zero_grad()
+            outputs.sum().backward()
+    if inputs.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / num_iters
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seq-len', default=50, type=int)
+    parser.add_argument('--batch-size', default=32, type=int)
+    parser.add_argument('--input-size', default=300, type=int)
+    parser.add_argument('--hidden-size', default=300, type=int)
+    parser.add_argument('--num-layers', default=2, type=int)
+    parser.add_argument('--bidirectional', default=False, action='store_true')
+    parser.add_argument('--num-iters', default=10, type=int)
+    parser.add_argument('--gpu', default=False, action='store_true')
+    args = parser.parse_args()
+
+    print 'CUDA SRU kernel available: {}'.format(check_sru_requirement())
+    rnns = [
+            ('lstm', nn.LSTM(args.input_size, args.hidden_size, num_layers=args.num_layers, bidirectional=args.bidirectional)),
+            ('sru', SRU(args.input_size, args.hidden_size, num_layers=args.num_layers, bidirectional=args.bidirectional)),
+            ]
+    inputs = Variable(torch.randn(args.seq_len, args.batch_size, args.input_size))
+    if args.gpu:
+        inputs = inputs.cuda()
+
+    for name, rnn in rnns:
+        if args.gpu:
+            rnn.cuda()
+        forward_time = timed(rnn, inputs, False, args.num_iters)
+        train_time = timed(rnn, inputs, True, args.num_iters)
+        print '{}: forward {:.2f}ms, forward+backward {:.2f}ms'.format(name, forward_time * 1000, train_time * 1000)
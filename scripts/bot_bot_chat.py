@@ -11,12 +11,13 @@ from cocoa.core.util import read_json
 from cocoa.core.schema import Schema
 from cocoa.core.scenario_db import ScenarioDB, add_scenario_arguments
 from cocoa.core.dataset import add_dataset_arguments
+from cocoa.core.self_play import generate_parallel
 
 from core.scenario import Scenario
 from core.controller import Controller
 from systems import add_system_arguments, get_system
 
-def generate_examples(agents, agent_names, scenarios, num_examples, max_turns):
+def generate_examples(agents, agent_names, scenarios, num_examples, max_turns, remove_fail=False):
     examples = []
     for i in range(num_examples):
         scenario = scenarios[i % len(scenarios)]
@@ -28,38 +29,76 @@ def generate_examples(agents, agent_names, scenarios, num_examples, max_turns):
                     new_agents[1].new_session(1, scenario.kbs[1])]
             controller = Controller(scenario, sessions, session_names=new_agent_names)
             ex = controller.simulate(max_turns, verbose=args.verbose)
+            if remove_fail and not controller.complete():
+                continue
             examples.append(ex)
     return examples
 
+def get_jobs(agent_pairs, scenarios, num_examples):
+    jobs = []
+    for agent_names in agent_pairs:
+        for i in range(num_examples):
+            scenario = scenarios[i % len(scenarios)]
+            # Each agent needs to play both buyer and seller
+            for j in (0, 1):
+                jobs.append((scenario.uuid, (agent_names[j], agent_names[1-j])))
+    return jobs
+
+def simulate_job(agents, job):
+    scenario_uuid, agent_names = job
+    scenario = scenario_db.get(scenario_uuid)
+    sessions = [agents[agent_names[0]].new_session(0, scenario.kbs[0]),
+            agents[agent_names[1]].new_session(1, scenario.kbs[1])]
+    controller = Controller(scenario, sessions, session_names=agent_names)
+    ex = controller.simulate(args.max_turns, verbose=args.verbose)
+    return ex, controller.complete()
+
+def load_agents():
+    agents = {}
+    for agent_params in args.agent:
+        agent_type, model_path, agent_name = agent_params
+        agents[agent_name] = get_system(agent_type, args, schema, model_path=model_path)
+    return agents
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(conflict_handler='resolve')
     parser.add_argument('--agent', nargs=3, metavar=('type', 'checkpoint', 'name'), action='append', help='Agent parameters')
     parser.add_argument('--max-turns', default=20, type=int, help='Maximum number of turns')
     parser.add_argument('--num-examples', type=int)
     parser.add_argument('--examples-path')
+    parser.add_argument('--random-seed', help='Random seed', type=int, default=None)
+    parser.add_argument('--remove-fail', default=False, action='store_true', help='Remove failed dialogues')
+    parser.add_argument('--workers', default=0, type=int,
+            help='Number of processes; if > 0, stream examples to --examples-path as JSONL and resume from it')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='whether or not to have verbose prints')
     add_scenario_arguments(parser)
     add_system_arguments(parser)
     args = parser.parse_args()
+    if args.random_seed is not None:
+        random.seed(args.random_seed)
+        np.random.seed(args.random_seed)
 
     schema = Schema(args.schema_path)
     scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path), Scenario)
 
-    agents = {}
-    for agent_params in args.agent:
-        agent_type, model_path, agent_name = agent_params
-        agents[agent_name] = get_system(agent_type, args, schema, model_path=model_path)
-
     scenarios = scenario_db.scenarios_list
-    examples = []
-    for base_agent_name in ('sl-words',):
-        base_agent = agents[base_agent_name]
-        for agent_name, agent in agents.iteritems():
-            if agent_name != base_agent_name:
-                agents = [base_agent, agent]
-                agent_names = [base_agent_name, agent_name]
-                examples.extend(generate_examples(agents, agent_names, scenarios, args.num_examples, args.max_turns))
+    base_agent_name = 'sl-words'
+    agent_pairs = [(base_agent_name, agent_params[2]) for agent_params in args.agent
+            if agent_params[2] != base_agent_name]
 
-    with open(args.examples_path, 'w') as out:
-        print >>out, json.dumps([e.to_dict() for e in examples])
+    if args.workers > 0:
+        # Each worker loads its own systems
+        jobs = get_jobs(agent_pairs, scenarios, args.num_examples)
+        num_failed = generate_parallel(jobs, args.workers, load_agents, simulate_job, args.examples_path,
+                remove_fail=args.remove_fail, random_seed=args.random_seed)
+        for worker_id in sorted(num_failed):
+            print 'Number of failed dialogues in worker {}: {}'.format(worker_id, num_failed[worker_id])
+    else:
+        all_agents = load_agents()
+        examples = []
+        for agent_names in agent_pairs:
+            agents = [all_agents[name] for name in agent_names]
+            examples.extend(generate_examples(agents, agent_names, scenarios, args.num_examples, args.max_turns, args.remove_fail))
 
+        with open(args.examples_path, 'w') as out:
+            print >>out, json.dumps([e.to_dict() for e in examples])
@@ -6,10 +6,13 @@ import argparse
 import random
 import json
 import numpy as np
+from itertools import izip
 
 from cocoa.core.util import read_json
 from cocoa.core.schema import Schema
 from cocoa.core.scenario_db import ScenarioDB
+from cocoa.core.controller import BatchedController
+from cocoa.core.self_play import generate_parallel
 import cocoa.options
 
 from core.scenario import Scenario
@@ -17,23 +20,29 @@ from core.controller import Controller
 from systems import get_system
 import options
 
-def generate_examples(num_examples, scenario_db, examples_path, max_examples, remove_fail, max_turns):
+def generate_examples(num_examples, scenario_db, examples_path, max_examples, remove_fail, max_turns, batch_size=1):
     examples = []
     num_failed = 0
     scenarios = scenario_db.scenarios_list
     #scenarios = [scenario_db.scenarios_map['S_8COuPdjZZkYgrzhb']]
     #random.shuffle(scenarios)
-    for i in range(max_examples):
-        scenario = scenarios[num_examples % len(scenarios)]
-        sessions = [agents[0].new_session(0, scenario.kbs[0]), agents[1].new_session(1, scenario.kbs[1])]
-        controller = Controller(scenario, sessions)
-        ex = controller.simulate(max_turns, verbose=args.verbose)
-        if not controller.complete():
-            num_failed += 1
-            if remove_fail:
-                continue
-        examples.append(ex)
-        num_examples += 1
+    for i in range(0, max_examples, batch_size):
+        controllers = []
+        for j in range(min(batch_size, max_examples - i)):
+            scenario = scenarios[(num_examples + j) % len(scenarios)]
+            sessions = [agents[0].new_session(0, scenario.kbs[0]), agents[1].new_session(1, scenario.kbs[1])]
+            controllers.append(Controller(scenario, sessions))
+        if len(controllers) == 1:
+            exs = [controllers[0].simulate(max_turns, verbose=args.verbose)]
+        else:
+            exs = BatchedController(controllers).simulate(max_turns, verbose=args.verbose)
+        for controller, ex in izip(controllers, exs):
+            if not controller.complete():
+                num_failed += 1
+                if remove_fail:
+                    continue
+            examples.append(ex)
+            num_examples += 1
     with open(examples_path, 'w') as out:
         print >>out, json.dumps([e.to_dict() for e in examples])
     if num_failed == 0:
@@ -41,6 +50,34 @@ def generate_examples(num_examples, scenario_db, examples_path, max_examples, re
     else:
         print 'Number of failed dialogues:', num_failed
 
+def simulate_job(agents, job):
+    scenario_uuid, agent_names = job
+    scenario = scenario_db.get(scenario_uuid)
+    sessions = [agents[0].new_session(0, scenario.kbs[0]), agents[1].new_session(1, scenario.kbs[1])]
+    controller = Controller(scenario, sessions, session_names=agent_names)
+    ex = controller.simulate(args.max_turns, verbose=args.verbose)
+    return ex, controller.complete()
+
+def generate_examples_parallel(num_examples, scenario_db, examples_path, max_examples, remove_fail, num_workers):
+    '''
+    Stream examples to the JSONL file `examples_path`, skipping those already there.
+    '''
+    scenarios = scenario_db.scenarios_list
+    agent_names = tuple(args.agents)
+    jobs = [(scenarios[(num_examples + i) % len(scenarios)].uuid, agent_names)
+            for i in range(max_examples)]
+    num_failed = generate_parallel(jobs, num_workers, load_agents, simulate_job, examples_path,
+            remove_fail=remove_fail, random_seed=args.random_seed)
+    if sum(num_failed.values()) == 0:
+        print 'All dialogues succeeded!'
+    else:
+        for worker_id in sorted(num_failed):
+            print 'Number of failed dialogues in worker {}: {}'.format(worker_id, num_failed[worker_id])
+
+def load_agents():
+    return [get_system(name, args, schema, model_path=model_path)
+            for name, model_path in zip(args.agents, args.agent_checkpoints)]
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(conflict_handler='resolve')
     parser.add_argument('--random-seed', help='Random seed', type=int, default=1)
@@ -53,6 +90,10 @@ if __name__ == '__main__':
             help='json path to store the results of the chat examples')
     parser.add_argument('--max-examples', default=20, type=int,
             help='Number of test examples to predict')
+    parser.add_argument('--batch-size', default=1, type=int,
+            help='Number of dialogues to simulate in lockstep')
+    parser.add_argument('--workers', default=0, type=int,
+            help='Number of processes; if > 0, stream examples to --results-path as JSONL and resume from it')
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='whether or not to have verbose prints')
     cocoa.options.add_scenario_arguments(parser)
     cocoa.options.add_dataset_arguments(parser)
@@ -66,8 +107,11 @@ if __name__ == '__main__':
     scenario_db = ScenarioDB.from_dict(schema, read_json(args.scenarios_path), Scenario)
 
     assert len(args.agent_checkpoints) == len(args.agents)
-    agents = [get_system(name, args, schema, model_path=model_path)
-            for name, model_path in zip(args.agents, args.agent_checkpoints)]
     num_examples = args.scenario_offset
 
-    generate_examples(num_examples, scenario_db, args.results_path, args.max_examples, args.remove_fail, args.max_turns)
+    if args.workers > 0:
+        # Each worker loads its own systems
+        generate_examples_parallel(num_examples, scenario_db, args.results_path, args.max_examples, args.remove_fail, args.workers)
+    else:
+        agents = load_agents()
+        generate_examples(num_examples, scenario_db, args.results_path, args.max_examples, args.remove_fail, args.max_turns, args.batch_size)